@@ -0,0 +1,102 @@
+"""
+Admission control for the inference routes.
+
+At most ``max_in_flight`` requests run inference at once and at most
+``max_waiting`` more wait for a slot. Anything beyond that is turned away
+immediately with 429, and a request that waits longer than
+``wait_timeout`` seconds gets 503, both with a Retry-After header. Clients
+get a fast, explicit answer instead of a timeout, and memory stays bounded
+under a burst of uploads.
+"""
+
+import functools
+import math
+import threading
+from contextlib import contextmanager
+
+
+class Overloaded(Exception):
+    """The server cannot take the request now; retry after ``retry_after`` seconds"""
+
+    def __init__(self, message='Server busy, please retry', status=503, retry_after=1):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+        self.retry_after = retry_after
+
+    @property
+    def headers(self):
+        return {'Retry-After': str(max(1, math.ceil(self.retry_after)))}
+
+
+class AdmissionGate:
+    """Bounded slots plus a bounded waiting line in front of inference"""
+
+    def __init__(self, max_in_flight=32, max_waiting=32, wait_timeout=10.0, retry_after=1):
+        self.max_in_flight = max_in_flight
+        self.max_waiting = max_waiting
+        self.wait_timeout = wait_timeout
+        self.retry_after = retry_after
+
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+
+    def acquire(self):
+        """Take a slot, waiting in line if there is room; raise Overloaded otherwise"""
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                if self.waiting >= self.max_waiting:
+                    self.rejected += 1
+                    raise Overloaded('Too many requests in progress, please retry', 429, self.retry_after)
+                self.waiting += 1
+            try:
+                admitted = self._slots.acquire(timeout=self.wait_timeout)
+            finally:
+                with self._lock:
+                    self.waiting -= 1
+            if not admitted:
+                with self._lock:
+                    self.timed_out += 1
+                raise Overloaded('Timed out waiting for capacity, please retry', 503, self.retry_after)
+
+        with self._lock:
+            self.in_flight += 1
+            self.admitted += 1
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+        self._slots.release()
+
+    @contextmanager
+    def slot(self):
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def limit(self, view):
+        """Decorate a Flask view so it only runs while holding a slot"""
+        @functools.wraps(view)
+        def limited(*args, **kwargs):
+            with self.slot():
+                return view(*args, **kwargs)
+        return limited
+
+    def stats(self):
+        with self._lock:
+            return {
+                'in_flight': self.in_flight,
+                'waiting': self.waiting,
+                'max_in_flight': self.max_in_flight,
+                'max_waiting': self.max_waiting,
+                'admitted': self.admitted,
+                'rejected': self.rejected,
+                'timed_out': self.timed_out,
+            }
@@ -1,47 +1,263 @@
-from flask import Flask, render_template, request, jsonify, send_from_directory
+from flask import Flask, render_template, request, jsonify, send_file, url_for, abort, Response, stream_with_context
 import os
 import numpy as np
-from PIL import Image
-import tensorflow as tf
-from werkzeug.utils import secure_filename
 import base64
+import functools
 import io
+import json
+import math
+import queue
+import threading
+import time
+import zipfile
+
+from admission import AdmissionGate, Overloaded
+from backends import KerasBackend, load_backend, load_ensemble_member, thread_budget
+from cascade import with_cascade
+from ensemble import DEFAULT_AUGMENTATIONS, TTA_MODES, EscalatingPredictor, TTAPredictor, parse_augmentations
+from inference import create_batcher, interpret_probability
+from ingest import ZIP_SIGNATURE, IngestError, iter_multipart_files, read_data_url_image, sniff_image
+from job_queue import JobQueue
+from model_registry import export_serving_function, parse_batch_sizes
+from model_server import ModelServerClient
+from pipeline import DecodeStage, is_image_file, iter_batch_predictions
+from prediction_cache import PredictionCache
+from preprocessing import preprocess_image
+from responses import NotAcceptable, negotiate, render, wants_image
+from sample_gallery import SampleGallery
+from slide import FieldTooLarge, analyze_field, open_field
+from streaming import init_app as init_streaming
+from telemetry import REGISTRY, init_app as init_telemetry, record_span, span
 
 app = Flask(__name__)
-app.config['UPLOAD_FOLDER'] = 'uploads'
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
 
-# Create uploads directory if it doesn't exist
-os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+# Micro-batching: concurrent requests are merged into one forward pass of up to
+# BATCH_MAX_SIZE images, waiting at most BATCH_MAX_WAIT_MS for the batch to fill
+app.config['BATCH_MAX_SIZE'] = int(os.environ.get('BATCH_MAX_SIZE', 32))
+app.config['BATCH_MAX_WAIT_MS'] = float(os.environ.get('BATCH_MAX_WAIT_MS', 5))
+app.config['BATCH_MAX_QUEUE'] = int(os.environ.get('BATCH_MAX_QUEUE', 256))
+
+# Feed the model raw uint8 pixels and let it do the /255 itself (quarter-size batches)
+app.config['UINT8_INPUT'] = os.environ.get('UINT8_INPUT', '0') == '1'
+
+# Inference backend: keras, xla, tflite-dynamic, tflite-int8 or stub (see backends.py)
+app.config['MODEL_BACKEND'] = os.environ.get('MODEL_BACKEND', 'keras')
+
+# Cascade (see cascade.py): a first-stage classifier saved at CASCADE_MODEL answers
+# confident images itself and forwards only the uncertain ones to the full model
+app.config['CASCADE_MODEL'] = os.environ.get('CASCADE_MODEL')
+
+# Run inference in a separate model host process (see model_server.py) instead
+# of loading the model into every web worker
+app.config['MODEL_SERVER_SOCKET'] = os.environ.get('MODEL_SERVER_SOCKET')
+
+# Prediction cache keyed by pixel content and model version: PREDICTION_CACHE_SIZE
+# entries in memory (0 disables it), plus an optional SQLite file that survives restarts
+app.config['PREDICTION_CACHE_SIZE'] = int(os.environ.get('PREDICTION_CACHE_SIZE', 4096))
+app.config['PREDICTION_CACHE_PATH'] = os.environ.get('PREDICTION_CACHE_PATH')
+
+prediction_cache = None
+if app.config['PREDICTION_CACHE_SIZE'] > 0:
+    prediction_cache = PredictionCache(app.config['PREDICTION_CACHE_SIZE'], app.config['PREDICTION_CACHE_PATH'])
+
+# Sample gallery: built once, rebuilt only when cell_images/ changes
+app.config['SAMPLE_CACHE_MAX_AGE'] = 365 * 24 * 3600
+gallery = SampleGallery()
+
+# JSON bodies up to this size are parsed in one go; larger ones (base64 images
+# sent to /predict_sample) are decoded as they stream in
+app.config['JSON_INLINE_LIMIT'] = 64 * 1024
+
+# Upper bound on the pixels of a /predict_slide field; formats that cannot be read in
+# windows (PNG, JPEG, compressed TIFF) are decoded whole, so this bounds their memory
+app.config['SLIDE_MAX_PIXELS'] = int(os.environ.get('SLIDE_MAX_PIXELS', 64 * 1024 * 1024))
+
+# Upper bound on images accepted by one /predict_batch request (zip members included)
+app.config['BATCH_UPLOAD_MAX_IMAGES'] = int(os.environ.get('BATCH_UPLOAD_MAX_IMAGES', 10000))
+
+# Zip archives are expanded in memory: upper bounds on the uncompressed size of one
+# member and of all members of a request, checked before anything is inflated
+app.config['ZIP_MEMBER_MAX_BYTES'] = int(os.environ.get('ZIP_MEMBER_MAX_BYTES', 32 * 1024 * 1024))
+app.config['ZIP_TOTAL_MAX_BYTES'] = int(os.environ.get('ZIP_TOTAL_MAX_BYTES', 512 * 1024 * 1024))
+
+# Asynchronous jobs: stored in a SQLite file and processed by JOB_WORKERS threads; images
+# whose worker stops renewing its lease for JOB_LEASE_SECONDS are queued again
+app.config['JOB_DB_PATH'] = os.environ.get('JOB_DB_PATH', 'jobs.sqlite3')
+app.config['JOB_WORKERS'] = int(os.environ.get('JOB_WORKERS', 2))
+app.config['JOB_LEASE_SECONDS'] = float(os.environ.get('JOB_LEASE_SECONDS', 60))
+app.config['JOB_EVENTS_INTERVAL'] = 0.5
+job_queue = JobQueue(app.config['JOB_DB_PATH'], batch_size=app.config['BATCH_MAX_SIZE'],
+                     workers=app.config['JOB_WORKERS'], lease_seconds=app.config['JOB_LEASE_SECONDS'])
 
-# Load the model
-try:
-    # Try different model loading approaches
-    model = None
+# Admission control: at most MAX_IN_FLIGHT requests run inference at once and
+# ADMISSION_QUEUE more may wait up to ADMISSION_TIMEOUT seconds for a slot. Past
+# that, requests get 429 (line full) or 503 (waited too long) with Retry-After.
+app.config['MAX_IN_FLIGHT'] = int(os.environ.get('MAX_IN_FLIGHT', app.config['BATCH_MAX_SIZE']))
+app.config['ADMISSION_QUEUE'] = int(os.environ.get('ADMISSION_QUEUE', 32))
+app.config['ADMISSION_TIMEOUT'] = float(os.environ.get('ADMISSION_TIMEOUT', 10))
+app.config['RETRY_AFTER'] = int(os.environ.get('RETRY_AFTER', 1))
+admission = AdmissionGate(app.config['MAX_IN_FLIGHT'], app.config['ADMISSION_QUEUE'],
+                          app.config['ADMISSION_TIMEOUT'], app.config['RETRY_AFTER'])
+
+# Staged execution: every route decodes and resizes images on one shared pool of
+# DECODE_WORKERS threads (Pillow releases the GIL), at most DECODE_QUEUE images at a time,
+# which hand them to the batcher's bounded queue, while the model runs each forward pass
+# on INTRA_OP_THREADS threads (INTER_OP_THREADS between ops). By default a quarter of the
+# cores decode and the rest run the model, so the two stages do not fight over cores
+app.config['DECODE_WORKERS'], app.config['INTRA_OP_THREADS'], app.config['INTER_OP_THREADS'] = thread_budget(
+    int(os.environ.get('DECODE_WORKERS', 0)), int(os.environ.get('INTRA_OP_THREADS', 0)),
+    int(os.environ.get('INTER_OP_THREADS', 0)))
+app.config['DECODE_QUEUE'] = int(os.environ.get('DECODE_QUEUE', 4 * app.config['DECODE_WORKERS']))
+decode_stage = DecodeStage(app.config['DECODE_WORKERS'], app.config['DECODE_QUEUE'], app.config['ADMISSION_TIMEOUT'])
+
+# Trace IDs, per-stage timings and Prometheus metrics at /metrics; PROFILER_ENABLED=1
+# also exposes /debug/profile for sampling flame graphs
+app.config['PROFILER_ENABLED'] = os.environ.get('PROFILER_ENABLED', '0') == '1'
+init_telemetry(app, profiler_enabled=app.config['PROFILER_ENABLED'])
+
+# Batch sizes to run through the model before reporting ready
+app.config['WARMUP_BATCH_SIZES'] = parse_batch_sizes(os.environ.get('WARMUP_BATCH_SIZES', '1,8,32'))
+
+# Test-time augmentation (see ensemble.py): with TTA_MODE=uncertain, an image whose
+# probability is within TTA_MARGIN of 0.5 is re-run under TTA_AUGMENTATIONS and through
+# the extra ENSEMBLE_MODELS (backend names or model paths), and the response gets the
+# mean and variance; TTA_MODE=always does this for every image
+app.config['TTA_MODE'] = os.environ.get('TTA_MODE', 'off')
+if app.config['TTA_MODE'] not in TTA_MODES:
+    raise ValueError(f"Unknown TTA_MODE {app.config['TTA_MODE']!r} (choose from: {', '.join(TTA_MODES)})")
+app.config['TTA_MARGIN'] = float(os.environ.get('TTA_MARGIN', 0.15))
+app.config['TTA_AUGMENTATIONS'] = parse_augmentations(os.environ.get('TTA_AUGMENTATIONS', ','.join(DEFAULT_AUGMENTATIONS)))
+app.config['ENSEMBLE_MODELS'] = [spec.strip() for spec in os.environ.get('ENSEMBLE_MODELS', '').split(',') if spec.strip()]
+
+# Batching scheduler in front of the model; it owns every call into the model.
+# Set by start_model once the model is loaded and warmed up.
+batcher = None
+escalation = None
+cascade_backend = None
+input_dtype = np.float32
+startup = {'ready': False, 'status': 'loading'}
+
+REGISTRY.collector('malaria_model_ready', 'Whether the model is loaded and warmed up', 'gauge',
+                   lambda: int(startup['ready']))
+REGISTRY.collector('malaria_batch_queue_depth', 'Images waiting for the batching scheduler', 'gauge',
+                   lambda: batcher.stats().get('queue_depth') if batcher is not None else None)
+REGISTRY.collector('malaria_prediction_cache', 'Prediction cache counters', 'gauge',
+                   lambda: {k: v for k, v in prediction_cache.stats().items() if isinstance(v, (int, float)) and not isinstance(v, bool)}
+                   if prediction_cache is not None else None)
+REGISTRY.collector('malaria_decode', 'Decode stage workers, queue and counters', 'gauge',
+                   lambda: {k: v for k, v in decode_stage.stats().items() if v is not None})
+REGISTRY.collector('malaria_admission', 'Admission gate state and counters', 'gauge', admission.stats)
+REGISTRY.collector('malaria_cascade', 'Images answered by the cascade first stage or forwarded', 'gauge',
+                   lambda: {k: v for k, v in cascade_backend.stats().items() if k in ('images', 'forwarded')}
+                   if cascade_backend is not None else None)
+REGISTRY.collector('malaria_tta', 'Test-time augmentation escalations', 'gauge',
+                   lambda: {k: v for k, v in escalation.stats().items() if isinstance(v, (int, float))}
+                   if escalation is not None else None)
+
+def start_tta(primary_predict_batch, load_members=True):
+    """Put the escalation policy in front of the batcher when TTA_MODE is on
     
-    # First try: direct load
+    ``primary_predict_batch`` runs the primary model's stacked views. It is
+    the backend itself rather than the batcher, so all views of an image go
+    through one forward pass instead of being split up and mixed with other
+    requests' images; the caller serializes it with the batcher's passes.
+    """
+    global escalation
+    
+    if app.config['TTA_MODE'] == 'off':
+        return
+    
+    members = [(primary_predict_batch, input_dtype)]
+    if app.config['ENSEMBLE_MODELS'] and not load_members:
+        print("ENSEMBLE_MODELS is ignored when using a model server")
+    elif app.config['ENSEMBLE_MODELS']:
+        for spec in app.config['ENSEMBLE_MODELS']:
+            member, _ = load_ensemble_member(spec, uint8_input=app.config['UINT8_INPUT'])
+            members.append((member.predict_batch, member.input_dtype))
+    
+    tta = TTAPredictor(members, app.config['TTA_AUGMENTATIONS'])
+    margin = None if app.config['TTA_MODE'] == 'always' else app.config['TTA_MARGIN']
+    escalation = EscalatingPredictor(batcher.predict_batch, tta, margin=margin)
+    print(f"Test-time augmentation: {app.config['TTA_MODE']}, {tta.views} views per escalated image")
+
+def start_background_work():
+    """Start the job workers and the gallery precompute once the model answers"""
+    # Jobs submitted while the model was loading have been waiting in the database
+    job_queue.start(batcher.predict_batch, input_dtype, decode_stage)
+    
+    # Precompute the gallery predictions so the first sample clicks are instant
     try:
-        model = tf.keras.models.load_model('my_model.keras copy')
-        print("Model loaded successfully!")
-    except:
-        # Second try: using TFSMLayer for SavedModel format
-        try:
-            from tensorflow import keras
-            model = keras.layers.TFSMLayer('my_model.keras copy', call_endpoint='serving_default')
-            print("Model loaded using TFSMLayer!")
-        except:
-            # Third try: rename file and try again
+        gallery.precompute(startup['model_version'], predict_malaria)
+    except Exception as e:
+        print(f"Error precomputing sample predictions: {e}")
+
+def start_model():
+    """Load and warm up the model, then open the batcher for requests"""
+    global batcher, input_dtype, cascade_backend
+    
+    if app.config['MODEL_SERVER_SOCKET']:
+        # The model host scales uint8 pixels itself, and they are a quarter of the size to send
+        input_dtype = np.uint8
+        client = ModelServerClient(app.config['MODEL_SERVER_SOCKET'])
+        # Stay not ready (503) until the model host answers: it may still be loading its model
+        delay = 0.5
+        while True:
             try:
-                import shutil
-                shutil.copy('my_model.keras copy', 'my_model.keras')
-                model = tf.keras.models.load_model('my_model.keras')
-                print("Model loaded after renaming!")
+                info = client.info()
+                break
             except Exception as e:
-                print(f"Error loading model: {e}")
-                model = None
-except Exception as e:
-    print(f"Error loading model: {e}")
-    model = None
+                print(f"Model server not reachable yet, retrying in {delay:.1f}s: {e}")
+                time.sleep(delay)
+                delay = min(30.0, delay * 2)
+        startup.update(backend=info.get('backend'), loader=info.get('loader'), model_version=info['model_version'])
+        batcher = client
+        # The model server runs each image's stacked views in one pass, like the in-process path
+        start_tta(batcher.predict_pass, load_members=False)
+        startup.update(ready=True, status='ready')
+        print(f"Using model server at {app.config['MODEL_SERVER_SOCKET']}")
+        start_background_work()
+        return
+    
+    try:
+        # Load the model
+        backend, info = load_backend(app.config['MODEL_BACKEND'], uint8_input=app.config['UINT8_INPUT'],
+                                     num_threads=app.config['INTRA_OP_THREADS'],
+                                     inter_op_threads=app.config['INTER_OP_THREADS'])
+        serving_backend, serving_info = backend, info
+        if app.config['CASCADE_MODEL']:
+            serving_backend, serving_info = with_cascade(backend, info, app.config['CASCADE_MODEL'],
+                                                           bucket_sizes=app.config['WARMUP_BATCH_SIZES'])
+            cascade_backend = serving_backend
+        startup.update(backend=serving_info['backend'], loader=info['loader'], load_seconds=info['load_seconds'],
+                       model_version=serving_info['model_version'])
+        
+        new_batcher = create_batcher(
+            serving_backend,
+            warmup_batch_sizes=app.config['WARMUP_BATCH_SIZES'],
+            max_batch_size=app.config['BATCH_MAX_SIZE'],
+            max_wait_ms=app.config['BATCH_MAX_WAIT_MS'],
+            max_queue_size=app.config['BATCH_MAX_QUEUE'],
+        )
+        input_dtype = backend.input_dtype
+        batcher = new_batcher
+        # Views run in one pass of their own, taking turns with the batcher on the model
+        start_tta(batcher.serialized(backend.predict_batch))
+        startup.update(ready=True, status='ready')
+    except Exception as e:
+        print(f"Error loading model: {e}")
+        startup.update(status='failed', error=str(e))
+        return
+    
+    start_background_work()
+    
+    # Trace and save the serving function so the next cold start can skip Keras
+    record = info.get('record', {})
+    if isinstance(backend, KerasBackend) and record.get('loader') == 'keras' and not record.get('serving_cache'):
+        try:
+            export_serving_function(backend.raw_model)
+        except Exception as e:
+            print(f"Could not cache serving function: {e}")
 
 # Allowed file extensions
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'bmp'}
@@ -49,76 +265,111 @@ ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'bmp'}
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def preprocess_image(image_path, target_size=(224, 224)):
-    """Preprocess image for model prediction"""
-    try:
-        # Load and resize image
-        img = Image.open(image_path)
-        img = img.resize(target_size)
-        
-        # Convert to RGB if necessary
-        if img.mode != 'RGB':
-            img = img.convert('RGB')
-        
-        # Convert to array and normalize
-        img_array = np.array(img)
-        img_array = img_array / 255.0
-        
-        # Add batch dimension
-        img_array = np.expand_dims(img_array, axis=0)
-        
-        return img_array
-    except Exception as e:
-        print(f"Error preprocessing image: {e}")
-        return None
+def validate_image_upload(filename, head):
+    """Reject an uploaded image from its name and first bytes, before the rest is read"""
+    if filename == '':
+        return 'No selected file'
+    if not allowed_file(filename):
+        return 'Invalid file type'
+    if sniff_image(head) is None:
+        return 'Not a supported image file'
+    return None
+
+def validate_slide_upload(filename, head):
+    """Like validate_image_upload, but whole-field TIFFs are accepted too"""
+    if filename.lower().endswith(('.tif', '.tiff')):
+        return None if sniff_image(head) == 'image/tiff' else 'Not a supported image file'
+    return validate_image_upload(filename, head)
+
+def validate_batch_upload(filename, head):
+    """Like validate_image_upload, but zip archives of images are accepted too"""
+    if filename.lower().endswith('.zip'):
+        return None if head.startswith(ZIP_SIGNATURE) else 'Invalid zip file'
+    return validate_image_upload(filename, head)
+
+def iter_uploads(fields, validate, spool=False):
+    """Stream the file parts of a multipart request as (filename, data, error)"""
+    if request.mimetype != 'multipart/form-data':
+        return iter(())
+    return iter_multipart_files(request.stream, request.mimetype_params.get('boundary', ''), fields,
+                                validate=validate, max_bytes=app.config['MAX_CONTENT_LENGTH'], spool=spool)
 
-def predict_malaria(image_path):
+def decode_and_queue(image):
+    """Decode stage: preprocess one image and hand it to the batcher's bounded queue
+    
+    Runs on a decode thread, which moves on to the next image as soon as this
+    one is queued. Returns ``(pixels, cache_key, probability, lookup_seconds)``;
+    probability is a cached float, a Future from the batcher, or None when the
+    batcher (the model server client) has no queue to hand over to.
+    ``lookup_seconds`` is the cache lookup time (None without a lookup), for
+    the request thread to record: this thread has no request trace.
+    """
+    processed_img = preprocess_image(image, dtype=input_dtype)
+    if processed_img is None:
+        return None, None, None, None
+    
+    # Same pixels under the same model version: reuse the earlier prediction
+    pixels = processed_img[0]
+    cache_key = None
+    probability = None
+    lookup_seconds = None
+    if prediction_cache is not None and startup.get('model_version'):
+        started = time.perf_counter()
+        cache_key = prediction_cache.key(pixels, startup['model_version'])
+        probability = prediction_cache.get(cache_key)
+        lookup_seconds = time.perf_counter() - started
+    
+    if probability is None and hasattr(batcher, 'submit'):
+        # Raises queue.Full when the batcher's queue is full
+        probability = batcher.submit(pixels)
+    return pixels, cache_key, probability, lookup_seconds
+
+def predict_malaria(image):
     """Predict malaria from image"""
-    if model is None:
+    if batcher is None:
+        if startup['status'] == 'loading':
+            return {"error": "Model is still loading, please retry"}
         return {"error": "Model not loaded"}
     
     try:
-        # Preprocess image
-        processed_img = preprocess_image(image_path)
-        if processed_img is None:
+        # Decoding runs on the shared decode stage; the request thread only waits
+        with span('preprocess'):
+            pixels, cache_key, probability, lookup_seconds = decode_stage.submit(decode_and_queue, image).result()
+        if lookup_seconds is not None:
+            record_span('cache_lookup', lookup_seconds)
+        if pixels is None:
             return {"error": "Failed to process image"}
         
-        # Make prediction
-        if hasattr(model, 'predict'):
-            # Standard Keras model
-            prediction = model.predict(processed_img)
-        else:
-            # TFSMLayer model
-            prediction = model(processed_img)
-            if isinstance(prediction, dict):
-                # Extract the first value from the dictionary
-                prediction = list(prediction.values())[0]
-        
-        # Handle different prediction formats
-        if len(prediction.shape) == 1:
-            # Single value output
-            probability = float(prediction[0])
-        elif prediction.shape[1] == 1:
-            # Single column output
-            probability = float(prediction[0][0])
-        else:
-            # Multiple columns, assume second column is positive class
-            probability = float(prediction[0][1])
+        if not isinstance(probability, float):
+            # The batcher runs the image together with concurrent requests
+            with span('inference'):
+                probability = probability.result() if probability is not None else batcher.predict(pixels)
+            if cache_key is not None:
+                prediction_cache.put(cache_key, probability)
         
-        # Determine result (reversed logic)
-        if probability > 0.5:
-            result = "Uninfected (Malaria Negative)"
-            confidence = probability
-        else:
-            result = "Parasitized (Malaria Positive)"
-            confidence = 1 - probability
+        if escalation is None:
+            return interpret_probability(probability)
         
-        return {
-            "result": result,
-            "confidence": round(confidence * 100, 2),
-            "probability": round(probability * 100, 2)
+        # Borderline images (all of them with TTA_MODE=always) are averaged over views and models
+        with span('tta'):
+            mean, variance, escalated = escalation.predict_batch_stats(pixels[None], [probability])
+        result = interpret_probability(float(mean[0]))
+        result['uncertainty'] = {
+            'escalated': bool(escalated[0]),
+            'single_pass_probability': round(probability * 100, 2),
         }
+        if escalated[0]:
+            result['uncertainty'].update(
+                views=escalation.tta.views,
+                mean=round(float(mean[0]) * 100, 2),
+                std=round(math.sqrt(variance[0]) * 100, 2),
+                variance=round(float(variance[0]), 6),
+            )
+        return result
         
+    except queue.Full:
+        # The batcher's own queue is full: shed the request like the admission gate does
+        raise Overloaded("Server busy, please retry", 503, app.config['RETRY_AFTER'])
     except Exception as e:
         return {"error": f"Prediction error: {str(e)}"}
 
@@ -126,114 +377,362 @@ def predict_malaria(image_path):
 def index():
     return render_template('index.html')
 
+def error_format():
+    # Errors follow the negotiated format too, falling back to JSON
+    try:
+        return negotiate(request)
+    except NotAcceptable:
+        return 'application/json'
+
+@app.errorhandler(Overloaded)
+def overloaded(error):
+    return render({'error': error.message}, error_format(), error.status, error.headers)
+
+@app.errorhandler(IngestError)
+def bad_upload(error):
+    return render({'error': error.message}, error_format(), error.status)
+
+@app.errorhandler(NotAcceptable)
+def not_acceptable(error):
+    return jsonify({'error': error.message}), error.status
+
 @app.route('/upload', methods=['POST'])
+@admission.limit
 def upload_file():
-    if 'file' not in request.files:
-        return jsonify({'error': 'No file part'})
+    mimetype = negotiate(request)
+    # Stream the body; a part that is not an image is rejected from its first bytes
+    with span('read_upload'):
+        upload = next(iter_uploads(('file',), validate_image_upload), None)
+    if upload is None:
+        return render({'error': 'No file part'}, mimetype, 400)
+    
+    filename, image_bytes, error = upload
+    if error:
+        return render({'error': error}, mimetype, 400)
+    
+    # Make prediction; the same bytes feed the model and the echoed image
+    result = predict_malaria(io.BytesIO(image_bytes))
+    
+    # Convert image to base64 for display; machine clients skip the echo
+    if wants_image(mimetype):
+        with span('encode_base64'):
+            img_data = base64.b64encode(image_bytes).decode('utf-8')
+        result['image_data'] = f"data:{sniff_image(bytes(image_bytes[:16]))};base64,{img_data}"
+    
+    with span('serialize'):
+        return render(result, mimetype)
+
+def collect_uploads(uploads):
+    """Expand streamed (filename, data, error) parts into (name, source) pairs
+    
+    Returns the pairs plus (name, error) for uploads that were rejected.
+    Zip members are read lazily by the decode workers. Members larger than
+    ZIP_MEMBER_MAX_BYTES are rejected, and IngestError (413) is raised once
+    the members add up to more than ZIP_TOTAL_MAX_BYTES.
+    """
+    sources = []
+    rejected = []
+    expanded = 0
+    for filename, data, error in uploads:
+        if error:
+            rejected.append((filename, error))
+        elif filename.lower().endswith('.zip'):
+            try:
+                archive = zipfile.ZipFile(io.BytesIO(data))
+            except zipfile.BadZipFile:
+                rejected.append((filename, 'Invalid zip file'))
+                continue
+            for info in archive.infolist():
+                if info.is_dir() or not is_image_file(info.filename):
+                    continue
+                # zipfile never inflates a member past the size in its directory entry
+                if info.file_size > app.config['ZIP_MEMBER_MAX_BYTES']:
+                    rejected.append((f'{filename}/{info.filename}', 'File too large'))
+                    continue
+                expanded += info.file_size
+                if expanded > app.config['ZIP_TOTAL_MAX_BYTES']:
+                    raise IngestError('Zip archives too large once expanded', 413)
+                sources.append((f'{filename}/{info.filename}', functools.partial(archive.read, info)))
+        else:
+            sources.append((filename, data))
+    return sources, rejected
+
+@app.route('/predict_batch', methods=['POST'])
+def predict_batch():
+    """Predict many images (multipart files and/or zip archives), streaming NDJSON results"""
+    if batcher is None:
+        return jsonify({'error': 'Model not loaded'})
     
-    file = request.files['file']
-    if file.filename == '':
-        return jsonify({'error': 'No selected file'})
+    # One slot covers reading the body and the whole stream; it is released when the
+    # response is closed
+    admission.acquire()
+    try:
+        sources, rejected = collect_uploads(iter_uploads(('files', 'file'), validate_batch_upload))
+    except BaseException:
+        admission.release()
+        raise
+    if not sources and not rejected:
+        admission.release()
+        return jsonify({'error': 'No file part'}), 400
+    if len(sources) > app.config['BATCH_UPLOAD_MAX_IMAGES']:
+        admission.release()
+        return jsonify({'error': f"Too many images (limit {app.config['BATCH_UPLOAD_MAX_IMAGES']})"}), 413
     
-    if file and allowed_file(file.filename):
-        filename = secure_filename(file.filename)
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(filepath)
+    def generate():
+        for filename, error in rejected:
+            yield json.dumps({'filename': filename, 'error': error}) + '\n'
         
-        # Make prediction
-        result = predict_malaria(filepath)
+        # Decode, batching and inference overlap; lines are sent as each batch finishes
+        for filename, probability, error in iter_batch_predictions(
+                sources, batcher.predict_batch, batch_size=app.config['BATCH_MAX_SIZE'],
+                input_dtype=input_dtype, decode_stage=decode_stage):
+            row = {'filename': filename}
+            row.update({'error': error} if error else interpret_probability(probability))
+            yield json.dumps(row) + '\n'
+    
+    response = Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+    response.call_on_close(admission.release)
+    return response
+
+@app.route('/predict_slide', methods=['POST'])
+@admission.limit
+def predict_slide():
+    """Find and classify every cell in a full smear field; returns parasitemia and per-cell boxes"""
+    mimetype = negotiate(request)
+    if batcher is None:
+        return render({'error': 'Model not loaded'}, mimetype)
+    
+    # The field goes to a temporary file and is read from there a strip at a time
+    upload = next(iter_uploads(('file',), validate_slide_upload, spool=True), None)
+    if upload is None:
+        return render({'error': 'No file part'}, mimetype, 400)
+    filename, spooled, error = upload
+    if error:
+        return render({'error': error}, mimetype, 400)
+    
+    with spooled:
+        mode = request.args.get('mode', 'segment')
+        if mode not in ('segment', 'grid'):
+            return render({'error': 'mode must be segment or grid'}, mimetype, 400)
         
-        # Convert image to base64 for display
         try:
-            with open(filepath, 'rb') as img_file:
-                img_data = base64.b64encode(img_file.read()).decode('utf-8')
-                result['image_data'] = f"data:image/png;base64,{img_data}"
-        except:
-            result['image_data'] = None
+            with span('decode_field'):
+                reader = open_field(spooled.name, max_pixels=app.config['SLIDE_MAX_PIXELS'])
+        except FieldTooLarge as e:
+            return render({'error': str(e)}, mimetype, 413)
+        except Exception as e:
+            return render({'error': f'Failed to process image: {e}'}, mimetype, 400)
         
-        # Clean up uploaded file
         try:
-            os.remove(filepath)
-        except:
-            pass
-        
-        return jsonify(result)
+            with span('analyze_field'):
+                summary = analyze_field(reader, batcher.predict_batch, mode=mode,
+                                        batch_size=app.config['BATCH_MAX_SIZE'],
+                                        input_dtype=input_dtype, decode_stage=decode_stage)
+        except Exception as e:
+            return render({'error': f'Failed to analyze slide: {e}'}, mimetype, 400)
+    summary['filename'] = filename
+    with span('serialize'):
+        return render(summary, mimetype)
+
+@app.route('/jobs', methods=['POST'])
+def submit_job():
+    """Queue a set of images (multipart files and/or zip archives) and return a job ID right away"""
+    sources, rejected = collect_uploads(iter_uploads(('files', 'file'), validate_batch_upload))
+    if not sources and not rejected:
+        return jsonify({'error': 'No file part'}), 400
+    if not sources:
+        return jsonify({'error': 'No valid images', 'rejected': [name for name, _ in rejected]})
+    if len(sources) > app.config['BATCH_UPLOAD_MAX_IMAGES']:
+        return jsonify({'error': f"Too many images (limit {app.config['BATCH_UPLOAD_MAX_IMAGES']})"}), 413
     
-    return jsonify({'error': 'Invalid file type'})
+    job_id = job_queue.submit((name, source() if callable(source) else source) for name, source in sources)
+    return jsonify({
+        'job_id': job_id,
+        'status_url': url_for('job_status', job_id=job_id),
+        'events_url': url_for('job_events', job_id=job_id),
+        'results_url': url_for('job_results', job_id=job_id),
+        'rejected': [name for name, _ in rejected],
+    }), 202
 
-@app.route('/sample_images')
-def get_sample_images():
-    """Get sample images from cell_images directory"""
-    sample_images = []
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    """Get the status and progress of a job"""
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    return jsonify(job)
+
+@app.route('/jobs/<job_id>/results')
+def job_results(job_id):
+    """Get the per-image results of a job (finished images only while it is running)"""
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    job['results'] = job_queue.results(job_id)
+    return jsonify(job)
+
+@app.route('/jobs/<job_id>/events')
+def job_events(job_id):
+    """Stream job progress as server-sent events until the job is done"""
+    if job_queue.get(job_id) is None:
+        return jsonify({'error': 'Unknown job'}), 404
     
-    # Get some sample images from both directories
-    parasitized_dir = 'cell_images/Parasitized'
-    uninfected_dir = 'cell_images/Uninfected'
+    def generate():
+        last = None
+        while True:
+            job = job_queue.get(job_id)
+            progress = (job['status'], job['done'], job['failed'])
+            if progress != last:
+                yield f"data: {json.dumps(job)}\n\n"
+                last = progress
+            if job['status'] == 'done':
+                return
+            time.sleep(app.config['JOB_EVENTS_INTERVAL'])
     
-    try:
-        # Get 5 sample parasitized images
-        if os.path.exists(parasitized_dir):
-            parasitized_files = [f for f in os.listdir(parasitized_dir) if f.endswith('.png')][:5]
-            for filename in parasitized_files:
-                filepath = os.path.join(parasitized_dir, filename)
-                with open(filepath, 'rb') as img_file:
-                    img_data = base64.b64encode(img_file.read()).decode('utf-8')
-                    sample_images.append({
-                        'filename': filename,
-                        'data': f"data:image/png;base64,{img_data}",
-                        'type': 'Parasitized'
-                    })
-        
-        # Get 5 sample uninfected images
-        if os.path.exists(uninfected_dir):
-            uninfected_files = [f for f in os.listdir(uninfected_dir) if f.endswith('.png')][:5]
-            for filename in uninfected_files:
-                filepath = os.path.join(uninfected_dir, filename)
-                with open(filepath, 'rb') as img_file:
-                    img_data = base64.b64encode(img_file.read()).decode('utf-8')
-                    sample_images.append({
-                        'filename': filename,
-                        'data': f"data:image/png;base64,{img_data}",
-                        'type': 'Uninfected'
-                    })
-    except Exception as e:
-        print(f"Error loading sample images: {e}")
+    return Response(generate(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+@app.route('/ready')
+def ready():
+    """Readiness probe: 200 once the model is loaded and warmed up, 503 before"""
+    return jsonify(startup), 200 if startup['ready'] else 503
+
+@app.route('/batch_metrics')
+def batch_metrics():
+    """Expose batch size, queue depth and wait time of the batching scheduler"""
+    if batcher is None:
+        return jsonify({'error': 'Model not loaded'})
+    return jsonify({**batcher.stats(), 'decode': decode_stage.stats()})
+
+@app.route('/admission_metrics')
+def admission_metrics():
+    """Expose in-flight, waiting and rejected request counts of the admission gate"""
+    return jsonify(admission.stats())
+
+@app.route('/cascade_metrics')
+def cascade_metrics():
+    """Expose how many images the cascade forwarded to the full model"""
+    if cascade_backend is None:
+        return jsonify({'error': 'Cascade disabled'})
+    return jsonify(cascade_backend.stats())
+
+@app.route('/tta_metrics')
+def tta_metrics():
+    """Expose how many images test-time augmentation escalated"""
+    if escalation is None:
+        return jsonify({'error': 'Test-time augmentation disabled'})
+    return jsonify(escalation.stats())
+
+@app.route('/cache_metrics')
+def cache_metrics():
+    """Expose hit/miss counters of the prediction cache"""
+    if prediction_cache is None:
+        return jsonify({'error': 'Prediction cache disabled'})
+    return jsonify(prediction_cache.stats())
+
+@app.route('/sample_images')
+def get_sample_images():
+    """Get the sample gallery index; thumbnails are fetched separately"""
+    sample_images = [{
+        'id': sample['id'],
+        'filename': sample['filename'],
+        'type': sample['type'],
+        'thumbnail_url': url_for('sample_thumbnail', sample_id=sample['id']),
+        'image_url': url_for('sample_image', sample_id=sample['id']),
+    } for sample in gallery.samples()]
     
-    return jsonify(sample_images)
+    response = jsonify(sample_images)
+    response.cache_control.public = True
+    response.cache_control.max_age = 60
+    response.add_etag()
+    return response.make_conditional(request)
+
+@app.route('/sample_images/<sample_id>/thumbnail')
+def sample_thumbnail(sample_id):
+    """Serve a cached sample thumbnail (IDs change with the file, so cache forever)"""
+    if gallery.get(sample_id) is None:
+        abort(404)
+    return send_file(gallery.thumbnail_path(sample_id), max_age=app.config['SAMPLE_CACHE_MAX_AGE'])
+
+@app.route('/sample_images/<sample_id>/image')
+def sample_image(sample_id):
+    """Serve the full-size sample image"""
+    sample = gallery.get(sample_id)
+    if sample is None:
+        abort(404)
+    return send_file(os.path.abspath(sample['path']), max_age=app.config['SAMPLE_CACHE_MAX_AGE'])
 
 @app.route('/predict_sample', methods=['POST'])
+@admission.limit
 def predict_sample():
     """Predict malaria from a sample image"""
-    data = request.get_json()
+    mimetype = negotiate(request)
+    
+    # Large bodies carry a base64 image: decode it as it streams in
+    if (request.content_length or 0) > app.config['JSON_INLINE_LIMIT']:
+        with span('decode_base64'):
+            prefix, image_bytes = read_data_url_image(request.stream, max_bytes=app.config['MAX_CONTENT_LENGTH'])
+        if image_bytes is None:
+            return render({'error': 'No image data provided'}, mimetype, 400)
+        
+        result = predict_malaria(io.BytesIO(image_bytes))
+        if wants_image(mimetype):
+            with span('encode_base64'):
+                result['image_data'] = f"{prefix},{base64.b64encode(image_bytes).decode('ascii')}"
+        with span('serialize'):
+            return render(result, mimetype)
+    
+    with span('parse_json'):
+        data = request.get_json()
+    
+    # Gallery samples are referenced by ID and their predictions are precomputed
+    sample_id = data.get('sample_id')
+    if sample_id:
+        with span('gallery_prediction'):
+            result = gallery.prediction(sample_id, startup.get('model_version'), predict_malaria)
+        if result is None:
+            return render({'error': 'Unknown sample'}, mimetype)
+        if wants_image(mimetype):
+            result['image_data'] = url_for('sample_image', sample_id=sample_id)
+        with span('serialize'):
+            return render(result, mimetype)
+    
     image_data = data.get('image_data')
     
     if not image_data:
-        return jsonify({'error': 'No image data provided'})
+        return render({'error': 'No image data provided'}, mimetype)
     
     try:
         # Decode base64 image
-        image_data = image_data.split(',')[1]  # Remove data URL prefix
-        image_bytes = base64.b64decode(image_data)
-        
-        # Save temporarily
-        temp_path = os.path.join(app.config['UPLOAD_FOLDER'], 'temp_sample.png')
-        with open(temp_path, 'wb') as f:
-            f.write(image_bytes)
-        
-        # Make prediction
-        result = predict_malaria(temp_path)
-        result['image_data'] = data.get('image_data')  # Return original image data
+        with span('decode_base64'):
+            image_data = image_data.split(',')[1]  # Remove data URL prefix
+            image_bytes = base64.b64decode(image_data)
         
-        # Clean up
-        try:
-            os.remove(temp_path)
-        except:
-            pass
+        # Make prediction straight from the decoded bytes
+        result = predict_malaria(io.BytesIO(image_bytes))
+        if wants_image(mimetype):
+            result['image_data'] = data.get('image_data')  # Return original image data
         
-        return jsonify(result)
+        with span('serialize'):
+            return render(result, mimetype)
         
     except Exception as e:
-        return jsonify({'error': f'Error processing sample image: {str(e)}'})
+        return render({'error': f'Error processing sample image: {str(e)}'}, mimetype)
+
+# WebSocket endpoint for continuous feeds (needs flask-sock): each connection has at most
+# STREAM_WINDOW frames in flight and is closed once more than STREAM_MAX_BUFFERED frames
+# wait behind them; frames of all connections share STREAM_WORKERS threads
+app.config['STREAM_WINDOW'] = int(os.environ.get('STREAM_WINDOW', 8))
+app.config['STREAM_MAX_BUFFERED'] = int(os.environ.get('STREAM_MAX_BUFFERED', app.config['STREAM_WINDOW']))
+app.config['STREAM_WORKERS'] = int(os.environ.get('STREAM_WORKERS', app.config['MAX_IN_FLIGHT'] + app.config['ADMISSION_QUEUE']))
+init_streaming(app, predict_malaria, admission, window=app.config['STREAM_WINDOW'],
+               workers=app.config['STREAM_WORKERS'], max_message_size=app.config['MAX_CONTENT_LENGTH'],
+               max_buffered=app.config['STREAM_MAX_BUFFERED'])
+
+# Load in the background so /ready can answer while the model warms up
+threading.Thread(target=start_model, name='model-startup', daemon=True).start()
 
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0', port=5001) 
\ No newline at end of file
+    # Production server (waitress); FLASK_DEBUG=1 for the reloading dev server.
+    # For several worker processes use serve.py.
+    from serve import run
+    run(app) 
\ No newline at end of file
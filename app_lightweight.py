@@ -1,16 +1,29 @@
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, render_template, request, jsonify, send_file, url_for, abort
 import os
-import numpy as np
-from PIL import Image
 import base64
-import random
+import io
+
+from backends import StubBackend
+from cascade import FirstStage
+from inference import interpret_probability
+from ingest import sniff_image
+from preprocessing import preprocess_image
+from responses import NotAcceptable, negotiate, render, wants_image
+from sample_gallery import SampleGallery
 
 app = Flask(__name__)
-app.config['UPLOAD_FOLDER'] = 'uploads'
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024
 
-# Create uploads directory if it doesn't exist
-os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+# Sample gallery: built once, rebuilt only when cell_images/ changes
+app.config['SAMPLE_CACHE_MAX_AGE'] = 365 * 24 * 3600
+gallery = SampleGallery()
+
+# Stand-in model: a trained cascade first stage when CASCADE_MODEL points at one (see
+# cascade.py), else the stub: same answer for the same image, cost set by STUB_COST_MS / STUB_PER_IMAGE_MS
+if os.environ.get('CASCADE_MODEL'):
+    stub_model = FirstStage.load(os.environ['CASCADE_MODEL'])
+else:
+    stub_model = StubBackend()
 
 # Allowed file extensions
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'bmp'}
@@ -18,59 +31,16 @@ ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'bmp'}
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def preprocess_image(image_path, target_size=(224, 224)):
-    """Preprocess image for model prediction"""
+def mock_predict_malaria(image):
+    """Demonstration prediction from the stub model or the cascade first stage"""
     try:
-        img = Image.open(image_path)
-        img = img.resize(target_size)
-        
-        if img.mode != 'RGB':
-            img = img.convert('RGB')
-        
-        img_array = np.array(img)
-        img_array = img_array / 255.0
-        img_array = np.expand_dims(img_array, axis=0)
-        
-        return img_array
-    except Exception as e:
-        print(f"Error preprocessing image: {e}")
-        return None
-
-def mock_predict_malaria(image_path):
-    """Mock prediction for demonstration (replace with actual model)"""
-    try:
-        # Simulate processing time
-        import time
-        time.sleep(0.5)
-        
-        # Generate realistic-looking prediction based on image characteristics
-        processed_img = preprocess_image(image_path)
+        processed_img = preprocess_image(image)
         if processed_img is None:
             return {"error": "Failed to process image"}
         
-        # Simple heuristic: check image brightness and contrast
-        img_array = processed_img[0]
-        brightness = np.mean(img_array)
-        contrast = np.std(img_array)
-        
-        # Simple rule-based prediction (replace with actual model)
-        if brightness < 0.4 and contrast > 0.15:
-            # Darker images with high contrast might be parasitized
-            probability = random.uniform(0.6, 0.9)
-            result = "Parasitized (Malaria Positive)"
-            confidence = probability
-        else:
-            # Brighter images might be uninfected
-            probability = random.uniform(0.1, 0.4)
-            result = "Uninfected (Malaria Negative)"
-            confidence = 1 - probability
-        
-        return {
-            "result": result,
-            "confidence": round(confidence * 100, 2),
-            "probability": round(probability * 100, 2),
-            "note": "This is a demonstration prediction. Replace with actual model for production."
-        }
+        result = interpret_probability(float(stub_model.predict_batch(processed_img)[0]))
+        result["note"] = "This is a demonstration prediction. Replace with actual model for production."
+        return result
         
     except Exception as e:
         return {"error": f"Prediction error: {str(e)}"}
@@ -79,113 +49,105 @@ def mock_predict_malaria(image_path):
 def index():
     return render_template('index.html')
 
+@app.errorhandler(NotAcceptable)
+def not_acceptable(error):
+    return jsonify({'error': error.message}), error.status
+
 @app.route('/upload', methods=['POST'])
 def upload_file():
+    mimetype = negotiate(request)
     if 'file' not in request.files:
-        return jsonify({'error': 'No file part'})
+        return render({'error': 'No file part'}, mimetype)
     
     file = request.files['file']
     if file.filename == '':
-        return jsonify({'error': 'No selected file'})
+        return render({'error': 'No selected file'}, mimetype)
     
     if file and allowed_file(file.filename):
-        filename = secure_filename(file.filename)
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(filepath)
+        # Read the upload once; the same bytes feed the model and the echoed image
+        image_bytes = file.read()
         
         # Make prediction
-        result = mock_predict_malaria(filepath)
-        
-        # Convert image to base64 for display
-        try:
-            with open(filepath, 'rb') as img_file:
-                img_data = base64.b64encode(img_file.read()).decode('utf-8')
-                result['image_data'] = f"data:image/png;base64,{img_data}"
-        except:
-            result['image_data'] = None
+        result = mock_predict_malaria(io.BytesIO(image_bytes))
         
-        # Clean up uploaded file
-        try:
-            os.remove(filepath)
-        except:
-            pass
+        # Convert image to base64 for display; machine clients skip the echo
+        if wants_image(mimetype):
+            img_data = base64.b64encode(image_bytes).decode('utf-8')
+            result['image_data'] = f"data:{sniff_image(image_bytes[:16]) or 'image/png'};base64,{img_data}"
         
-        return jsonify(result)
+        return render(result, mimetype)
     
-    return jsonify({'error': 'Invalid file type'})
+    return render({'error': 'Invalid file type'}, mimetype)
 
 @app.route('/sample_images')
 def get_sample_images():
-    """Get sample images from cell_images directory"""
-    sample_images = []
+    """Get the sample gallery index; thumbnails are fetched separately"""
+    sample_images = [{
+        'id': sample['id'],
+        'filename': sample['filename'],
+        'type': sample['type'],
+        'thumbnail_url': url_for('sample_thumbnail', sample_id=sample['id']),
+        'image_url': url_for('sample_image', sample_id=sample['id']),
+    } for sample in gallery.samples()]
     
-    parasitized_dir = 'cell_images/Parasitized'
-    uninfected_dir = 'cell_images/Uninfected'
-    
-    try:
-        # Get 5 sample parasitized images
-        if os.path.exists(parasitized_dir):
-            parasitized_files = [f for f in os.listdir(parasitized_dir) if f.endswith('.png')][:5]
-            for filename in parasitized_files:
-                filepath = os.path.join(parasitized_dir, filename)
-                with open(filepath, 'rb') as img_file:
-                    img_data = base64.b64encode(img_file.read()).decode('utf-8')
-                    sample_images.append({
-                        'filename': filename,
-                        'data': f"data:image/png;base64,{img_data}",
-                        'type': 'Parasitized'
-                    })
-        
-        # Get 5 sample uninfected images
-        if os.path.exists(uninfected_dir):
-            uninfected_files = [f for f in os.listdir(uninfected_dir) if f.endswith('.png')][:5]
-            for filename in uninfected_files:
-                filepath = os.path.join(uninfected_dir, filename)
-                with open(filepath, 'rb') as img_file:
-                    img_data = base64.b64encode(img_file.read()).decode('utf-8')
-                    sample_images.append({
-                        'filename': filename,
-                        'data': f"data:image/png;base64,{img_data}",
-                        'type': 'Uninfected'
-                    })
-    except Exception as e:
-        print(f"Error loading sample images: {e}")
-    
-    return jsonify(sample_images)
+    response = jsonify(sample_images)
+    response.cache_control.public = True
+    response.cache_control.max_age = 60
+    response.add_etag()
+    return response.make_conditional(request)
+
+@app.route('/sample_images/<sample_id>/thumbnail')
+def sample_thumbnail(sample_id):
+    """Serve a cached sample thumbnail (IDs change with the file, so cache forever)"""
+    if gallery.get(sample_id) is None:
+        abort(404)
+    return send_file(gallery.thumbnail_path(sample_id), max_age=app.config['SAMPLE_CACHE_MAX_AGE'])
+
+@app.route('/sample_images/<sample_id>/image')
+def sample_image(sample_id):
+    """Serve the full-size sample image"""
+    sample = gallery.get(sample_id)
+    if sample is None:
+        abort(404)
+    return send_file(os.path.abspath(sample['path']), max_age=app.config['SAMPLE_CACHE_MAX_AGE'])
 
 @app.route('/predict_sample', methods=['POST'])
 def predict_sample():
     """Predict malaria from a sample image"""
+    mimetype = negotiate(request)
     data = request.get_json()
+    
+    # Gallery samples are referenced by ID and their predictions are precomputed
+    sample_id = data.get('sample_id')
+    if sample_id:
+        result = gallery.prediction(sample_id, stub_model.name, mock_predict_malaria)
+        if result is None:
+            return render({'error': 'Unknown sample'}, mimetype)
+        if wants_image(mimetype):
+            result['image_data'] = url_for('sample_image', sample_id=sample_id)
+        return render(result, mimetype)
+    
     image_data = data.get('image_data')
     
     if not image_data:
-        return jsonify({'error': 'No image data provided'})
+        return render({'error': 'No image data provided'}, mimetype)
     
     try:
         # Decode base64 image
         image_data = image_data.split(',')[1]
         image_bytes = base64.b64decode(image_data)
         
-        # Save temporarily
-        temp_path = os.path.join(app.config['UPLOAD_FOLDER'], 'temp_sample.png')
-        with open(temp_path, 'wb') as f:
-            f.write(image_bytes)
-        
-        # Make prediction
-        result = mock_predict_malaria(temp_path)
-        result['image_data'] = data.get('image_data')
-        
-        # Clean up
-        try:
-            os.remove(temp_path)
-        except:
-            pass
+        # Make prediction straight from the decoded bytes
+        result = mock_predict_malaria(io.BytesIO(image_bytes))
+        if wants_image(mimetype):
+            result['image_data'] = data.get('image_data')  # Return original image data
         
-        return jsonify(result)
+        return render(result, mimetype)
         
     except Exception as e:
-        return jsonify({'error': f'Error processing sample image: {str(e)}'})
+        return render({'error': f'Error processing sample image: {str(e)}'}, mimetype)
 
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0', port=5001) 
\ No newline at end of file
+    # Production server (waitress); FLASK_DEBUG=1 for the reloading dev server
+    from serve import run
+    run(app)
@@ -0,0 +1,284 @@
+"""
+Pluggable inference backends for the Malaria Detection System.
+
+Every backend exposes the same small interface, so the batcher, the model
+server and the bulk tools do not care which one is running:
+
+    backend.name           short identifier, part of the model version
+    backend.input_dtype    dtype of the (N, 224, 224, 3) batches it expects
+    backend.predict_batch  batch -> one probability per image
+
+Available backends (MODEL_BACKEND):
+
+    keras           the original Keras model
+    xla             the model traced into an XLA-compiled tf.function
+    tflite-dynamic  TFLite model with dynamic-range quantized weights
+    tflite-int8     TFLite model with full-integer quantization
+    stub            deterministic stand-in with a configurable cost, for load tests
+
+The exported artifacts are produced by export_models.py. Extra models for
+an ensemble (see ensemble.py) are loaded with load_ensemble_member.
+
+Image decoding and the model share the machine's cores: ``thread_budget``
+splits them between the decode pool and the model's own op threads, which
+``load_backend`` applies before the model is loaded.
+"""
+
+import hashlib
+import os
+import threading
+import time
+
+import numpy as np
+
+from inference import model_probabilities, output_probabilities
+from model_registry import CACHE_DIR, INPUT_SHAPE, load_model, model_version
+
+EXPORT_DIR = os.environ.get('MODEL_EXPORT_DIR', 'exports')
+EXPORT_PATHS = {
+    'xla': 'xla',
+    'tflite-dynamic': 'model_dynamic.tflite',
+    'tflite-int8': 'model_int8.tflite',
+}
+BACKENDS = ('keras', 'xla', 'tflite-dynamic', 'tflite-int8', 'stub')
+
+
+class KerasBackend:
+    """Run the Keras (or TFSMLayer / cached serving function) model directly"""
+
+    name = 'keras'
+
+    def __init__(self, model, uint8_input=False):
+        self.raw_model = model
+        self.input_dtype = np.float32
+        if uint8_input and hasattr(model, 'predict_on_batch'):
+            from preprocessing import fold_normalization
+            model = fold_normalization(model)
+            self.input_dtype = np.uint8
+        self.model = model
+
+    def predict_batch(self, batch):
+        return model_probabilities(self.model, batch)
+
+
+class TFFunctionBackend:
+    """Run the model as a frozen, XLA-compiled tf.function
+
+    Uses the SavedModel written by ``export_models.py --formats xla`` when it
+    exists, otherwise traces the Keras model in-process.
+    """
+
+    name = 'xla'
+
+    def __init__(self, model=None, export_dir=None, jit_compile=True):
+        import tensorflow as tf
+
+        self.input_dtype = np.float32
+        if export_dir and os.path.exists(export_dir):
+            self._loaded = tf.saved_model.load(export_dir)
+            self._fn = self._loaded.serve
+        else:
+            self._fn = tf.function(
+                lambda batch: model(batch, training=False),
+                input_signature=[tf.TensorSpec((None,) + INPUT_SHAPE, tf.float32)],
+                jit_compile=jit_compile,
+            )
+
+    def predict_batch(self, batch):
+        prediction = self._fn(np.asarray(batch, dtype=np.float32))
+        if isinstance(prediction, dict):
+            prediction = list(prediction.values())[0]
+        return output_probabilities(prediction.numpy())
+
+
+class TFLiteBackend:
+    """Run a (possibly quantized) TFLite model
+
+    Uses the small ``tflite_runtime`` package when installed, so a replica
+    does not need full TensorFlow. Quantized inputs and outputs are
+    converted with the scale and zero point stored in the model.
+    """
+
+    def __init__(self, model_path, name='tflite', num_threads=None):
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            import tensorflow as tf
+            Interpreter = tf.lite.Interpreter
+
+        self.name = name
+        self.model_path = model_path
+        self.input_dtype = np.float32
+        self._interpreter = Interpreter(model_path=model_path, num_threads=num_threads)
+        self._interpreter.allocate_tensors()
+        self._input = self._interpreter.get_input_details()[0]
+        self._output = self._interpreter.get_output_details()[0]
+        self._batch_size = int(self._input['shape'][0])
+        # An interpreter is not thread-safe; the batcher is normally its only caller
+        self._lock = threading.Lock()
+
+    def _resize(self, batch_size):
+        self._interpreter.resize_tensor_input(self._input['index'], (batch_size,) + INPUT_SHAPE)
+        self._interpreter.allocate_tensors()
+        self._input = self._interpreter.get_input_details()[0]
+        self._output = self._interpreter.get_output_details()[0]
+        self._batch_size = batch_size
+
+    def predict_batch(self, batch):
+        batch = np.asarray(batch)
+        with self._lock:
+            if len(batch) != self._batch_size:
+                self._resize(len(batch))
+
+            input_type = self._input['dtype']
+            if input_type in (np.int8, np.uint8):
+                scale, zero_point = self._input['quantization']
+                info = np.iinfo(input_type)
+                batch = np.clip(np.round(batch / scale + zero_point), info.min, info.max).astype(input_type)
+            else:
+                batch = batch.astype(input_type, copy=False)
+
+            self._interpreter.set_tensor(self._input['index'], batch)
+            self._interpreter.invoke()
+            prediction = self._interpreter.get_tensor(self._output['index'])
+
+            if self._output['dtype'] in (np.int8, np.uint8):
+                scale, zero_point = self._output['quantization']
+                prediction = (prediction.astype(np.float32) - zero_point) * scale
+
+        return output_probabilities(prediction)
+
+
+class StubBackend:
+    """Deterministic stand-in for the model, for load tests and the demo app
+
+    The probability is a fixed function of image brightness and contrast, so
+    the same image always gets the same answer. Each batch costs
+    ``cost_ms + per_image_ms * N``: slept by default (like a model op that
+    releases the GIL) or busy-waited with ``mode='spin'`` to load a core.
+    """
+
+    name = 'stub'
+
+    def __init__(self, cost_ms=None, per_image_ms=None, mode=None, input_dtype=np.float32):
+        self.cost_ms = float(os.environ.get('STUB_COST_MS', 20) if cost_ms is None else cost_ms)
+        self.per_image_ms = float(os.environ.get('STUB_PER_IMAGE_MS', 2) if per_image_ms is None else per_image_ms)
+        self.mode = mode or os.environ.get('STUB_COST_MODE', 'sleep')
+        if self.mode not in ('sleep', 'spin'):
+            raise ValueError(f"Unknown stub cost mode {self.mode!r} (choose from: sleep, spin)")
+        self.input_dtype = input_dtype
+
+    def predict_batch(self, batch):
+        batch = np.asarray(batch)
+        deadline = time.perf_counter() + (self.cost_ms + self.per_image_ms * len(batch)) / 1000
+
+        pixels = batch.reshape(len(batch), -1)
+        scale = 1 / 255 if batch.dtype == np.uint8 else 1.0
+        brightness = pixels.mean(axis=1) * scale
+        contrast = pixels.std(axis=1) * scale
+        # Dark, high-contrast (stained) cells lean towards Parasitized, i.e. a low probability
+        probabilities = 1 / (1 + np.exp(-(12 * (brightness - 0.4) - 8 * (contrast - 0.15))))
+
+        if self.mode == 'spin':
+            while time.perf_counter() < deadline:
+                pass
+        else:
+            remaining = deadline - time.perf_counter()
+            if remaining > 0:
+                time.sleep(remaining)
+        return probabilities.astype(np.float32)
+
+
+def thread_budget(decode_workers=None, intra_op_threads=None, inter_op_threads=None, cpu_count=None):
+    """Split the cores between image decoding and the model's op threads
+
+    Returns ``(decode_workers, intra_op_threads, inter_op_threads)``. By
+    default a quarter of the cores decode and the rest run the ops of one
+    forward pass; the batcher only runs one pass at a time, so a single
+    inter-op thread is enough.
+    """
+    cores = cpu_count or os.cpu_count() or 1
+    decode_workers = decode_workers or max(1, cores // 4)
+    intra_op_threads = intra_op_threads or max(1, cores - decode_workers)
+    inter_op_threads = inter_op_threads or 1
+    return decode_workers, intra_op_threads, inter_op_threads
+
+
+def configure_tensorflow_threads(intra_op_threads=None, inter_op_threads=None):
+    """Set TensorFlow's thread pools; must run before TensorFlow executes anything"""
+    import tensorflow as tf
+
+    try:
+        if intra_op_threads:
+            tf.config.threading.set_intra_op_parallelism_threads(intra_op_threads)
+        if inter_op_threads:
+            tf.config.threading.set_inter_op_parallelism_threads(inter_op_threads)
+    except RuntimeError as e:
+        # The runtime is already initialized (e.g. an ensemble member loaded second)
+        print(f"TensorFlow threads already fixed, keeping them: {e}")
+
+
+def export_path(name, export_dir=EXPORT_DIR):
+    """Where export_models.py writes the artifact for a backend"""
+    return os.path.join(export_dir, EXPORT_PATHS[name])
+
+
+def load_backend(name='keras', uint8_input=False, export_dir=EXPORT_DIR, num_threads=None, inter_op_threads=None):
+    """Load a backend by name and return it with a description of what was loaded
+
+    ``num_threads`` caps the threads of one forward pass (TFLite threads, or
+    TensorFlow's intra-op pool) and ``inter_op_threads`` TensorFlow's
+    inter-op pool; None leaves the runtime's default of one per core.
+    """
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown backend {name!r} (choose from: {', '.join(BACKENDS)})")
+
+    started = time.perf_counter()
+    if name == 'stub':
+        backend = StubBackend(input_dtype=np.uint8 if uint8_input else np.float32)
+        info = {'loader': 'stub', 'model_version': 'stub'}
+    elif name.startswith('tflite'):
+        path = export_path(name, export_dir)
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"{path} not found; run: python export_models.py --formats {name[7:]}")
+        backend = TFLiteBackend(path, name=name, num_threads=num_threads)
+        stat = os.stat(path)
+        info = {'loader': name, 'model_version': f'{name}-{stat.st_size}-{stat.st_mtime_ns}'}
+    else:
+        if num_threads or inter_op_threads:
+            configure_tensorflow_threads(num_threads, inter_op_threads)
+        path = export_path('xla', export_dir)
+        if name == 'xla' and os.path.exists(path):
+            backend = TFFunctionBackend(export_dir=path)
+            stat = os.stat(path)
+            info = {'loader': 'xla-export', 'model_version': f'xla-{stat.st_mtime_ns}'}
+        else:
+            # XLA traces the Keras model itself, so it cannot start from the serving cache
+            model, record = load_model(use_serving_cache=False if name == 'xla' else None)
+            info = {'loader': record['loader'], 'model_version': model_version(record), 'record': record}
+            backend = TFFunctionBackend(model) if name == 'xla' else KerasBackend(model, uint8_input)
+            if name == 'xla':
+                info['model_version'] += '-xla'
+
+    info['backend'] = name
+    info['threads'] = {'intra_op': num_threads, 'inter_op': inter_op_threads}
+    info['load_seconds'] = round(time.perf_counter() - started, 3)
+    print(f"Backend {name} loaded in {info['load_seconds']}s")
+    return backend, info
+
+
+def load_ensemble_member(spec, uint8_input=False, export_dir=EXPORT_DIR, cache_dir=CACHE_DIR):
+    """Load one extra ensemble model: a backend name, or the path of another model artifact
+
+    Other artifacts get a registry of their own under ``cache_dir``, so they
+    never replace the primary model's record or serving cache.
+    """
+    if spec in BACKENDS:
+        return load_backend(spec, uint8_input=uint8_input, export_dir=export_dir)
+
+    started = time.perf_counter()
+    member_cache = os.path.join(cache_dir, 'ensemble', hashlib.sha256(os.path.abspath(spec).encode()).hexdigest()[:12])
+    model, record = load_model(candidates=[spec], cache_dir=member_cache, use_serving_cache=False)
+    info = {'loader': record['loader'], 'model_version': model_version(record), 'record': record,
+            'backend': 'keras', 'load_seconds': round(time.perf_counter() - started, 3)}
+    return KerasBackend(model, uint8_input), info
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+Offline bulk prediction for whole slide folders.
+
+Walks a directory tree such as cell_images/, runs every image through the
+model with decoding, batching and inference overlapping, and writes one
+row per image to CSV (or Parquet when the output ends in .parquet and
+pandas with a Parquet engine is installed).
+
+Usage:
+    python batch_predict.py cell_images --output predictions.csv
+"""
+
+import csv
+import os
+import time
+
+import numpy as np
+
+from inference import interpret_probability
+from pipeline import iter_batch_predictions, iter_image_files
+
+FIELDS = ['path', 'folder', 'result', 'probability', 'confidence', 'error']
+
+
+def predict_folder(root, predict_batch, batch_size=32, decode_workers=None, input_dtype=np.float32):
+    """Yield one result row per image under root"""
+    files = list(iter_image_files(root))
+    for relpath, probability, error in iter_batch_predictions(
+            ((relpath, path) for relpath, path in files), predict_batch,
+            batch_size=batch_size, decode_workers=decode_workers, input_dtype=input_dtype):
+        row = {'path': relpath, 'folder': os.path.dirname(relpath), 'result': None,
+               'probability': None, 'confidence': None, 'error': error}
+        if error is None:
+            row.update(interpret_probability(probability))
+        yield row
+
+
+def write_csv(rows, output):
+    """Write rows to a CSV file as they arrive and return how many were written"""
+    count = 0
+    with open(output, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=FIELDS)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+    return count
+
+
+def write_parquet(rows, output):
+    """Write rows to a Parquet file and return how many were written"""
+    try:
+        import pandas as pd
+    except ImportError:
+        raise SystemExit("❌ Writing Parquet needs pandas and pyarrow: pip install pandas pyarrow")
+
+    frame = pd.DataFrame(list(rows), columns=FIELDS)
+    frame.to_parquet(output, index=False)
+    return len(frame)
+
+
+def main():
+    import argparse
+
+    from backends import BACKENDS, load_backend
+
+    parser = argparse.ArgumentParser(description='Predict every image in a directory tree')
+    parser.add_argument('root', nargs='?', default='cell_images', help='Directory to walk')
+    parser.add_argument('--output', '-o', default='predictions.csv', help='Output .csv or .parquet file')
+    parser.add_argument('--batch-size', type=int, default=32, help='Images per forward pass')
+    parser.add_argument('--backend', choices=BACKENDS, default=os.environ.get('MODEL_BACKEND', 'keras'),
+                        help='Inference backend (see backends.py)')
+    parser.add_argument('--workers', type=int, default=None, help='Decode threads (default: cores + 4)')
+
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.root):
+        raise SystemExit(f"❌ Directory not found: {args.root}")
+
+    backend, _ = load_backend(args.backend)
+
+    started = time.perf_counter()
+    rows = predict_folder(args.root, backend.predict_batch, batch_size=args.batch_size,
+                          decode_workers=args.workers, input_dtype=backend.input_dtype)
+    if args.output.endswith('.parquet'):
+        count = write_parquet(rows, args.output)
+    else:
+        count = write_csv(rows, args.output)
+    elapsed = time.perf_counter() - started
+
+    print(f"✅ Wrote {count} predictions to {args.output} "
+          f"in {elapsed:.1f}s ({count / elapsed if elapsed else 0:.1f} images/s)")
+
+
+if __name__ == "__main__":
+    main()
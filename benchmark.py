@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+"""
+Reproducible inference benchmark for the Malaria Detection System.
+
+Measures, per backend:
+    cold start       model load + first prediction in a fresh process
+    preprocessing    decode/resize throughput in images/s
+    inference        p50/p95/p99 latency and images/s per batch size
+    memory           peak RSS of a fresh process that loads the backend and
+                     runs the largest batch
+
+Images come from cell_images/ (or a packed dataset, see packed_dataset.py)
+when present, otherwise from a fixed set of synthetic PNGs, so two runs on
+the same machine measure the same work.
+Results are written as JSON; with --baseline they are compared against an
+earlier run and the command exits with status 1 if anything regressed
+beyond --tolerance.
+
+Usage:
+    python benchmark.py --output bench.json
+    python benchmark.py --backends keras,tflite-int8 --baseline benchmarks/baseline.json
+    python benchmark.py --data cell_images.packed
+    python benchmark.py --save-baseline benchmarks/baseline.json
+"""
+
+import io
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+import numpy as np
+from PIL import Image
+
+from packed_dataset import PackedDataset, is_packed
+from pipeline import iter_image_files
+from preprocessing import preprocess_batch
+
+SEED = 1234
+
+# Metrics where a higher value is better; everything else is a time or a size
+HIGHER_IS_BETTER = ('images_per_second',)
+# Descriptive numbers that are not performance
+NOT_COMPARED = ('.images',)
+
+
+def sample_images(root='cell_images', count=256, seed=SEED):
+    """Return ``count`` images: a fixed sample of root, or synthetic PNGs
+
+    Images from a tree are encoded bytes. From a packed dataset they are
+    (224, 224, 3) uint8 views of the memory map, so preprocessing measures
+    what a packed reader pays instead of decoding.
+    """
+    if is_packed(root):
+        dataset = PackedDataset(root)
+        rng = np.random.default_rng(seed)
+        picks = rng.choice(len(dataset), size=min(count, len(dataset)), replace=False)
+        return [dataset[int(index)] for index in sorted(picks)], 'packed'
+
+    files = [path for _, path in iter_image_files(root)] if os.path.isdir(root) else []
+    if files:
+        rng = np.random.default_rng(seed)
+        picks = rng.choice(len(files), size=min(count, len(files)), replace=False)
+        images = []
+        for index in sorted(picks):
+            with open(files[index], 'rb') as f:
+                images.append(f.read())
+        return images, 'cell_images'
+
+    # Cell images are roughly 130x130; vary the size so resizing is exercised
+    rng = np.random.default_rng(seed)
+    images = []
+    for _ in range(count):
+        size = int(rng.integers(100, 160))
+        pixels = rng.integers(0, 256, (size, size, 3), dtype=np.uint8)
+        buffer = io.BytesIO()
+        Image.fromarray(pixels).save(buffer, format='PNG')
+        images.append(buffer.getvalue())
+    return images, 'synthetic'
+
+
+def _source(image):
+    # Encoded bytes need a file object; packed arrays are used as they are
+    return io.BytesIO(image) if isinstance(image, bytes) else image
+
+
+def percentiles(samples_ms):
+    """p50/p95/p99 of a list of millisecond timings"""
+    return {f'p{q}_ms': round(float(np.percentile(samples_ms, q)), 3) for q in (50, 95, 99)}
+
+
+def peak_rss_mb():
+    # ru_maxrss is the high-water mark of the whole process lifetime, so it only
+    # describes one backend in a process that loaded nothing else.
+    # It is KB on Linux and bytes on macOS.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def bench_preprocessing(images, repeats=3, dtype=np.float32):
+    """Decode/resize throughput over the sample images"""
+    best = float('inf')
+    for _ in range(repeats):
+        started = time.perf_counter()
+        preprocess_batch([_source(image) for image in images], dtype=dtype)
+        best = min(best, time.perf_counter() - started)
+    return {'images': len(images), 'seconds': round(best, 4),
+            'images_per_second': round(len(images) / best, 1)}
+
+
+def bench_inference(predict_batch, batch, batch_sizes=(1, 8, 32), iterations=30, warmup=3):
+    """Latency percentiles and throughput of predict_batch at each batch size"""
+    results = {}
+    for size in batch_sizes:
+        inputs = np.ascontiguousarray(np.resize(batch, (size,) + batch.shape[1:]))
+        for _ in range(warmup):
+            predict_batch(inputs)
+        timings = []
+        for _ in range(iterations):
+            started = time.perf_counter()
+            predict_batch(inputs)
+            timings.append((time.perf_counter() - started) * 1000)
+        stats = percentiles(timings)
+        stats['images_per_second'] = round(size * 1000 / float(np.mean(timings)), 1)
+        results[str(size)] = stats
+    return results
+
+
+def cold_start(backend, batch_size=1):
+    """Load the backend and run one prediction in a fresh interpreter
+
+    The child then runs one pass of ``batch_size`` images and reports its
+    own peak RSS, the memory footprint of this backend alone.
+    """
+    started = time.perf_counter()
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), '--cold-start-child', backend,
+                             '--batch-sizes', str(batch_size)],
+                            capture_output=True, text=True, check=True).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+    result['process_seconds'] = round(time.perf_counter() - started, 3)
+    return result
+
+
+def _cold_start_child(backend_name, batch_size=1):
+    from backends import load_backend
+
+    started = time.perf_counter()
+    backend, info = load_backend(backend_name)
+    loaded = time.perf_counter()
+    backend.predict_batch(np.zeros((1, 224, 224, 3), dtype=backend.input_dtype))
+    first = time.perf_counter()
+    if batch_size > 1:
+        backend.predict_batch(np.zeros((batch_size, 224, 224, 3), dtype=backend.input_dtype))
+    print(json.dumps({'load_seconds': round(loaded - started, 3),
+                      'first_prediction_seconds': round(first - loaded, 3),
+                      'model_version': info['model_version'],
+                      'peak_rss_mb': peak_rss_mb()}))
+
+
+def run(backends, images, batch_sizes, iterations, with_cold_start=True):
+    from backends import load_backend
+
+    report = {
+        'meta': {
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'cpu_count': os.cpu_count(),
+            'images': len(images),
+            'seed': SEED,
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        },
+        'preprocessing': {
+            'float32': bench_preprocessing(images),
+            'uint8': bench_preprocessing(images, dtype=np.uint8),
+        },
+        'backends': {},
+    }
+
+    for name in backends:
+        entry = {}
+        if with_cold_start:
+            try:
+                entry['cold_start'] = cold_start(name, max(batch_sizes))
+            except subprocess.CalledProcessError as e:
+                print(f"Skipping {name}: {e.stderr.strip().splitlines()[-1] if e.stderr else e}")
+                continue
+            # Measured in the fresh process; this one holds every backend loaded so far
+            entry['peak_rss_mb'] = entry['cold_start'].pop('peak_rss_mb')
+        try:
+            backend, info = load_backend(name)
+        except Exception as e:
+            print(f"Skipping {name}: {e}")
+            continue
+
+        batch = preprocess_batch([_source(image) for image in images[:max(batch_sizes)]],
+                                 dtype=backend.input_dtype)
+        entry['model_version'] = info['model_version']
+        entry['inference'] = bench_inference(backend.predict_batch, batch, batch_sizes, iterations)
+        report['backends'][name] = entry
+        del backend
+    return report
+
+
+def _flatten(report, prefix=''):
+    for key, value in report.items():
+        path = f'{prefix}.{key}' if prefix else key
+        if isinstance(value, dict):
+            yield from _flatten(value, path)
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield path, value
+
+
+def compare(report, baseline, tolerance=0.1):
+    """Return ``(metric, baseline, current, change)`` for every metric worse than tolerance"""
+    current = dict(_flatten({k: v for k, v in report.items() if k != 'meta'}))
+    regressions = []
+    for metric, before in _flatten({k: v for k, v in baseline.items() if k != 'meta'}):
+        after = current.get(metric)
+        if after is None or not before or metric.endswith(NOT_COMPARED):
+            continue
+        change = (after - before) / before
+        worse = -change if metric.endswith(HIGHER_IS_BETTER) else change
+        if worse > tolerance:
+            regressions.append((metric, before, after, round(change, 4)))
+    return regressions
+
+
+def main():
+    import argparse
+
+    from backends import BACKENDS
+
+    parser = argparse.ArgumentParser(description='Benchmark preprocessing and inference')
+    parser.add_argument('--backends', default='keras', help=f"Comma separated ({', '.join(BACKENDS)})")
+    parser.add_argument('--data', default='cell_images', help='Image tree or packed dataset to sample (synthetic if missing)')
+    parser.add_argument('--images', type=int, default=256, help='Number of sample images')
+    parser.add_argument('--batch-sizes', default='1,8,32', help='Comma separated batch sizes')
+    parser.add_argument('--iterations', type=int, default=30, help='Timed runs per batch size')
+    parser.add_argument('--no-cold-start', action='store_true',
+                        help='Skip the fresh-process load and peak memory measurement')
+    parser.add_argument('--output', '-o', default='bench.json', help='Where to write the results')
+    parser.add_argument('--baseline', help='Compare against this earlier result file')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='Allowed relative regression (0.1 = 10%%)')
+    parser.add_argument('--save-baseline', help='Also write the results here as the new baseline')
+    parser.add_argument('--cold-start-child', help=argparse.SUPPRESS)
+
+    args = parser.parse_args()
+
+    from model_registry import parse_batch_sizes
+
+    if args.cold_start_child:
+        _cold_start_child(args.cold_start_child, max(parse_batch_sizes(args.batch_sizes)))
+        return
+
+    images, source = sample_images(args.data, args.images)
+    print(f"Benchmarking with {len(images)} {source} images")
+
+    report = run([name for name in args.backends.split(',') if name], images,
+                 parse_batch_sizes(args.batch_sizes), args.iterations,
+                 with_cold_start=not args.no_cold_start)
+    report['meta']['source'] = source
+
+    for path in filter(None, (args.output, args.save_baseline)):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2)
+    print(f"✅ Results written to {args.output}")
+
+    for name, entry in report['backends'].items():
+        for size, stats in entry['inference'].items():
+            print(f"{name:<16} batch {size:>3}: p50 {stats['p50_ms']:>8} ms  p99 {stats['p99_ms']:>8} ms  "
+                  f"{stats['images_per_second']:>8} img/s")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.tolerance)
+        if regressions:
+            print(f"\n❌ {len(regressions)} regression(s) beyond {args.tolerance:.0%}:")
+            for metric, before, after, change in regressions:
+                print(f"   {metric}: {before} -> {after} ({change:+.1%})")
+            sys.exit(1)
+        print(f"\n✅ No regressions beyond {args.tolerance:.0%} against {args.baseline}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,470 @@
+#!/usr/bin/env python3
+"""
+Two-stage cascade: a cheap first-stage classifier in front of the full model.
+
+Most cells are clearly uninfected or clearly parasitized, and for those the
+full 224x224 network is overkill. The first stage reduces the image to
+56x56 and computes a handful of colour and darkness statistics of the cell
+(stained parasites are dark and purple). A logistic regression on these
+features answers when it is confident and forwards the rest to the full model.
+
+The classifier is trained with numpy alone and saved as a small JSON file.
+Its two confidence thresholds are chosen on held-out images, so that the
+answers it gives itself disagree with the reference at most ``max_error`` of
+the time. The reference is the labels, or the full model's decisions with
+``--teacher``.
+
+Usage:
+    python cascade.py train cell_images --teacher keras      # writes cascade_stage1.json
+    python cascade.py evaluate cell_images --backend keras   # routing rate and agreement
+    CASCADE_MODEL=cascade_stage1.json python app.py
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from model_registry import warmup
+from packed_dataset import PackedDataset, is_packed
+from pipeline import decode_source, iter_image_files
+
+DEFAULT_PATH = 'cascade_stage1.json'
+FORMAT_VERSION = 1
+POOL = 4                      # 224 / 4 = 56x56 working resolution
+FEATURES = (
+    'mean_r', 'mean_g', 'mean_b', 'std_r', 'std_g', 'std_b',
+    'luma_p1', 'luma_p5', 'luma_p50', 'dark_fraction', 'dark_depth',
+    'purple_p99', 'purple_fraction', 'cell_fraction',
+)
+
+_SCALE = np.float32(1.0 / 255.0)
+
+
+def _percentiles(values, counts, quantiles):
+    # values: (N, P) with the pixels outside the cell set to +inf
+    ordered = np.sort(values, axis=1)
+    index = np.floor(np.multiply.outer(np.maximum(counts - 1, 0), quantiles)).astype(np.int64)
+    return np.take_along_axis(ordered, index, axis=1).T
+
+
+def cheap_features(batch):
+    """(N, len(FEATURES)) statistics of each cell at a quarter of the resolution
+
+    Each 4x4 block is represented by the mean of four of its pixels, which is
+    several times cheaper than a full average and keeps parasite-sized
+    detail. The training crops have a black background, so only pixels
+    brighter than a small floor count as cell.
+    """
+    batch = np.asarray(batch)
+    n, h, w, _ = batch.shape
+    batch = batch[:, :h // POOL * POOL, :w // POOL * POOL]
+    taps = [batch[:, i::POOL, j::POOL] for i in (1, 3) for j in (1, 3)]
+    if batch.dtype == np.uint8:
+        small = taps[0].astype(np.uint16)
+        for tap in taps[1:]:
+            small += tap
+        small = small * np.float32(1 / (4 * 255))
+    else:
+        small = (taps[0] + taps[1] + taps[2] + taps[3]).astype(np.float32) * np.float32(0.25)
+    pixels = small.reshape(n, -1, 3)
+
+    luma = pixels @ np.array([0.299, 0.587, 0.114], dtype=np.float32)
+    cell = luma > 0.08
+    counts = cell.sum(axis=1)
+    safe_counts = np.maximum(counts, 1)
+    purple = (pixels[..., 0] + pixels[..., 2]) / 2 - pixels[..., 1]
+
+    mean = (pixels * cell[..., None]).sum(axis=1) / safe_counts[:, None]
+    std = np.sqrt(((pixels - mean[:, None]) ** 2 * cell[..., None]).sum(axis=1) / safe_counts[:, None])
+    p1, p5, p50 = _percentiles(np.where(cell, luma, np.inf), counts, [0.01, 0.05, 0.5])
+    dark = cell & (luma < (p50 - 0.15)[:, None])
+    dark_count = dark.sum(axis=1)
+    dark_depth = np.where(dark, p50[:, None] - luma, 0).sum(axis=1) / np.maximum(dark_count, 1)
+    purple_p99, = _percentiles(np.where(cell, purple, np.inf), counts, [0.99])
+
+    features = np.column_stack([
+        mean, std, p1, p5, p50,
+        dark_count / safe_counts, dark_depth,
+        purple_p99, (cell & (purple > 0.1)).sum(axis=1) / safe_counts,
+        counts / cell.shape[1],
+    ])
+    # Blank images have no cell statistics
+    features[counts == 0] = 0
+    return features.astype(np.float32)
+
+
+def fit_logistic(x, y, l2=1e-2, iterations=25):
+    """L2-regularised logistic regression by Newton's method; returns (weights, bias)"""
+    x = np.column_stack([x, np.ones(len(x))]).astype(np.float64)
+    weights = np.zeros(x.shape[1])
+    penalty = l2 * np.eye(x.shape[1])
+    penalty[-1, -1] = 0
+    for _ in range(iterations):
+        p = 1 / (1 + np.exp(-(x @ weights)))
+        gradient = x.T @ (p - y) + penalty @ weights
+        hessian = (x * (p * (1 - p))[:, None]).T @ x + penalty
+        step = np.linalg.solve(hessian, gradient)
+        weights -= step
+        if np.abs(step).max() < 1e-6:
+            break
+    return weights[:-1], weights[-1]
+
+
+def choose_thresholds(probabilities, targets, max_error=0.005, min_support=20):
+    """Loosest thresholds whose direct answers disagree with targets at most max_error
+
+    Returns ``(low, high)``: at or below ``low`` answer Parasitized, at or
+    above ``high`` answer Uninfected. A side that never reaches the error
+    target is switched off (``low=-1`` / ``high=2``).
+    """
+    order = np.argsort(probabilities)
+    p, t = probabilities[order], targets[order]
+
+    # Parasitized side: the k lowest probabilities, errors are Uninfected targets among them
+    errors = np.cumsum(t) / np.arange(1, len(t) + 1)
+    ok = np.flatnonzero((errors <= max_error) & (np.arange(1, len(t) + 1) >= min_support))
+    low = float(p[ok[-1]]) if len(ok) else -1.0
+
+    # Uninfected side: the k highest probabilities, errors are Parasitized targets among them
+    errors = np.cumsum(1 - t[::-1]) / np.arange(1, len(t) + 1)
+    ok = np.flatnonzero((errors <= max_error) & (np.arange(1, len(t) + 1) >= min_support))
+    high = float(p[::-1][ok[-1]]) if len(ok) else 2.0
+    return low, high
+
+
+class FirstStage:
+    """The trained first-stage classifier: standardised features -> P(Uninfected)"""
+
+    def __init__(self, mean, scale, weights, bias, low, high, metadata=None):
+        self.mean = np.asarray(mean, dtype=np.float32)
+        self.scale = np.asarray(scale, dtype=np.float32)
+        self.weights = np.asarray(weights, dtype=np.float32)
+        self.bias = float(bias)
+        self.low = float(low)
+        self.high = float(high)
+        self.metadata = metadata or {}
+
+    @classmethod
+    def train(cls, features, targets, max_error=0.005, validation=0.25, seed=0):
+        """Fit on part of the data and pick the thresholds on the held-out rest"""
+        rng = np.random.default_rng(seed)
+        order = rng.permutation(len(features))
+        held_out = order[:int(len(order) * validation)]
+        fit = order[len(held_out):]
+
+        mean = features[fit].mean(axis=0)
+        scale = features[fit].std(axis=0) + 1e-6
+        weights, bias = fit_logistic((features[fit] - mean) / scale, targets[fit])
+        stage = cls(mean, scale, weights, bias, -1.0, 2.0)
+
+        probabilities = stage.predict_batch_features(features[held_out])
+        stage.low, stage.high = choose_thresholds(probabilities, targets[held_out], max_error)
+        stage.metadata = {'trained_on': int(len(fit)), 'thresholds_from': int(len(held_out)),
+                          'max_error': max_error}
+        return stage
+
+    @classmethod
+    def load(cls, path=DEFAULT_PATH):
+        with open(path) as f:
+            data = json.load(f)
+        if data.get('version') != FORMAT_VERSION or data.get('features') != list(FEATURES):
+            raise ValueError(f"{path} was written by an incompatible version of cascade.py")
+        return cls(data['mean'], data['scale'], data['weights'], data['bias'], data['low'], data['high'],
+                   data.get('metadata'))
+
+    def to_dict(self):
+        return {
+            'version': FORMAT_VERSION,
+            'features': list(FEATURES),
+            'mean': self.mean.tolist(),
+            'scale': self.scale.tolist(),
+            'weights': self.weights.tolist(),
+            'bias': self.bias,
+            'low': self.low,
+            'high': self.high,
+            'metadata': self.metadata,
+        }
+
+    def save(self, path=DEFAULT_PATH):
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+        os.replace(path + '.tmp', path)
+
+    @property
+    def name(self):
+        return f'first-stage-{self.version}'
+
+    @property
+    def version(self):
+        """Short hash of the parameters, to keep cached predictions apart"""
+        return hashlib.sha256(json.dumps(self.to_dict(), sort_keys=True).encode('utf-8')).hexdigest()[:8]
+
+    def predict_batch_features(self, features):
+        z = ((features - self.mean) / self.scale) @ self.weights + self.bias
+        return 1 / (1 + np.exp(-np.clip(z, -30, 30)))
+
+    def predict_batch(self, batch):
+        return self.predict_batch_features(cheap_features(batch)).astype(np.float32)
+
+    def confident(self, probabilities):
+        """Mask of the probabilities the first stage answers itself"""
+        return (probabilities <= self.low) | (probabilities >= self.high)
+
+
+class CascadeBackend:
+    """Backend that answers confident images from the first stage and forwards the rest
+
+    The number of forwarded images changes from batch to batch. With
+    ``bucket_sizes`` they are padded up to the next of those sizes (and run
+    in chunks of the largest), so the full model only ever sees a few batch
+    shapes: a TFLite interpreter is not resized and XLA does not retrace on
+    every call.
+    """
+
+    def __init__(self, first_stage, full, bucket_sizes=()):
+        self.first_stage = first_stage
+        self.full = full
+        self.name = f'cascade+{full.name}'
+        self.input_dtype = full.input_dtype
+        self.bucket_sizes = tuple(sorted(set(bucket_sizes)))
+
+        self._lock = threading.Lock()
+        self._images = 0
+        self._forwarded = 0
+
+    def predict_batch(self, batch):
+        batch = np.asarray(batch)
+        probabilities = self.first_stage.predict_batch(batch)
+        forward = ~self.first_stage.confident(probabilities)
+        if forward.any():
+            probabilities[forward] = self._predict_full(batch[forward])
+
+        with self._lock:
+            self._images += len(batch)
+            self._forwarded += int(forward.sum())
+        return probabilities
+
+    def _predict_full(self, images):
+        if not self.bucket_sizes:
+            return self.full.predict_batch(images)
+        largest = self.bucket_sizes[-1]
+        outputs = []
+        for first in range(0, len(images), largest):
+            chunk = images[first:first + largest]
+            size = next(size for size in self.bucket_sizes if size >= len(chunk))
+            if size > len(chunk):
+                padded = np.zeros((size,) + chunk.shape[1:], dtype=chunk.dtype)
+                padded[:len(chunk)] = chunk
+                chunk = padded
+            outputs.append(np.asarray(self.full.predict_batch(chunk))[:min(largest, len(images) - first)])
+        return np.concatenate(outputs)
+
+    def stats(self):
+        """How many images reached the full model"""
+        with self._lock:
+            images, forwarded = self._images, self._forwarded
+        return {
+            'images': images,
+            'forwarded': forwarded,
+            'forwarded_rate': round(forwarded / images, 4) if images else 0.0,
+            'low': self.first_stage.low,
+            'high': self.first_stage.high,
+        }
+
+
+def with_cascade(backend, info, path, bucket_sizes=()):
+    """Put the first stage saved at path in front of a loaded backend
+
+    Forwarded images are padded to ``bucket_sizes`` (see CascadeBackend),
+    and the full model is warmed up at each of them here.
+    """
+    stage = FirstStage.load(path)
+    info = dict(info, backend=f"cascade+{info['backend']}",
+                model_version=f"{info['model_version']}-cascade-{stage.version}")
+    print(f"Cascade: first stage {path} answers below {stage.low:.3f} and above {stage.high:.3f}")
+    if bucket_sizes:
+        timings = warmup(backend.predict_batch, sorted(set(bucket_sizes)), backend.input_dtype)
+        print(f"Full model warmed up for the cascade (ms per batch size): {timings}")
+    return CascadeBackend(stage, backend, bucket_sizes), info
+
+
+def iter_labelled_batches(data, batch_size=64, limit=None, seed=0, workers=None, errors=None):
+    """Yield ``(uint8 pixels, labels)`` batches of a labelled tree or packed dataset; 1 = Uninfected
+
+    Images that fail to decode are left out of their batch and, when
+    ``errors`` is a list, appended to it as ``(path, message)``.
+    """
+    if is_packed(data):
+        dataset = PackedDataset(data)
+        uninfected = dataset.classes.index('Uninfected')
+        keep = np.flatnonzero(np.isin(dataset.labels, [dataset.classes.index(name) for name in
+                                                        ('Parasitized', 'Uninfected') if name in dataset.classes]))
+        if limit and limit < len(keep):
+            keep = np.sort(np.random.default_rng(seed).choice(keep, size=limit, replace=False))
+        for first in range(0, len(keep), batch_size):
+            indices = keep[first:first + batch_size]
+            yield dataset.take(indices), (dataset.labels[indices] == uninfected).astype(np.int64)
+        return
+
+    files = [(path, int(relpath.split(os.sep)[0] == 'Uninfected')) for relpath, path in iter_image_files(data)
+             if relpath.split(os.sep)[0] in ('Parasitized', 'Uninfected')]
+    if limit and limit < len(files):
+        picks = np.random.default_rng(seed).choice(len(files), size=limit, replace=False)
+        files = [files[i] for i in sorted(picks)]
+    chunks = [files[first:first + batch_size] for first in range(0, len(files), batch_size)]
+    with ThreadPoolExecutor(max_workers=workers or min(32, (os.cpu_count() or 1) + 4)) as pool:
+        def load(chunk):
+            pixels, labels, failed = [], [], []
+            for path, label in chunk:
+                try:
+                    pixels.append(decode_source(path, dtype=np.uint8))
+                except Exception as e:
+                    failed.append((path, str(e)))
+                    continue
+                labels.append(label)
+            return pixels, labels, failed
+
+        for pixels, labels, failed in pool.map(load, chunks):
+            if errors is not None:
+                errors.extend(failed)
+            if pixels:
+                yield np.stack(pixels), np.array(labels, dtype=np.int64)
+
+
+def _as_input(batch, dtype):
+    return batch if dtype == np.uint8 else np.multiply(batch, _SCALE, dtype=np.float32)
+
+
+def train(data, teacher=None, max_error=0.005, limit=None, seed=0):
+    """Compute features (and teacher decisions) over data and train a FirstStage"""
+    features, targets, errors = [], [], []
+    for pixels, labels in iter_labelled_batches(data, limit=limit, seed=seed, errors=errors):
+        features.append(cheap_features(pixels))
+        if teacher is None:
+            targets.append(labels)
+        else:
+            targets.append((teacher.predict_batch(_as_input(pixels, teacher.input_dtype)) > 0.5).astype(np.int64))
+    if errors:
+        print(f"Skipped {len(errors)} images that could not be decoded, e.g. {errors[0][0]}: {errors[0][1]}")
+    if not features:
+        raise ValueError(f"No Parasitized/Uninfected images found in {data}")
+    return FirstStage.train(np.concatenate(features), np.concatenate(targets), max_error, seed=seed)
+
+
+def evaluate(stage, full, data, limit=None, seed=0):
+    """Routing rate, agreement with the full model and cost of the cascade on labelled data"""
+    labels, first, reference, errors = [], [], [], []
+    first_seconds = full_seconds = 0.0
+    for pixels, batch_labels in iter_labelled_batches(data, limit=limit, seed=seed, errors=errors):
+        started = time.perf_counter()
+        first.append(stage.predict_batch(pixels))
+        first_seconds += time.perf_counter() - started
+
+        started = time.perf_counter()
+        reference.append(np.asarray(full.predict_batch(_as_input(pixels, full.input_dtype))))
+        full_seconds += time.perf_counter() - started
+        labels.append(batch_labels)
+
+    if not labels:
+        raise ValueError(f"No Parasitized/Uninfected images could be decoded in {data}")
+    labels, first, reference = np.concatenate(labels), np.concatenate(first), np.concatenate(reference)
+    answered = stage.confident(first)
+    cascade = np.where(answered, first, reference)
+
+    def accuracy(probabilities, mask=slice(None)):
+        return round(float(np.mean((probabilities[mask] > 0.5) == labels[mask])), 4) if len(labels[mask]) else None
+
+    count = len(labels)
+    forwarded_rate = 1 - answered.mean()
+    first_ms, full_ms = first_seconds / count * 1000, full_seconds / count * 1000
+    return {
+        'images': count,
+        'failed': len(errors),
+        'low': stage.low,
+        'high': stage.high,
+        'answered_by_first_stage': int(answered.sum()),
+        'forwarded_rate': round(float(forwarded_rate), 4),
+        'agreement_with_full': round(float(np.mean((cascade > 0.5) == (reference > 0.5))), 4),
+        'agreement_on_answered': round(float(np.mean((first[answered] > 0.5) == (reference[answered] > 0.5))), 4)
+        if answered.any() else None,
+        'accuracy_full': accuracy(reference),
+        'accuracy_cascade': accuracy(cascade),
+        'accuracy_first_stage_alone': accuracy(first),
+        'first_stage_ms_per_image': round(first_ms, 3),
+        'full_ms_per_image': round(full_ms, 3),
+        'cascade_ms_per_image': round(first_ms + forwarded_rate * full_ms, 3),
+        'speedup': round(full_ms / (first_ms + forwarded_rate * full_ms), 2) if full_ms else None,
+    }
+
+
+def main():
+    import argparse
+
+    from backends import BACKENDS, load_backend
+
+    parser = argparse.ArgumentParser(description='Train and evaluate the first stage of the cascade')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    train_parser = commands.add_parser('train', help='Train the first stage on labelled images')
+    train_parser.add_argument('data', nargs='?', default='cell_images', help='Labelled image tree or packed dataset')
+    train_parser.add_argument('--output', default=DEFAULT_PATH, help='Where to save the first stage')
+    train_parser.add_argument('--teacher', choices=BACKENDS,
+                              help='Learn the full model\'s decisions with this backend instead of the labels')
+    train_parser.add_argument('--max-error', type=float, default=0.005,
+                              help='Largest disagreement allowed on the images the first stage answers')
+    train_parser.add_argument('--limit', type=int, help='Train on a random subset of this many images')
+
+    evaluate_parser = commands.add_parser('evaluate', help='Measure routing rate and agreement with the full model')
+    evaluate_parser.add_argument('data', nargs='?', default='cell_images', help='Labelled image tree or packed dataset')
+    evaluate_parser.add_argument('--model', default=DEFAULT_PATH, help='First stage to evaluate')
+    evaluate_parser.add_argument('--backend', choices=BACKENDS, default=os.environ.get('MODEL_BACKEND', 'keras'))
+    evaluate_parser.add_argument('--limit', type=int, help='Evaluate a random subset of this many images')
+    evaluate_parser.add_argument('--seed', type=int, default=1, help='Seed for --limit')
+    evaluate_parser.add_argument('--json', help='Also write the report to this file')
+
+    args = parser.parse_args()
+    if not os.path.exists(args.data):
+        raise SystemExit(f"❌ Not found: {args.data}")
+
+    if args.command == 'train':
+        teacher = load_backend(args.teacher)[0] if args.teacher else None
+        started = time.perf_counter()
+        try:
+            stage = train(args.data, teacher, args.max_error, args.limit)
+        except ValueError as e:
+            raise SystemExit(f"❌ {e}")
+        stage.save(args.output)
+        print(f"✅ Saved {args.output} in {time.perf_counter() - started:.1f}s: answers Parasitized at or below "
+              f"{stage.low:.3f} and Uninfected at or above {stage.high:.3f}")
+        return
+
+    if not os.path.exists(args.model):
+        raise SystemExit(f"❌ {args.model} not found; run: python cascade.py train")
+    stage = FirstStage.load(args.model)
+    full, _ = load_backend(args.backend)
+    try:
+        report = evaluate(stage, full, args.data, args.limit, args.seed)
+    except ValueError as e:
+        raise SystemExit(f"❌ {e}")
+
+    print(f"{report['images']} images ({report['failed']} failed to decode): "
+          f"{report['answered_by_first_stage']} answered by the first stage, "
+          f"{report['forwarded_rate']:.1%} forwarded to {args.backend}")
+    print(f"Agreement with the full model: {report['agreement_with_full']} overall, "
+          f"{report['agreement_on_answered']} on first-stage answers")
+    print(f"Accuracy: full {report['accuracy_full']}, cascade {report['accuracy_cascade']}, "
+          f"first stage alone {report['accuracy_first_stage_alone']}")
+    print(f"ms/image: first stage {report['first_stage_ms_per_image']}, full {report['full_ms_per_image']}, "
+          f"cascade {report['cascade_ms_per_image']} ({report['speedup']}x)")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,28 +4,300 @@ Deployment setup script for Malaria Detection System
 This script helps set up the application for deployment without including the large model file.
 """
 
+import hashlib
+import http.client
+import json
 import os
-import requests
+import threading
+import time
+import urllib.request
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
-def download_model_from_url(url, filename="my_model.keras"):
+DEFAULT_MODEL = "my_model.keras"
+DEFAULT_MANIFEST = "model_manifest.json"
+DEFAULT_GDRIVE_ID = "16imA9-VPF45hMTKflJqSZxotdUSwKJwO"
+
+BUFFER_SIZE = 1 << 20          # bytes read per call
+MIN_SEGMENT = 16 << 20         # smallest range worth its own connection
+CONNECTIONS = 4
+RETRIES = 3
+SAVE_EVERY = 8 << 20           # persist resume state after this many new bytes
+
+
+class DownloadError(Exception):
+    """The model could not be downloaded or failed verification"""
+
+
+def gdrive_url(file_id):
+    # confirm=t skips the "can't scan this file for viruses" page Drive serves for large files
+    return f"https://drive.google.com/uc?export=download&confirm=t&id={file_id}"
+
+
+def load_manifest(path):
+    """Read the expected url, sha256, size and filename of the model from a JSON manifest"""
+    with open(path) as f:
+        manifest = json.load(f)
+    unknown = set(manifest) - {'url', 'sha256', 'size', 'filename'}
+    if unknown:
+        raise ValueError(f"{path}: unknown keys {', '.join(sorted(unknown))}")
+    return manifest
+
+
+def file_sha256(path):
+    """SHA-256 hex digest of a file, read in large blocks"""
+    digest = hashlib.sha256()
+    buffer = bytearray(4 * BUFFER_SIZE)
+    view = memoryview(buffer)
+    with open(path, 'rb', buffering=0) as f:
+        while True:
+            n = f.readinto(buffer)
+            if not n:
+                return digest.hexdigest()
+            digest.update(view[:n])
+
+
+def cached_sha256(path):
+    """SHA-256 of path, reusing the digest stored next to it while size and mtime are unchanged"""
+    sidecar = path + '.sha256.json'
+    stat = os.stat(path)
+    try:
+        with open(sidecar) as f:
+            record = json.load(f)
+        if record['size'] == stat.st_size and record['mtime_ns'] == stat.st_mtime_ns:
+            return record['sha256']
+    except (OSError, ValueError, KeyError):
+        pass
+    digest = file_sha256(path)
+    _write_json(sidecar, {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': digest})
+    return digest
+
+
+def _write_json(path, data):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(data, f)
+    os.replace(path + '.tmp', path)
+
+
+def probe(url, timeout=30):
+    """Return (final url, size, whether byte ranges are supported, ETag or Last-Modified)
+
+    Asks for the first byte only: a 206 answer proves range support and
+    carries the full size in Content-Range.
+    """
+    request = urllib.request.Request(url, headers={'Range': 'bytes=0-0'})
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        validator = response.headers.get('ETag') or response.headers.get('Last-Modified')
+        if response.status == 206:
+            total = response.headers.get('Content-Range', '').rsplit('/', 1)[-1]
+            if total.isdigit():
+                return response.geturl(), int(total), True, validator
+        length = response.headers.get('Content-Length')
+        return response.geturl(), int(length) if length else None, False, validator
+
+
+class _Progress:
+    """Thread-safe byte counter that persists resume state and prints every 10%"""
+
+    def __init__(self, state, state_path, fd, enabled=True):
+        self.state = state
+        self.state_path = state_path
+        self.fd = fd
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.unsaved = 0
+        self.reported = 0
+
+    def advance(self, segment, count):
+        with self.lock:
+            segment['done'] += count
+            self.unsaved += count
+            if self.unsaved >= SAVE_EVERY:
+                self.save()
+            # A server may report a size of 0; there is no percentage to print then
+            if self.enabled and self.state['size']:
+                done = sum(s['done'] for s in self.state['segments'])
+                decile = done * 10 // self.state['size']
+                if decile != self.reported:
+                    self.reported = decile
+                    print(f"  {done * 100 // self.state['size']:3d}% "
+                          f"({done / 1e6:.1f} / {self.state['size'] / 1e6:.1f} MB)")
+
+    def save(self):
+        # Only record progress that is on disk, so a crash never skips unwritten bytes
+        os.fsync(self.fd)
+        _write_json(self.state_path, self.state)
+        self.unsaved = 0
+
+
+def _fetch_segment(url, part, segment, progress, timeout):
+    buffer = bytearray(BUFFER_SIZE)
+    view = memoryview(buffer)
+    error = None
+    with open(part, 'r+b', buffering=0) as f:
+        for attempt in range(RETRIES):
+            position = segment['start'] + segment['done']
+            if position >= segment['end']:
+                return
+            request = urllib.request.Request(url, headers={'Range': f"bytes={position}-{segment['end'] - 1}"})
+            try:
+                with urllib.request.urlopen(request, timeout=timeout) as response:
+                    if response.status != 206:
+                        raise DownloadError("Server stopped honouring byte ranges")
+                    f.seek(position)
+                    while position < segment['end']:
+                        n = response.readinto(view[:min(BUFFER_SIZE, segment['end'] - position)])
+                        if not n:
+                            break
+                        f.write(view[:n])
+                        position += n
+                        progress.advance(segment, n)
+                    if position < segment['end']:
+                        error = DownloadError("Connection closed early")
+            except (OSError, http.client.HTTPException) as e:
+                error = e
+                time.sleep(2 ** attempt)
+        if segment['start'] + segment['done'] < segment['end']:
+            raise DownloadError(f"Range {segment['start']}-{segment['end'] - 1} failed: {error}")
+
+
+def _download_ranges(url, part, size, validator, connections, timeout, verbose):
+    """Fill part with parallel range requests, resuming from part + '.json' when it matches"""
+    state_path = part + '.json'
+    state = None
+    try:
+        with open(state_path) as f:
+            state = json.load(f)
+        if state['size'] != size or state['validator'] != validator or os.path.getsize(part) != size:
+            state = None
+    except (OSError, ValueError, KeyError):
+        state = None
+
+    if state is None:
+        count = max(1, min(connections, size // MIN_SEGMENT))
+        bounds = [size * i // count for i in range(count + 1)]
+        state = {'size': size, 'validator': validator,
+                 'segments': [{'start': a, 'end': b, 'done': 0} for a, b in zip(bounds, bounds[1:])]}
+        with open(part, 'wb') as f:
+            f.truncate(size)
+        _write_json(state_path, state)
+    elif verbose:
+        done = sum(s['done'] for s in state['segments'])
+        print(f"Resuming at {done / 1e6:.1f} of {size / 1e6:.1f} MB")
+
+    fd = os.open(part, os.O_RDWR)
+    try:
+        progress = _Progress(state, state_path, fd, verbose)
+        pending = [s for s in state['segments'] if s['done'] < s['end'] - s['start']]
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, len(pending))) as pool:
+                futures = [pool.submit(_fetch_segment, url, part, s, progress, timeout) for s in pending]
+                for future in futures:
+                    future.result()
+        finally:
+            # Once the pool has shut down, so segments still running when one failed are included
+            with progress.lock:
+                progress.save()
+    finally:
+        os.close(fd)
+
+
+def _download_stream(url, part, timeout):
+    """Single GET for servers without range support; cannot resume"""
+    buffer = bytearray(BUFFER_SIZE)
+    view = memoryview(buffer)
+    with urllib.request.urlopen(url, timeout=timeout) as response, open(part, 'wb', buffering=0) as f:
+        while True:
+            n = response.readinto(buffer)
+            if not n:
+                break
+            f.write(view[:n])
+        os.fsync(f.fileno())
+
+
+def fetch_model(url, filename=DEFAULT_MODEL, sha256=None, size=None, connections=CONNECTIONS,
+                timeout=30, verbose=True):
+    """Download url to filename unless a verified copy is already there
+
+    The file is fetched into ``<filename>.part`` with parallel range requests
+    (a single stream if the server does not support ranges), checked against
+    ``sha256`` when given and only then renamed over ``filename``. An
+    interrupted download resumes from ``<filename>.part.json`` on the next run.
+    Returns ``'cached'`` or ``'downloaded'``; raises DownloadError.
+    """
+    sha256 = sha256.lower() if sha256 else None
+    if os.path.exists(filename):
+        if sha256 and cached_sha256(filename) == sha256:
+            return 'cached'
+        if not sha256 and size is not None and os.path.getsize(filename) == size:
+            return 'cached'
+
+    try:
+        final_url, remote_size, ranges, validator = probe(url, timeout)
+    except (OSError, http.client.HTTPException) as e:
+        raise DownloadError(f"Cannot reach {url}: {e}") from e
+    if size is not None and remote_size is not None and remote_size != size:
+        raise DownloadError(f"Server reports {remote_size} bytes, manifest expects {size}")
+    if not sha256 and remote_size is not None and os.path.exists(filename) \
+            and os.path.getsize(filename) == remote_size:
+        # Nothing to verify against; a same-sized copy is taken as current
+        return 'cached'
+
+    part = filename + '.part'
+    try:
+        if ranges:
+            _download_ranges(final_url, part, remote_size, validator, connections, timeout, verbose)
+        else:
+            _download_stream(final_url, part, timeout)
+    except (OSError, http.client.HTTPException) as e:
+        raise DownloadError(f"Download failed: {e}") from e
+
+    expected_size = size if size is not None else remote_size
+    if expected_size is not None and os.path.getsize(part) != expected_size:
+        raise DownloadError(f"Downloaded {os.path.getsize(part)} bytes, expected {expected_size}")
+    digest = file_sha256(part)
+    if sha256 and digest != sha256:
+        for path in (part, part + '.json'):
+            if os.path.exists(path):
+                os.remove(path)
+        raise DownloadError(f"SHA-256 mismatch: got {digest}, expected {sha256}")
+
+    os.replace(part, filename)
+    if os.path.exists(part + '.json'):
+        os.remove(part + '.json')
+    stat = os.stat(filename)
+    _write_json(filename + '.sha256.json', {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': digest})
+    return 'downloaded'
+
+
+def download_model_from_url(url, filename=DEFAULT_MODEL, sha256=None, size=None, connections=CONNECTIONS):
     """Download model from a cloud storage URL"""
     print(f"Downloading model from {url}...")
     try:
-        response = requests.get(url, stream=True)
-        response.raise_for_status()
-        
-        with open(filename, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                f.write(chunk)
-        
-        print(f"✅ Model downloaded successfully: {filename}")
-        return True
-    except Exception as e:
+        started = time.perf_counter()
+        outcome = fetch_model(url, filename, sha256, size, connections)
+    except DownloadError as e:
         print(f"❌ Error downloading model: {e}")
         return False
 
+    if outcome == 'cached':
+        print(f"✅ {filename} is already up to date")
+    else:
+        verified = "verified" if sha256 else "not verified, no SHA-256 given"
+        print(f"✅ Model downloaded successfully: {filename} "
+              f"({os.path.getsize(filename) / 1e6:.1f} MB in {time.perf_counter() - started:.1f}s, {verified})")
+    return True
+
+
+def write_manifest(path, filename, url):
+    """Record the size and SHA-256 of a known-good model for later downloads"""
+    manifest = {'url': url, 'filename': os.path.basename(filename),
+                'size': os.path.getsize(filename), 'sha256': file_sha256(filename)}
+    with open(path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
 def create_deployment_files():
     """Create deployment-specific files"""
     
@@ -116,6 +388,19 @@ python deploy_setup.py --url <direct-download-url>
 2. Rename it to `my_model.keras`
 3. Place it in the project root directory
 
+### Verified, resumable downloads
+Downloads use parallel HTTP range requests (`--connections`, default 4) into `my_model.keras.part`.
+An interrupted download resumes where it stopped when the command is run again. The file only
+replaces `my_model.keras` once it is complete, so the app never loads a half-written model.
+
+Record the checksum of a known-good model once and commit the manifest:
+```bash
+python deploy_setup.py --write-manifest my_model.keras --url <direct-download-url>
+```
+`model_manifest.json` then supplies the URL, size and SHA-256 for `--download-model`. A download
+that does not match is discarded. When the local model already matches, nothing is downloaded.
+`--sha256 <hex>` checks a one-off URL.
+
 ## Deployment Platforms
 
 ### Heroku
@@ -144,23 +429,47 @@ def main():
     parser.add_argument('--url', type=str, help='Download model from specific URL')
     parser.add_argument('--gdrive', type=str, help='Download model from Google Drive file ID')
     parser.add_argument('--setup', action='store_true', help='Create deployment files')
+    parser.add_argument('--manifest', default=DEFAULT_MANIFEST,
+                        help=f'JSON with the url, sha256, size and filename of the model (default: {DEFAULT_MANIFEST})')
+    parser.add_argument('--sha256', help='Expected SHA-256 of the model (overrides the manifest)')
+    parser.add_argument('--output', help=f'Where to save the model (default: {DEFAULT_MODEL})')
+    parser.add_argument('--connections', type=int, default=CONNECTIONS, help='Parallel range requests')
+    parser.add_argument('--write-manifest', metavar='MODEL',
+                        help='Write --manifest for a known-good local model file, with --url as its source')
     
     args = parser.parse_args()
     
     if args.setup:
         create_deployment_files()
     
+    if args.write_manifest:
+        manifest = write_manifest(args.manifest, args.write_manifest, args.url)
+        print(f"✅ Wrote {args.manifest} ({manifest['size']} bytes, sha256 {manifest['sha256']})")
+        return
+    
+    manifest = load_manifest(args.manifest) if os.path.exists(args.manifest) else {}
+    
     if args.url:
-        download_model_from_url(args.url)
+        url = args.url
     elif args.gdrive:
-        gdrive_url = f"https://drive.google.com/uc?id={args.gdrive}"
-        download_model_from_url(gdrive_url)
+        url = gdrive_url(args.gdrive)
     elif args.download_model:
-        # Default to the provided Google Drive link
-        gdrive_id = "16imA9-VPF45hMTKflJqSZxotdUSwKJwO"
-        gdrive_url = f"https://drive.google.com/uc?id={gdrive_id}"
-        print(f"Downloading model from Google Drive (ID: {gdrive_id})...")
-        download_model_from_url(gdrive_url)
+        # The manifest's source when there is one, else the provided Google Drive link
+        url = manifest.get('url') or gdrive_url(DEFAULT_GDRIVE_ID)
+    else:
+        return
+    
+    # The manifest's checksum only describes its own file; don't apply it to a different URL
+    same_source = manifest.get('url') in (None, url)
+    ok = download_model_from_url(
+        url,
+        filename=args.output or manifest.get('filename') or DEFAULT_MODEL,
+        sha256=args.sha256 or (manifest.get('sha256') if same_source else None),
+        size=manifest.get('size') if same_source and not args.sha256 else None,
+        connections=args.connections,
+    )
+    if not ok:
+        raise SystemExit(1)
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    main()
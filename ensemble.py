@@ -0,0 +1,166 @@
+"""
+Test-time augmentation and model ensembles for the Malaria Detection System.
+
+One forward pass gives one probability and no sense of how stable it is.
+``TTAPredictor`` runs each image under a set of flips and rotations (a cell
+has no preferred orientation) through one or more models and reports the
+mean and variance of the answers. All views of a batch are stacked into a
+single tensor, so each model sees one forward pass per batch instead of a
+Python loop of predictions.
+
+``EscalatingPredictor`` keeps the average cost close to a single pass:
+every image gets the normal prediction first and only those within
+``margin`` of the 0.5 threshold are run through the full ensemble.
+"""
+
+import threading
+
+import numpy as np
+
+# The eight symmetries of a square, applied to (N, H, W, C) batches
+AUGMENTATIONS = {
+    'identity': lambda x: x,
+    'hflip': lambda x: x[:, :, ::-1],
+    'vflip': lambda x: x[:, ::-1],
+    'rot90': lambda x: np.rot90(x, 1, axes=(1, 2)),
+    'rot180': lambda x: x[:, ::-1, ::-1],
+    'rot270': lambda x: np.rot90(x, 3, axes=(1, 2)),
+    'transpose': lambda x: x.swapaxes(1, 2),
+    'antitranspose': lambda x: x.swapaxes(1, 2)[:, ::-1, ::-1],
+}
+DEFAULT_AUGMENTATIONS = tuple(AUGMENTATIONS)
+TTA_MODES = ('off', 'uncertain', 'always')
+
+_SCALE = np.float32(1.0 / 255.0)
+
+
+def parse_augmentations(value):
+    """Parse a comma separated list such as 'identity,hflip,rot90'"""
+    names = tuple(name.strip() for name in value.split(',') if name.strip())
+    unknown = [name for name in names if name not in AUGMENTATIONS]
+    if unknown or not names:
+        raise ValueError(f"Unknown augmentations {', '.join(unknown) or '(none given)'} "
+                         f"(choose from: {', '.join(AUGMENTATIONS)})")
+    return names
+
+
+def augment(batch, augmentations=DEFAULT_AUGMENTATIONS):
+    """Stack every view of every image into one (V * N, H, W, C) array, view by view"""
+    batch = np.asarray(batch)
+    views = np.empty((len(augmentations),) + batch.shape, dtype=batch.dtype)
+    for index, name in enumerate(augmentations):
+        views[index] = AUGMENTATIONS[name](batch)
+    return views.reshape((-1,) + batch.shape[1:])
+
+
+def _as_input(batch, dtype):
+    # Members of an ensemble may take different pixel formats
+    if batch.dtype == dtype:
+        return batch
+    if batch.dtype == np.uint8:
+        return np.multiply(batch, _SCALE, dtype=np.float32).astype(dtype, copy=False)
+    return np.clip(np.round(batch * 255), 0, 255).astype(dtype)
+
+
+class TTAPredictor:
+    """Mean and variance of the probability over augmented views and models
+
+    ``members`` is a list of ``(predict_batch, input_dtype)`` pairs, one per
+    model. Batches are split so no forward pass holds more than
+    ``max_pass_size`` views.
+    """
+
+    name = 'tta'
+
+    def __init__(self, members, augmentations=DEFAULT_AUGMENTATIONS, max_pass_size=256):
+        if not members:
+            raise ValueError("TTAPredictor needs at least one model")
+        self.members = list(members)
+        self.augmentations = tuple(augmentations)
+        self.input_dtype = self.members[0][1]
+        self.images_per_pass = max(1, max_pass_size // len(self.augmentations))
+
+    @property
+    def views(self):
+        """Predictions averaged per image"""
+        return len(self.members) * len(self.augmentations)
+
+    def predict_batch_stats(self, batch):
+        """Return the mean and variance of each image's probability"""
+        batch = np.asarray(batch)
+        means, variances = [], []
+        for first in range(0, len(batch), self.images_per_pass):
+            chunk = batch[first:first + self.images_per_pass]
+            views = augment(chunk, self.augmentations)
+            outputs = [np.asarray(predict_batch(_as_input(views, dtype)), dtype=np.float64)
+                       .reshape(len(self.augmentations), len(chunk))
+                       for predict_batch, dtype in self.members]
+            outputs = np.concatenate(outputs)
+            means.append(outputs.mean(axis=0))
+            variances.append(outputs.var(axis=0))
+        return np.concatenate(means), np.concatenate(variances)
+
+    def predict_batch(self, batch):
+        return self.predict_batch_stats(batch)[0].astype(np.float32)
+
+
+class EscalatingPredictor:
+    """Single pass for confident images, the TTA ensemble for uncertain ones
+
+    An image is uncertain when its single-pass probability is within
+    ``margin`` of ``threshold``; ``margin=None`` escalates every image.
+    """
+
+    def __init__(self, predict_batch, tta, margin=0.15, threshold=0.5):
+        self.predict_fn = predict_batch
+        self.tta = tta
+        self.margin = margin
+        self.threshold = threshold
+        self.input_dtype = tta.input_dtype
+
+        self._lock = threading.Lock()
+        self._images = 0
+        self._escalated = 0
+
+    def predict_batch_stats(self, batch, probabilities=None):
+        """Return ``(mean, variance, escalated)`` arrays for a batch
+
+        Pass the single-pass ``probabilities`` when they are already known
+        (e.g. from the prediction cache). Images that were not escalated keep
+        their single-pass probability and have a NaN variance.
+        """
+        batch = np.asarray(batch)
+        if probabilities is None:
+            probabilities = self.predict_fn(batch)
+        mean = np.array(probabilities, dtype=np.float64)
+        variance = np.full(len(mean), np.nan)
+
+        if self.margin is None:
+            escalated = np.ones(len(mean), dtype=bool)
+        else:
+            escalated = np.abs(mean - self.threshold) < self.margin
+        if escalated.any():
+            mean[escalated], variance[escalated] = self.tta.predict_batch_stats(batch[escalated])
+
+        with self._lock:
+            self._images += len(mean)
+            self._escalated += int(escalated.sum())
+        return mean, variance, escalated
+
+    def predict_batch(self, batch):
+        return self.predict_batch_stats(batch)[0].astype(np.float32)
+
+    def stats(self):
+        """Escalation counters, for tuning the margin against the extra cost"""
+        with self._lock:
+            images, escalated = self._images, self._escalated
+        rate = escalated / images if images else 0.0
+        return {
+            'images': images,
+            'escalated': escalated,
+            'escalation_rate': round(rate, 4),
+            'views': self.tta.views,
+            'margin': self.margin,
+            # Forward-pass images per input image, relative to a single pass
+            'relative_cost': round(1 + rate * self.tta.views, 3),
+        }
@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+"""
+Evaluate the model over a labelled dataset.
+
+Streams every image of a class-labelled tree (cell_images/Parasitized and
+cell_images/Uninfected) or of a packed dataset through batched inference
+and reports:
+
+    confusion matrix, accuracy, sensitivity, specificity, precision and F1
+        at the 0.5 threshold used by predict_malaria
+    ROC curve and AUC
+    calibration: reliability bins, expected calibration error, Brier score
+    a threshold sweep, with the threshold that maximises Youden's J
+    images per second
+
+Parasitized is the positive class. The model outputs the probability of
+Uninfected, so thresholds are reported the way predict_malaria applies
+them: probability above the threshold means Uninfected.
+
+Usage:
+    python evaluate.py cell_images --json eval.json
+    python evaluate.py cell_images.packed --backend tflite-int8 --limit 2000
+    python evaluate.py cell_images.packed --tta uncertain --ensemble tflite-int8
+"""
+
+import csv
+import json
+import os
+import time
+
+import numpy as np
+
+from packed_dataset import PackedDataset, is_packed
+from pipeline import iter_batch_predictions, iter_image_files
+
+POSITIVE = 'Parasitized'
+NEGATIVE = 'Uninfected'
+
+# predict_malaria calls an image Uninfected when its probability is above this
+MODEL_THRESHOLD = 0.5
+
+
+def collect_tree(root, predict_batch, batch_size=32, decode_workers=None, input_dtype=np.float32,
+                 limit=None, seed=0):
+    """Run every labelled image under root; return names, labels (1 = Parasitized) and probabilities"""
+    files = [(relpath, path) for relpath, path in iter_image_files(root)
+             if relpath.split(os.sep)[0] in (POSITIVE, NEGATIVE)]
+    if limit and limit < len(files):
+        picks = np.random.default_rng(seed).choice(len(files), size=limit, replace=False)
+        files = [files[i] for i in sorted(picks)]
+
+    names, labels, probabilities, errors = [], [], [], []
+    for relpath, probability, error in iter_batch_predictions(files, predict_batch, batch_size=batch_size,
+                                                              decode_workers=decode_workers,
+                                                              input_dtype=input_dtype):
+        if error:
+            errors.append((relpath, error))
+            continue
+        names.append(relpath)
+        labels.append(int(relpath.split(os.sep)[0] == POSITIVE))
+        probabilities.append(probability)
+    return names, np.array(labels), np.array(probabilities, dtype=np.float64), errors
+
+
+def collect_packed(path, predict_batch, batch_size=32, input_dtype=np.float32, limit=None, seed=0):
+    """Same as collect_tree, reading zero-copy batches from a packed dataset"""
+    dataset = PackedDataset(path)
+    if POSITIVE not in dataset.classes or NEGATIVE not in dataset.classes:
+        return [], np.array([], dtype=int), np.array([]), []
+    positive = dataset.classes.index(POSITIVE)
+    negative = dataset.classes.index(NEGATIVE)
+    keep = np.isin(dataset.labels, (positive, negative))
+
+    probabilities = np.full(len(dataset), np.nan)
+    if limit and limit < int(keep.sum()):
+        picks = np.sort(np.random.default_rng(seed).choice(np.flatnonzero(keep), size=limit, replace=False))
+        batch = None
+        for first in range(0, len(picks), batch_size):
+            indices = picks[first:first + batch_size]
+            batch = dataset.take(indices, dtype=input_dtype, out=batch)
+            probabilities[indices] = predict_batch(batch)
+        selected = picks
+    else:
+        for pixels, _, first in dataset.iter_batches(batch_size, dtype=input_dtype):
+            probabilities[first:first + len(pixels)] = predict_batch(pixels)
+        selected = np.flatnonzero(keep)
+
+    names = [dataset.names[i] for i in selected]
+    return names, (dataset.labels[selected] == positive).astype(int), probabilities[selected], []
+
+
+def confusion(labels, probabilities, threshold=MODEL_THRESHOLD):
+    """Counts and rates when probability <= threshold is called Parasitized"""
+    predicted = probabilities <= threshold
+    tp = int(np.sum(predicted & (labels == 1)))
+    fp = int(np.sum(predicted & (labels == 0)))
+    tn = int(np.sum(~predicted & (labels == 0)))
+    fn = int(np.sum(~predicted & (labels == 1)))
+
+    def ratio(a, b):
+        return round(a / b, 4) if b else None
+
+    precision, sensitivity = ratio(tp, tp + fp), ratio(tp, tp + fn)
+    return {
+        'threshold': round(float(threshold), 4),
+        'tp': tp, 'fp': fp, 'tn': tn, 'fn': fn,
+        'accuracy': ratio(tp + tn, len(labels)),
+        'sensitivity': sensitivity,
+        'specificity': ratio(tn, tn + fp),
+        'precision': precision,
+        'f1': round(2 * precision * sensitivity / (precision + sensitivity), 4)
+        if precision and sensitivity else None,
+    }
+
+
+def roc(labels, probabilities):
+    """ROC points (false positive rate, true positive rate), the area under the curve
+    and the threshold that maximises Youden's J (sensitivity + specificity - 1)"""
+    scores = 1 - probabilities
+    order = np.argsort(-scores, kind='mergesort')
+    scores, labels = scores[order], labels[order]
+    # One point per distinct score, so tied scores do not make a staircase
+    distinct = np.r_[np.flatnonzero(np.diff(scores)), len(scores) - 1]
+    tps = np.cumsum(labels)[distinct]
+    fps = (distinct + 1) - tps
+    positives, negatives = tps[-1], fps[-1]
+    if not positives or not negatives:
+        return {'auc': None, 'best_youden_threshold': None, 'fpr': [], 'tpr': []}
+
+    tpr = np.r_[0, tps / positives]
+    fpr = np.r_[0, fps / negatives]
+    auc = float(np.sum(np.diff(fpr) * (tpr[1:] + tpr[:-1]) / 2))
+    # Point i > 0 calls Parasitized every score >= scores[distinct[i - 1]]
+    best = int(np.argmax(tpr[1:] - fpr[1:]))
+    youden = 1 - float(scores[distinct[best]])
+
+    # Thin the curve for the report; the AUC uses every point
+    keep = np.unique(np.linspace(0, len(fpr) - 1, num=min(len(fpr), 101)).astype(int))
+    return {'auc': round(auc, 5), 'best_youden_threshold': round(youden, 4),
+            'fpr': np.round(fpr[keep], 4).tolist(), 'tpr': np.round(tpr[keep], 4).tolist()}
+
+
+def calibration(labels, probabilities, bins=10):
+    """Reliability bins, expected calibration error and Brier score
+
+    Measured on the parasitized score ``1 - probability``, so each bin
+    compares the mean predicted chance of infection with the observed one.
+    """
+    scores = 1 - probabilities
+    edges = np.linspace(0, 1, bins + 1)
+    index = np.clip(np.digitize(scores, edges[1:-1]), 0, bins - 1)
+    table = []
+    ece = 0.0
+    for b in range(bins):
+        members = index == b
+        count = int(members.sum())
+        if not count:
+            continue
+        confidence = float(scores[members].mean())
+        observed = float(labels[members].mean())
+        ece += count / len(scores) * abs(confidence - observed)
+        table.append({'bin': f'{edges[b]:.1f}-{edges[b + 1]:.1f}', 'count': count,
+                      'mean_score': round(confidence, 4), 'fraction_parasitized': round(observed, 4)})
+    return {
+        'bins': table,
+        'expected_calibration_error': round(ece, 5),
+        'brier_score': round(float(np.mean((scores - labels) ** 2)), 5),
+    }
+
+
+def threshold_sweep(labels, probabilities, thresholds=np.round(np.arange(0.05, 1.0, 0.05), 2)):
+    """Confusion metrics at each threshold, to show what moving 0.5 would change"""
+    return [confusion(labels, probabilities, t) for t in thresholds]
+
+
+def evaluate(labels, probabilities):
+    """All metrics for labels (1 = Parasitized) and model probabilities (of Uninfected)"""
+    return {
+        'images': int(len(labels)),
+        'parasitized': int(labels.sum()),
+        'uninfected': int(len(labels) - labels.sum()),
+        'at_model_threshold': confusion(labels, probabilities),
+        'roc': roc(labels, probabilities),
+        'calibration': calibration(labels, probabilities),
+        'threshold_sweep': threshold_sweep(labels, probabilities),
+    }
+
+
+def main():
+    import argparse
+
+    from backends import BACKENDS, load_backend, load_ensemble_member
+    from ensemble import DEFAULT_AUGMENTATIONS, EscalatingPredictor, TTAPredictor, parse_augmentations
+
+    parser = argparse.ArgumentParser(description='Evaluate the model over a labelled dataset')
+    parser.add_argument('data', nargs='?', default='cell_images', help='Labelled image tree or packed dataset')
+    parser.add_argument('--backend', choices=BACKENDS, default=os.environ.get('MODEL_BACKEND', 'keras'))
+    parser.add_argument('--batch-size', type=int, default=64, help='Images per forward pass')
+    parser.add_argument('--workers', type=int, default=None, help='Decode threads (default: cores + 4)')
+    parser.add_argument('--limit', type=int, help='Evaluate a random subset of this many images')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for --limit')
+    parser.add_argument('--tta', choices=('uncertain', 'always'),
+                        help='Average over augmented views (and --ensemble models): for uncertain images or all')
+    parser.add_argument('--tta-margin', type=float, default=0.15, help='Escalate when |probability - 0.5| is below this')
+    parser.add_argument('--augmentations', default=','.join(DEFAULT_AUGMENTATIONS), help='Views used by --tta')
+    parser.add_argument('--ensemble', default='', help='Extra models for --tta: backend names or model paths')
+    parser.add_argument('--json', help='Write the full report to this file')
+    parser.add_argument('--predictions', help='Write per-image probabilities to this CSV file')
+
+    args = parser.parse_args()
+
+    if not os.path.exists(args.data):
+        raise SystemExit(f"❌ Not found: {args.data}")
+
+    backend, info = load_backend(args.backend)
+    predict_batch = backend.predict_batch
+    escalation = None
+    if args.tta:
+        try:
+            augmentations = parse_augmentations(args.augmentations)
+        except ValueError as e:
+            raise SystemExit(f"❌ {e}")
+        members = [(backend.predict_batch, backend.input_dtype)]
+        for spec in filter(None, args.ensemble.split(',')):
+            member, _ = load_ensemble_member(spec)
+            members.append((member.predict_batch, member.input_dtype))
+        escalation = EscalatingPredictor(backend.predict_batch, TTAPredictor(members, augmentations),
+                                         margin=None if args.tta == 'always' else args.tta_margin)
+        predict_batch = escalation.predict_batch
+
+    started = time.perf_counter()
+    if is_packed(args.data):
+        names, labels, probabilities, errors = collect_packed(
+            args.data, predict_batch, args.batch_size, backend.input_dtype, args.limit, args.seed)
+    else:
+        names, labels, probabilities, errors = collect_tree(
+            args.data, predict_batch, args.batch_size, args.workers, backend.input_dtype,
+            args.limit, args.seed)
+    elapsed = time.perf_counter() - started
+
+    if not len(labels):
+        raise SystemExit(f"❌ No {POSITIVE}/{NEGATIVE} images found in {args.data}")
+
+    report = evaluate(labels, probabilities)
+    report.update({
+        'data': args.data,
+        'backend': info['backend'],
+        'model_version': info['model_version'],
+        'seconds': round(elapsed, 2),
+        'images_per_second': round(len(labels) / elapsed, 1) if elapsed else None,
+        'failed': len(errors),
+        'tta': escalation.stats() if escalation else None,
+    })
+
+    at = report['at_model_threshold']
+    if escalation:
+        tta = report['tta']
+        print(f"TTA: {tta['escalated']} of {tta['images']} images escalated ({tta['views']} views each), "
+              f"{tta['relative_cost']}x the single-pass cost")
+    print(f"{report['images']} images ({report['parasitized']} parasitized) in {report['seconds']}s "
+          f"= {report['images_per_second']} images/s, {len(errors)} failed")
+    print(f"Confusion at 0.5:  TP {at['tp']}  FN {at['fn']}  FP {at['fp']}  TN {at['tn']}")
+    print(f"Accuracy {at['accuracy']}  sensitivity {at['sensitivity']}  specificity {at['specificity']}  "
+          f"F1 {at['f1']}")
+    print(f"AUC {report['roc']['auc']}  ECE {report['calibration']['expected_calibration_error']}  "
+          f"Brier {report['calibration']['brier_score']}  best threshold (Youden) {report['roc']['best_youden_threshold']}")
+
+    print(f"\n{'threshold':>10}{'acc':>8}{'sens':>8}{'spec':>8}{'FN':>7}{'FP':>7}")
+    for row in report['threshold_sweep'][1::2]:
+        print(f"{row['threshold']:>10}{str(row['accuracy']):>8}{str(row['sensitivity']):>8}"
+              f"{str(row['specificity']):>8}{row['fn']:>7}{row['fp']:>7}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.predictions:
+        with open(args.predictions, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['path', 'label', 'probability_uninfected'])
+            for name, label, probability in zip(names, labels, probabilities):
+                writer.writerow([name, POSITIVE if label else NEGATIVE, round(float(probability), 6)])
+
+
+if __name__ == "__main__":
+    main()
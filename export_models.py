@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+"""
+Export the Keras model to the optimized inference backends and compare them.
+
+Formats (written to exports/, see backends.py):
+    dynamic  TFLite with dynamic-range quantized weights
+    int8     TFLite with full-integer quantization, calibrated on cell_images/
+    xla      SavedModel of an XLA-compiled tf.function
+
+Usage:
+    python export_models.py --formats dynamic,int8,xla
+    python export_models.py --compare
+"""
+
+import json
+import os
+import random
+import shutil
+import subprocess
+import time
+
+import numpy as np
+
+from backends import BACKENDS, EXPORT_DIR, export_path, load_backend
+from benchmark import cold_start
+from model_registry import INPUT_SHAPE, load_model
+from packed_dataset import PackedDataset, is_packed
+from pipeline import iter_image_files
+from preprocessing import preprocess_batch
+
+FORMATS = ('dynamic', 'int8', 'xla')
+CLASSES = ('Parasitized', 'Uninfected')
+
+
+def split_samples(root='cell_images', calibration_count=200, eval_count=200, seed=42):
+    """Split labelled images into disjoint calibration and held-out evaluation sets
+
+    Labels come from the class folder: 1 for Uninfected (the model's positive
+    output), 0 for Parasitized. ``root`` may also be a packed dataset (see
+    packed_dataset.py), in which case the images are memory-mapped arrays.
+    """
+    if is_packed(root):
+        dataset = PackedDataset(root)
+        uninfected = dataset.classes.index('Uninfected')
+        calibration_ids = dataset.sample(calibration_count // len(CLASSES), seed)
+        eval_ids = dataset.sample(eval_count // len(CLASSES), seed + 1, exclude=calibration_ids)
+        return ([(dataset[i], int(dataset.labels[i] == uninfected)) for i in calibration_ids],
+                [(dataset[i], int(dataset.labels[i] == uninfected)) for i in eval_ids])
+
+    per_class = {label: [] for label in CLASSES}
+    for relpath, path in iter_image_files(root):
+        label = relpath.split(os.sep)[0]
+        if label in per_class:
+            per_class[label].append(path)
+
+    rng = random.Random(seed)
+    calibration, evaluation = [], []
+    for label, paths in per_class.items():
+        rng.shuffle(paths)
+        cal = paths[:calibration_count // len(CLASSES)]
+        held_out = paths[len(cal):len(cal) + eval_count // len(CLASSES)]
+        calibration += [(path, int(label == 'Uninfected')) for path in cal]
+        evaluation += [(path, int(label == 'Uninfected')) for path in held_out]
+    return calibration, evaluation
+
+
+def export_tflite(model, output, calibration=None):
+    """Convert to TFLite; with calibration images, quantize fully to int8"""
+    import tensorflow as tf
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+
+    if calibration is not None:
+        def representative_dataset():
+            for path, _ in calibration:
+                yield [preprocess_batch([path])]
+
+        converter.representative_dataset = representative_dataset
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+        converter.inference_input_type = tf.int8
+        converter.inference_output_type = tf.int8
+
+    data = converter.convert()
+    with open(output + '.tmp', 'wb') as f:
+        f.write(data)
+    os.replace(output + '.tmp', output)
+    return len(data)
+
+
+def export_xla(model, export_dir):
+    """Save the model as a SavedModel holding one XLA-compiled serving function"""
+    import tensorflow as tf
+
+    module = tf.Module()
+    module.model = model
+    module.serve = tf.function(
+        lambda batch: model(batch, training=False),
+        input_signature=[tf.TensorSpec((None,) + INPUT_SHAPE, tf.float32)],
+        jit_compile=True,
+    )
+    shutil.rmtree(export_dir + '.tmp', ignore_errors=True)
+    tf.saved_model.save(module, export_dir + '.tmp')
+    shutil.rmtree(export_dir, ignore_errors=True)
+    os.replace(export_dir + '.tmp', export_dir)
+
+
+def _artifact_size(path):
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(d, f)) for d, _, files in os.walk(path) for f in files)
+    return os.path.getsize(path)
+
+
+def compare_backends(names, evaluation, batch_size=32, repeats=20):
+    """Measure accuracy and latency of each backend on the held-out images"""
+    images = preprocess_batch([path for path, _ in evaluation])
+    labels = np.array([label for _, label in evaluation])
+    reference = None
+    report = []
+
+    for name in names:
+        try:
+            backend, info = load_backend(name)
+        except Exception as e:
+            print(f"Skipping {name}: {e}")
+            continue
+
+        probabilities = np.concatenate([backend.predict_batch(images[i:i + batch_size])
+                                        for i in range(0, len(images), batch_size)])
+        if reference is None:
+            reference = probabilities
+
+        single = []
+        for i in range(repeats):
+            started = time.perf_counter()
+            backend.predict_batch(images[i % len(images):i % len(images) + 1])
+            single.append((time.perf_counter() - started) * 1000)
+
+        batch = images[:batch_size]
+        started = time.perf_counter()
+        for _ in range(max(1, repeats // 4)):
+            backend.predict_batch(batch)
+        batch_seconds = (time.perf_counter() - started) / max(1, repeats // 4)
+
+        # Peak memory in a fresh process: this one's high-water mark covers every backend so far
+        try:
+            peak_rss_mb = cold_start(name, batch_size)['peak_rss_mb']
+        except subprocess.CalledProcessError:
+            peak_rss_mb = None
+
+        path = export_path(name) if name != 'keras' else info.get('record', {}).get('artifact', {}).get('path')
+        report.append({
+            'backend': name,
+            'accuracy': round(float(np.mean((probabilities > 0.5) == labels)), 4),
+            'agreement_with_first': round(float(np.mean((probabilities > 0.5) == (reference > 0.5))), 4),
+            'max_probability_diff': round(float(np.max(np.abs(probabilities - reference))), 4),
+            'latency_ms_p50': round(float(np.percentile(single, 50)), 2),
+            'latency_ms_p95': round(float(np.percentile(single, 95)), 2),
+            'images_per_second': round(len(batch) / batch_seconds, 1),
+            'load_seconds': info['load_seconds'],
+            'artifact_mb': round(_artifact_size(path) / 1e6, 1) if path and os.path.exists(path) else None,
+            'peak_rss_mb': peak_rss_mb,
+        })
+    return report
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Export and compare optimized inference backends')
+    parser.add_argument('--formats', default='', help=f"Comma separated formats to export ({', '.join(FORMATS)})")
+    parser.add_argument('--data', default='cell_images', help='Labelled image tree or packed dataset to sample')
+    parser.add_argument('--calibration-samples', type=int, default=200, help='Images used to calibrate int8')
+    parser.add_argument('--eval-samples', type=int, default=200, help='Held-out images used by --compare')
+    parser.add_argument('--compare', action='store_true', help='Compare accuracy and latency of the backends')
+    parser.add_argument('--backends', default=','.join(BACKENDS), help='Backends to compare')
+    parser.add_argument('--json', help='Also write the comparison to this file')
+
+    args = parser.parse_args()
+    formats = [f for f in args.formats.split(',') if f]
+    unknown = set(formats) - set(FORMATS)
+    if unknown:
+        raise SystemExit(f"❌ Unknown formats: {', '.join(sorted(unknown))}")
+
+    calibration, evaluation = split_samples(args.data, args.calibration_samples, args.eval_samples)
+
+    if formats:
+        # Export from the original Keras model, never from a serving cache
+        model, _ = load_model(use_serving_cache=False)
+        os.makedirs(EXPORT_DIR, exist_ok=True)
+        for fmt in formats:
+            started = time.perf_counter()
+            if fmt == 'xla':
+                export_xla(model, export_path('xla'))
+            elif fmt == 'dynamic':
+                export_tflite(model, export_path('tflite-dynamic'))
+            else:
+                if not calibration:
+                    raise SystemExit(f"❌ int8 export needs calibration images in {args.data}/")
+                export_tflite(model, export_path('tflite-int8'), calibration)
+            print(f"✅ Exported {fmt} in {time.perf_counter() - started:.1f}s")
+
+    if args.compare:
+        if not evaluation:
+            raise SystemExit(f"❌ No held-out images found in {args.data}/")
+        report = compare_backends([name for name in args.backends.split(',') if name], evaluation)
+
+        print(f"\n{'backend':<16}{'acc':>8}{'agree':>8}{'p50 ms':>9}{'p95 ms':>9}{'img/s':>9}{'MB':>9}{'RSS MB':>9}")
+        for row in report:
+            print(f"{row['backend']:<16}{row['accuracy']:>8}{row['agreement_with_first']:>8}"
+                  f"{row['latency_ms_p50']:>9}{row['latency_ms_p95']:>9}{row['images_per_second']:>9}"
+                  f"{str(row['artifact_mb']):>9}{str(row['peak_rss_mb']):>9}")
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,244 @@
+"""
+Shared inference helpers for the Malaria Detection System.
+
+Holds the model output handling used by every entry point and the
+micro-batching scheduler that merges concurrent requests into a single
+forward pass.
+"""
+
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+import numpy as np
+
+from model_registry import warmup
+
+
+def create_batcher(backend, warmup_batch_sizes=(), **batch_options):
+    """Warm up a backend (see backends.py) and put a MicroBatcher in front of it
+
+    The backend runs one pass at each of ``warmup_batch_sizes`` before the
+    batcher starts taking requests.
+    """
+    if warmup_batch_sizes:
+        timings = warmup(backend.predict_batch, warmup_batch_sizes, backend.input_dtype)
+        print(f"Model warmed up (ms per batch size): {timings}")
+
+    return MicroBatcher(backend.predict_batch, **batch_options)
+
+
+def model_probabilities(model, batch):
+    """Run one forward pass and return one probability per image"""
+    if hasattr(model, 'predict_on_batch'):
+        # Standard Keras model (predict_on_batch skips the tf.data setup of predict)
+        prediction = model.predict_on_batch(batch)
+    else:
+        # TFSMLayer model
+        prediction = model(batch)
+        if isinstance(prediction, dict):
+            # Extract the first value from the dictionary
+            prediction = list(prediction.values())[0]
+
+    return output_probabilities(prediction)
+
+
+def output_probabilities(prediction):
+    """Reduce raw model output to one probability per image"""
+    prediction = np.asarray(prediction)
+
+    # Handle different prediction formats
+    if prediction.ndim == 1:
+        # Single value output
+        return prediction.astype(np.float32)
+    if prediction.shape[1] == 1:
+        # Single column output
+        return prediction[:, 0].astype(np.float32)
+    # Multiple columns, assume second column is positive class
+    return prediction[:, 1].astype(np.float32)
+
+
+PARASITIZED = "Parasitized (Malaria Positive)"
+UNINFECTED = "Uninfected (Malaria Negative)"
+
+
+def interpret_probability(probability):
+    """Turn a model probability into the prediction response"""
+    # Determine result (reversed logic)
+    if probability > 0.5:
+        result = UNINFECTED
+        confidence = probability
+    else:
+        result = PARASITIZED
+        confidence = 1 - probability
+
+    return {
+        "result": result,
+        "confidence": round(confidence * 100, 2),
+        "probability": round(probability * 100, 2)
+    }
+
+
+class MicroBatcher:
+    """Queue single-image requests and run them through the model in batches
+
+    A background thread takes the first queued image, keeps collecting until
+    either ``max_batch_size`` images are waiting or ``max_wait_ms`` has passed,
+    then runs ``predict_fn`` once on the stacked batch and hands each caller
+    its own probability through a ``Future``.
+    """
+
+    def __init__(self, predict_fn, max_batch_size=32, max_wait_ms=5, max_queue_size=256):
+        self.predict_fn = predict_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.max_queue_size = max_queue_size
+
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._lock = threading.Lock()
+        # Held for every forward pass, the scheduler's own and those of serialized()
+        self._model_lock = threading.Lock()
+        self._batches = 0
+        self._images = 0
+        self._errors = 0
+        self._batch_sizes = {}
+        self._recent_waits = deque(maxlen=1024)
+        self._recent_batch_ms = deque(maxlen=1024)
+        self._buffer = None
+
+        self._thread = threading.Thread(target=self._run, name='micro-batcher', daemon=True)
+        self._thread.start()
+
+    def submit(self, image, block=False):
+        """Queue one preprocessed image and return a Future for its probability
+
+        Raises ``queue.Full`` when the queue already holds ``max_queue_size``
+        images, so callers can shed load instead of piling up memory. Bulk
+        callers pass ``block=True`` to wait for room instead.
+        """
+        future = Future()
+        self._queue.put((image, future, time.perf_counter()), block=block)
+        return future
+
+    def predict(self, image, timeout=None):
+        """Queue one preprocessed image and block until its probability is ready"""
+        return self.submit(image).result(timeout)
+
+    def predict_batch(self, images, timeout=None):
+        """Queue a stack of preprocessed images and return their probabilities
+
+        The images share the scheduler with online requests, so bulk work is
+        batched together with (not ahead of) interactive traffic.
+        """
+        futures = [self.submit(image, block=True) for image in images]
+        return np.array([future.result(timeout) for future in futures], dtype=np.float32)
+
+    def serialized(self, predict_fn):
+        """Wrap another entry point into the same model so it takes turns with the scheduler
+
+        The wrapped calls keep their own batch (one forward pass) but never
+        run at the same time as a scheduled batch, so the model's thread
+        pools are not oversubscribed.
+        """
+        def predict_batch(batch):
+            with self._model_lock:
+                return predict_fn(batch)
+        return predict_batch
+
+    def close(self):
+        """Stop the scheduler thread once the queued work has been handed out"""
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+
+            batch = [item]
+            stop = False
+            deadline = time.perf_counter() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.perf_counter()
+                try:
+                    if remaining > 0:
+                        item = self._queue.get(timeout=remaining)
+                    else:
+                        item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+
+            self._run_batch(batch)
+            if stop:
+                return
+
+    def _stack(self, images):
+        # Reuse one contiguous max_batch_size buffer instead of allocating per batch
+        first = images[0]
+        if (self._buffer is None or self._buffer.shape[1:] != first.shape
+                or self._buffer.dtype != first.dtype):
+            self._buffer = np.empty((self.max_batch_size,) + first.shape, dtype=first.dtype)
+        return np.stack(images, out=self._buffer[:len(images)])
+
+    def _run_batch(self, batch):
+        started = time.perf_counter()
+        futures = [future for _, future, _ in batch]
+        waits = [started - queued_at for _, _, queued_at in batch]
+
+        try:
+            with self._model_lock:
+                probabilities = self.predict_fn(self._stack([image for image, _, _ in batch]))
+        except Exception as e:
+            for future in futures:
+                if future.set_running_or_notify_cancel():
+                    future.set_exception(e)
+            with self._lock:
+                self._errors += 1
+            return
+
+        for future, probability in zip(futures, probabilities):
+            if future.set_running_or_notify_cancel():
+                future.set_result(float(probability))
+
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self._batches += 1
+            self._images += len(batch)
+            self._batch_sizes[len(batch)] = self._batch_sizes.get(len(batch), 0) + 1
+            self._recent_waits.extend(waits)
+            self._recent_batch_ms.append(elapsed * 1000)
+
+    def stats(self):
+        """Return batch size, queue depth and wait time figures for tuning"""
+        with self._lock:
+            waits_ms = np.array(self._recent_waits) * 1000
+            batch_ms = np.array(self._recent_batch_ms)
+            stats = {
+                'queue_depth': self._queue.qsize(),
+                'max_queue_size': self.max_queue_size,
+                'max_batch_size': self.max_batch_size,
+                'max_wait_ms': self.max_wait * 1000,
+                'batches': self._batches,
+                'images': self._images,
+                'errors': self._errors,
+                'mean_batch_size': round(self._images / self._batches, 2) if self._batches else 0.0,
+                'batch_size_counts': {str(size): count for size, count in sorted(self._batch_sizes.items())},
+            }
+
+        for name, values in (('queue_wait_ms', waits_ms), ('batch_run_ms', batch_ms)):
+            if len(values):
+                stats[name] = {
+                    'p50': round(float(np.percentile(values, 50)), 3),
+                    'p99': round(float(np.percentile(values, 99)), 3),
+                    'max': round(float(values.max()), 3),
+                }
+            else:
+                stats[name] = {'p50': 0.0, 'p99': 0.0, 'max': 0.0}
+        return stats
@@ -0,0 +1,233 @@
+"""
+Streaming request ingest for the Malaria Detection System.
+
+Reads image uploads straight from the request body in small chunks instead
+of letting Werkzeug buffer (or spool) the whole body first:
+
+- ``iter_multipart_files`` decodes a multipart/form-data body incrementally
+  and yields each file part's bytes. The first bytes of every part are
+  checked before the rest is read, so a file that is not an image is
+  rejected without buffering it. With ``spool=True`` each part is written
+  to a temporary file instead of memory.
+- ``read_data_url_image`` pulls the base64 ``image_data`` data URL out of
+  a JSON body and decodes it as it streams in, never holding the encoded
+  string.
+
+Peak memory per request stays close to the size of the decoded image.
+"""
+
+import base64
+import binascii
+import os
+import tempfile
+
+from werkzeug.sansio.multipart import Data, Epilogue, File, MultipartDecoder, NeedData
+
+CHUNK_SIZE = 64 * 1024
+
+# Enough bytes to recognise every supported format
+HEADER_BYTES = 16
+
+IMAGE_SIGNATURES = (
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+    (b'BM', 'image/bmp'),
+    (b'II*\x00', 'image/tiff'),
+    (b'MM\x00*', 'image/tiff'),
+)
+ZIP_SIGNATURE = b'PK\x03\x04'
+
+
+class IngestError(ValueError):
+    """The request body cannot be used; ``status`` is the HTTP status to answer with"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+def sniff_image(head):
+    """Return the MIME type of an image from its first bytes, or None if unsupported"""
+    for signature, mime in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return mime
+    return None
+
+
+def _spool_file(filename):
+    """Named temporary file for a spooled part, keeping a plain extension so readers can pick a format"""
+    suffix = os.path.splitext(filename)[1].lower()
+    return tempfile.NamedTemporaryFile(suffix=suffix if suffix[1:].isalnum() else '')
+
+
+def iter_multipart_files(stream, boundary, fields, validate=None, max_bytes=None, chunk_size=CHUNK_SIZE,
+                         spool=False):
+    """Yield ``(filename, data, error)`` for each file part in ``fields``, in body order
+
+    ``data`` is a bytearray, or None for a rejected part. With ``spool`` it
+    is a named temporary file instead, rewound to the start; closing it
+    deletes it.
+    ``validate(filename, head)`` is called once with the first bytes of a
+    part and returns an error message to reject it; the rest of a rejected
+    part is skipped rather than stored. Parts larger than ``max_bytes``
+    raise IngestError with status 413.
+    """
+    decoder = MultipartDecoder(boundary.encode() if isinstance(boundary, str) else boundary)
+    part = None
+    exhausted = False
+
+    while True:
+        try:
+            event = decoder.next_event()
+        except ValueError:
+            # Werkzeug's decoder raises once the body ends mid-part, or on malformed part headers
+            raise IngestError('Incomplete multipart body' if exhausted else 'Invalid multipart body')
+
+        if isinstance(event, NeedData):
+            if exhausted:
+                raise IngestError('Incomplete multipart body')
+            chunk = stream.read(chunk_size)
+            exhausted = not chunk
+            decoder.receive_data(chunk or None)
+        elif isinstance(event, File):
+            part = None
+            if event.name in fields:
+                filename = event.filename or ''
+                part = {'filename': filename, 'buffer': _spool_file(filename) if spool else bytearray(),
+                        'head': bytearray(), 'size': 0, 'checked': False, 'error': None}
+        elif isinstance(event, Data):
+            if part is not None and part['error'] is None:
+                buffer = part['buffer']
+                if spool:
+                    buffer.write(event.data)
+                else:
+                    buffer += event.data
+                part['size'] += len(event.data)
+                if max_bytes is not None and part['size'] > max_bytes:
+                    if spool:
+                        buffer.close()
+                    raise IngestError('File too large', 413)
+                if not part['checked']:
+                    part['head'] += event.data[:HEADER_BYTES]
+                if not part['checked'] and (len(part['head']) >= HEADER_BYTES or not event.more_data):
+                    part['checked'] = True
+                    if validate is not None:
+                        part['error'] = validate(part['filename'], bytes(part['head'][:HEADER_BYTES]))
+                        if part['error']:
+                            if spool:
+                                buffer.close()
+                            else:
+                                buffer.clear()
+            if part is not None and not event.more_data:
+                if part['error'] is None and not part['checked'] and validate is not None:
+                    # Empty part: nothing was ever checked
+                    part['error'] = validate(part['filename'], b'')
+                    if part['error'] and spool:
+                        part['buffer'].close()
+                if spool and not part['error']:
+                    part['buffer'].flush()
+                    part['buffer'].seek(0)
+                yield part['filename'], None if part['error'] else part['buffer'], part['error']
+                part = None
+        elif isinstance(event, Epilogue):
+            return
+
+
+def _unescape_base64(segment):
+    """Undo the JSON escapes that can appear in a base64 string
+
+    ``\\/`` is a "/" and escaped line breaks (from wrapped base64) are
+    dropped; any other escape cannot be base64 and is rejected.
+    """
+    if b'\\' not in segment:
+        return segment
+    segment = segment.replace(b'\\/', b'/').replace(b'\\n', b'').replace(b'\\r', b'')
+    if b'\\' in segment:
+        raise IngestError('Invalid image data')
+    return segment
+
+
+def read_data_url_image(stream, key='image_data', max_bytes=None, chunk_size=CHUNK_SIZE):
+    """Decode the base64 data URL stored under ``key`` in a JSON body as it streams in
+
+    Returns ``(prefix, image bytearray)`` where prefix is the part of the data
+    URL before the comma (e.g. ``data:image/png;base64``), or ``(None,
+    None)`` if the key is not in the body. Only the body up to the end of
+    the value is read.
+    """
+    marker = f'"{key}"'.encode()
+    pending = b''
+    state = 'key'
+    prefix = b''
+    encoded_tail = b''
+    image = bytearray()
+    checked = False
+
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            if state == 'key':
+                return None, None
+            raise IngestError('Incomplete image data')
+        data = pending + chunk
+        pending = b''
+
+        if state == 'key':
+            index = data.find(marker)
+            if index < 0:
+                # Keep enough of the tail to find a key split across chunks
+                pending = data[-(len(marker) - 1):]
+                continue
+            data = data[index + len(marker):]
+            state = 'open'
+
+        if state == 'open':
+            stripped = data.lstrip(b' \t\r\n:')
+            if not stripped:
+                continue
+            if not stripped.startswith(b'"'):
+                raise IngestError('Invalid image data')
+            data = stripped[1:]
+            state = 'prefix'
+
+        if state == 'prefix':
+            index = data.find(b',')
+            if index < 0:
+                prefix += data
+                if len(prefix) > 100:
+                    raise IngestError('Invalid image data')
+                continue
+            prefix = (prefix + data[:index]).replace(b'\\/', b'/')
+            if not prefix.startswith(b'data:') or not prefix.endswith(b';base64'):
+                raise IngestError('Invalid image data')
+            data = data[index + 1:]
+            state = 'data'
+
+        if state == 'data':
+            end = data.find(b'"')
+            if end > 0 and data[end - 1:end] == b'\\':
+                # An escaped quote cannot be part of base64
+                raise IngestError('Invalid image data')
+            segment = data[:end if end >= 0 else len(data)]
+            if end < 0 and segment.endswith(b'\\'):
+                # Escape split across chunks: finish it with the next one
+                segment, pending = segment[:-1], b'\\'
+            encoded = encoded_tail + _unescape_base64(segment)
+            usable = len(encoded) - len(encoded) % 4 if end < 0 else len(encoded)
+            encoded_tail = encoded[usable:]
+            try:
+                image += base64.b64decode(encoded[:usable], validate=True)
+            except binascii.Error:
+                raise IngestError('Invalid image data')
+
+            if max_bytes is not None and len(image) > max_bytes:
+                raise IngestError('File too large', 413)
+            if not checked and (len(image) >= HEADER_BYTES or end >= 0):
+                checked = True
+                if sniff_image(bytes(image[:HEADER_BYTES])) is None:
+                    raise IngestError('Not a supported image file')
+            if end >= 0:
+                return prefix.decode('ascii'), image
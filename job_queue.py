@@ -0,0 +1,261 @@
+"""
+Persistent asynchronous prediction jobs for the Malaria Detection System.
+
+A job is a set of images submitted in one go. Submitting returns a job ID
+straight away; the images are stored in a local SQLite database and a pool
+of worker threads claims them in batches, runs them through the model and
+stores the results. Because all state lives in the database, a restart
+loses nothing. A claimed item carries its worker's lease, which that
+process renews while it runs; items whose lease has expired (their worker
+died) go back in the queue, while items another live worker holds are left
+alone, so several web workers can share one database.
+"""
+
+import functools
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+import numpy as np
+
+from inference import interpret_probability
+from pipeline import decode_source
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    created REAL NOT NULL,
+    updated REAL NOT NULL,
+    total INTEGER NOT NULL,
+    done INTEGER NOT NULL DEFAULT 0,
+    failed INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS items (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    job_id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    image BLOB,
+    status TEXT NOT NULL,
+    result TEXT,
+    owner TEXT,
+    lease_expires REAL
+);
+CREATE INDEX IF NOT EXISTS items_pending ON items (status, seq);
+CREATE INDEX IF NOT EXISTS items_job ON items (job_id, position);
+"""
+
+
+class JobQueue:
+    """SQLite-backed job store plus the worker threads that process it"""
+
+    def __init__(self, db_path='jobs.sqlite3', batch_size=32, workers=2, poll_interval=1.0, lease_seconds=60.0):
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.lease_seconds = lease_seconds
+        # Names this process's claims; its leases are renewed while it lives
+        self.owner = f'{os.getpid()}-{uuid.uuid4().hex[:8]}'
+
+        self._local = threading.local()
+        self._claim_lock = threading.Lock()
+        self._held = set()  # seqs of the items this process is working on
+        self._held_lock = threading.Lock()
+        self._wakeup = threading.Condition()
+        self._threads = []
+
+        db = self._db()
+        db.executescript(SCHEMA)
+        # Databases from before leases: running items without one count as expired
+        columns = {row['name'] for row in db.execute('PRAGMA table_info(items)')}
+        for column, kind in (('owner', 'TEXT'), ('lease_expires', 'REAL')):
+            if column not in columns:
+                db.execute(f'ALTER TABLE items ADD COLUMN {column} {kind}')
+        db.commit()
+
+    def _db(self):
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.db_path, timeout=30)
+            db.row_factory = sqlite3.Row
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self._local.db = db
+        return db
+
+    def submit(self, images):
+        """Store a job of ``(name, image bytes)`` pairs and return its ID"""
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        db = self._db()
+        with db:
+            db.execute('INSERT INTO jobs (id, status, created, updated, total) VALUES (?, ?, ?, ?, ?)',
+                       (job_id, 'queued', now, now, 0))
+            total = 0
+            for position, (name, image_bytes) in enumerate(images):
+                db.execute("INSERT INTO items (job_id, position, name, image, status) VALUES (?, ?, ?, ?, 'pending')",
+                           (job_id, position, name, image_bytes))
+                total += 1
+            status = 'queued' if total else 'done'
+            db.execute('UPDATE jobs SET total = ?, status = ? WHERE id = ?', (total, status, job_id))
+
+        with self._wakeup:
+            self._wakeup.notify_all()
+        return job_id
+
+    def get(self, job_id):
+        """Return the status and progress of a job, or None if it does not exist"""
+        row = self._db().execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job['progress'] = round((job['done'] + job['failed']) / job['total'], 4) if job['total'] else 1.0
+        return job
+
+    def results(self, job_id):
+        """Return the per-image results of a job, in submission order"""
+        rows = self._db().execute(
+            'SELECT name, status, result FROM items WHERE job_id = ? ORDER BY position', (job_id,)
+        ).fetchall()
+        results = []
+        for row in rows:
+            entry = {'filename': row['name'], 'status': row['status']}
+            if row['result']:
+                entry.update(json.loads(row['result']))
+            results.append(entry)
+        return results
+
+    def start(self, predict_batch, input_dtype=np.float32, decode_stage=None):
+        """Start the worker threads once the model is ready
+
+        Images are decoded on ``decode_stage`` (pipeline.DecodeStage) when
+        given, else on the worker thread itself.
+        """
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._work, args=(predict_batch, input_dtype, decode_stage),
+                                      name=f'job-worker-{index}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        thread = threading.Thread(target=self._heartbeat, name='job-heartbeat', daemon=True)
+        thread.start()
+        self._threads.append(thread)
+
+    def _heartbeat(self):
+        # Renew the leases of the items being worked on well before they run out
+        while True:
+            time.sleep(self.lease_seconds / 3)
+            with self._held_lock:
+                held = list(self._held)
+            if not held:
+                continue
+            try:
+                db = self._db()
+                with db:
+                    expires = time.time() + self.lease_seconds
+                    db.executemany("UPDATE items SET lease_expires = ? WHERE seq = ? AND owner = ? AND status = 'running'",
+                                   [(expires, seq, self.owner) for seq in held])
+            except sqlite3.Error as e:
+                print(f"Job lease renewal failed: {e}")
+
+    def _claim(self):
+        # One claimer at a time so two workers never take the same items; the
+        # IMMEDIATE transaction extends that to workers in other processes
+        with self._claim_lock:
+            db = self._db()
+            with db:
+                db.execute('BEGIN IMMEDIATE')
+                now = time.time()
+                # Items whose worker stopped renewing its lease go back in the queue
+                db.execute("UPDATE items SET status = 'pending', owner = NULL "
+                           "WHERE status = 'running' AND (lease_expires IS NULL OR lease_expires < ?)", (now,))
+                rows = db.execute(
+                    "SELECT seq, job_id, image FROM items WHERE status = 'pending' ORDER BY seq LIMIT ?",
+                    (self.batch_size,)
+                ).fetchall()
+                if rows:
+                    db.executemany("UPDATE items SET status = 'running', owner = ?, lease_expires = ? WHERE seq = ?",
+                                   [(self.owner, now + self.lease_seconds, row['seq']) for row in rows])
+                    db.executemany("UPDATE jobs SET status = 'running', updated = ? WHERE id = ? AND status = 'queued'",
+                                   [(time.time(), job_id) for job_id in {row['job_id'] for row in rows}])
+            return rows
+
+    def _work(self, predict_batch, input_dtype, decode_stage=None):
+        failures = 0
+        while True:
+            rows = []
+            try:
+                rows = self._claim()
+                if rows:
+                    with self._held_lock:
+                        self._held.update(row['seq'] for row in rows)
+                    self._process(rows, predict_batch, input_dtype, decode_stage)
+                failures = 0
+            except Exception as e:
+                # e.g. "database is locked" under several processes. The claimed items are
+                # no longer renewed, so once their lease runs out any worker retries them.
+                failures += 1
+                delay = min(30.0, self.poll_interval * 2 ** min(failures, 5))
+                print(f"Job worker error (retrying in {delay:.1f}s): {e}")
+                time.sleep(delay)
+                continue
+            finally:
+                with self._held_lock:
+                    self._held.difference_update(row['seq'] for row in rows)
+            if not rows:
+                with self._wakeup:
+                    self._wakeup.wait(self.poll_interval)
+
+    def _process(self, rows, predict_batch, input_dtype, decode_stage=None):
+        """Predict one claimed batch and record the outcomes"""
+
+        outcomes = {}
+        decoded = []
+        if decode_stage is not None:
+            pending = [(row['seq'], decode_stage.submit(decode_source, row['image'], input_dtype, timeout=None).result)
+                       for row in rows]
+        else:
+            pending = [(row['seq'], functools.partial(decode_source, row['image'], input_dtype)) for row in rows]
+        for seq, decode in pending:
+            try:
+                decoded.append((seq, decode()))
+            except Exception as e:
+                outcomes[seq] = ('failed', {'error': f'Failed to process image: {e}'})
+
+        if decoded:
+            try:
+                probabilities = predict_batch(np.stack([pixels for _, pixels in decoded]))
+                for (seq, _), probability in zip(decoded, probabilities):
+                    outcomes[seq] = ('done', interpret_probability(float(probability)))
+            except Exception as e:
+                for seq, _ in decoded:
+                    outcomes[seq] = ('failed', {'error': f'Prediction error: {e}'})
+
+        self._record(rows, outcomes)
+
+    def _record(self, rows, outcomes):
+        db = self._db()
+        counts = {}
+        with db:
+            for row in rows:
+                status, result = outcomes[row['seq']]
+                # The image is no longer needed once it has a result. Items another
+                # worker already finished are skipped so they are not counted twice.
+                updated = db.execute(
+                    "UPDATE items SET status = ?, result = ?, image = NULL WHERE seq = ? AND status = 'running'",
+                    (status, json.dumps(result), row['seq'])
+                ).rowcount
+                if not updated:
+                    continue
+                done, failed = counts.get(row['job_id'], (0, 0))
+                counts[row['job_id']] = (done + (status == 'done'), failed + (status == 'failed'))
+
+            now = time.time()
+            for job_id, (done, failed) in counts.items():
+                db.execute('UPDATE jobs SET done = done + ?, failed = failed + ?, updated = ? WHERE id = ?',
+                           (done, failed, now, job_id))
+                db.execute("UPDATE jobs SET status = 'done' WHERE id = ? AND done + failed >= total", (job_id,))
@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+"""
+HTTP load generator for the Malaria Detection System web apps.
+
+Replays a weighted mix of requests against a running server at a fixed
+target rate and reports throughput, error rate and a latency histogram per
+route. Requests are sent open-loop: each one is scheduled at its arrival
+time whether or not earlier ones have finished, and latency is measured
+from that scheduled time, so a slow server cannot hide its queueing delay.
+
+Run the server with the stub model so only the request path is measured:
+
+    MODEL_BACKEND=stub STUB_COST_MS=20 python app.py
+    python loadtest.py http://localhost:5001 --rps 50 --duration 60
+
+The default mix is 50% /upload, 30% /predict_sample and 20% /sample_images;
+change it with e.g. ``--mix upload=1,predict_sample=1``.
+
+Every upload changes one pixel of an image from the pool, so uploads miss the
+server's prediction cache and reach the model; ``--repeat-images`` sends the
+pool unchanged instead. The server's cache hit rate over the run is reported
+alongside the latencies.
+"""
+
+import io
+import json
+import os
+import random
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from pipeline import iter_image_files
+
+DEFAULT_MIX = {'upload': 0.5, 'predict_sample': 0.3, 'sample_images': 0.2}
+
+# Histogram bucket upper bounds in milliseconds
+BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+def load_upload_images(root='cell_images', count=64, seed=0):
+    """Encoded images to upload: a fixed sample of root, or synthetic PNGs"""
+    rng = random.Random(seed)
+    files = [path for _, path in iter_image_files(root)] if os.path.isdir(root) else []
+    if files:
+        images = []
+        for path in rng.sample(files, min(count, len(files))):
+            with open(path, 'rb') as f:
+                images.append((os.path.basename(path), f.read()))
+        return images
+
+    pixels = np.random.default_rng(seed)
+    images = []
+    for index in range(count):
+        size = rng.randint(100, 160)
+        buffer = io.BytesIO()
+        Image.fromarray(pixels.integers(0, 256, (size, size, 3), dtype=np.uint8)).save(buffer, format='PNG')
+        images.append((f'synthetic_{index}.png', buffer.getvalue()))
+    return images
+
+
+def perturbed_png(pixels, index):
+    """PNG of pixels with one pixel changed, a different one for each index"""
+    pixels = pixels.copy()
+    row, column = divmod(index % (pixels.shape[0] * pixels.shape[1]), pixels.shape[1])
+    pixels[row, column] += 128
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def encode_multipart(field, filename, data, content_type='image/png'):
+    """Build a multipart/form-data body holding one file"""
+    boundary = uuid.uuid4().hex
+    body = (f'--{boundary}\r\nContent-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'
+            f'Content-Type: {content_type}\r\n\r\n').encode() + data + f'\r\n--{boundary}--\r\n'.encode()
+    return body, f'multipart/form-data; boundary={boundary}'
+
+
+class RouteStats:
+    """Latency samples and outcome counts for one route"""
+
+    def __init__(self):
+        self.latencies_ms = []
+        self.errors = 0
+        self.status_counts = {}
+
+    def record(self, latency_ms, status, ok):
+        self.latencies_ms.append(latency_ms)
+        self.status_counts[str(status)] = self.status_counts.get(str(status), 0) + 1
+        if not ok:
+            self.errors += 1
+
+    def summary(self, elapsed):
+        count = len(self.latencies_ms)
+        summary = {
+            'requests': count,
+            'errors': self.errors,
+            'error_rate': round(self.errors / count, 4) if count else 0.0,
+            'throughput_rps': round(count / elapsed, 2) if elapsed else 0.0,
+            'status_counts': self.status_counts,
+        }
+        if count:
+            latencies = np.array(self.latencies_ms)
+            summary.update({f'p{q}_ms': round(float(np.percentile(latencies, q)), 2) for q in (50, 95, 99)})
+            summary['max_ms'] = round(float(latencies.max()), 2)
+            counts, _ = np.histogram(latencies, bins=(0,) + BUCKETS_MS + (float('inf'),))
+            summary['histogram_ms'] = {f'<={bound}': int(n) for bound, n in zip(BUCKETS_MS, counts)}
+            summary['histogram_ms'][f'>{BUCKETS_MS[-1]}'] = int(counts[-1])
+        return summary
+
+
+class LoadTest:
+    """Send a weighted request mix to base_url at a fixed rate"""
+
+    def __init__(self, base_url, mix=None, images=None, timeout=30.0, seed=0, repeat_images=False):
+        self.base_url = base_url.rstrip('/')
+        self.mix = mix or DEFAULT_MIX
+        self.images = images or load_upload_images()
+        self.timeout = timeout
+        self.repeat_images = repeat_images
+        self._pixels = {}
+        self._uploads = 0
+        self.rng = random.Random(seed)
+        self.sample_ids = []
+        self.etag = None
+        self.stats = {route: RouteStats() for route in self.mix}
+        self._lock = threading.Lock()
+
+    def _request(self, path, data=None, headers=None):
+        request = urllib.request.Request(self.base_url + path, data=data, headers=headers or {})
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return response.status, response.read(), response.headers
+        except urllib.error.HTTPError as e:
+            return e.code, e.read(), e.headers
+
+    def cache_stats(self):
+        """Prediction cache counters of the server, or None when it has no cache"""
+        try:
+            status, body, _ = self._request('/cache_metrics')
+        except (urllib.error.URLError, OSError):
+            return None
+        stats = json.loads(body) if status == 200 else {}
+        return stats if 'hits' in stats else None
+
+    def discover_samples(self):
+        """Fetch the sample IDs that /predict_sample requests will use"""
+        status, body, headers = self._request('/sample_images')
+        if status == 200:
+            self.sample_ids = [sample['id'] for sample in json.loads(body)]
+            self.etag = headers.get('ETag')
+
+    def build_request(self, route):
+        """Return (path, body, headers) for one request of route"""
+        if route == 'upload':
+            filename, data = self.rng.choice(self.images)
+            if not self.repeat_images:
+                # A pixel no earlier upload changed: a cache miss on the server
+                if filename not in self._pixels:
+                    self._pixels[filename] = np.array(Image.open(io.BytesIO(data)).convert('RGB'))
+                data = perturbed_png(self._pixels[filename], self._uploads)
+                filename = os.path.splitext(filename)[0] + '.png'
+                self._uploads += 1
+            body, content_type = encode_multipart('file', filename, data)
+            return '/upload', body, {'Content-Type': content_type}
+        if route == 'predict_sample':
+            if not self.sample_ids:
+                raise RuntimeError('no sample images on the server')
+            body = json.dumps({'sample_id': self.rng.choice(self.sample_ids)}).encode()
+            return '/predict_sample', body, {'Content-Type': 'application/json'}
+        if route == 'sample_images':
+            # Half the gallery loads come from browsers that already have the index
+            if self.etag and self.rng.random() < 0.5:
+                return '/sample_images', None, {'If-None-Match': self.etag}
+            return '/sample_images', None, {}
+        raise ValueError(f'Unknown route {route!r}')
+
+    def _send(self, route, request, scheduled):
+        path, body, headers = request
+        try:
+            status, payload, _ = self._request(path, body, headers)
+            ok = status in (200, 304)
+            # The prediction routes report failures in a 200 JSON body
+            if ok and status == 200 and route != 'sample_images':
+                ok = 'error' not in json.loads(payload)
+        except Exception:
+            status, ok = 'exception', False
+        latency_ms = (time.perf_counter() - scheduled) * 1000
+        with self._lock:
+            self.stats[route].record(latency_ms, status, ok)
+
+    def run(self, rps, duration, max_in_flight=256):
+        """Send requests for duration seconds and return the report"""
+        if 'predict_sample' in self.mix or 'sample_images' in self.mix:
+            self.discover_samples()
+        routes = list(self.mix)
+        if 'predict_sample' in routes and not self.sample_ids:
+            print("No sample images on the server; leaving predict_sample out of the mix")
+            routes.remove('predict_sample')
+            del self.stats['predict_sample']
+        if not routes:
+            raise ValueError('No routes left in the request mix')
+
+        weights = [self.mix[route] for route in routes]
+        total = int(rps * duration)
+        cache_before = self.cache_stats()
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=max_in_flight) as pool:
+            for index in range(total):
+                scheduled = started + index / rps
+                route = self.rng.choices(routes, weights)[0]
+                request = self.build_request(route)
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                pool.submit(self._send, route, request, scheduled)
+        elapsed = time.perf_counter() - started
+
+        report = {
+            'target_rps': rps,
+            'duration_seconds': round(elapsed, 2),
+            'routes': {route: stats.summary(elapsed) for route, stats in self.stats.items()},
+        }
+        all_requests = sum(s['requests'] for s in report['routes'].values())
+        all_errors = sum(s['errors'] for s in report['routes'].values())
+        report['total'] = {
+            'requests': all_requests,
+            'errors': all_errors,
+            'error_rate': round(all_errors / all_requests, 4) if all_requests else 0.0,
+            'throughput_rps': round(all_requests / elapsed, 2) if elapsed else 0.0,
+        }
+
+        # Counters are per server process: exact with one worker
+        cache_after = self.cache_stats()
+        report['server_cache'] = None
+        if cache_before is not None and cache_after is not None:
+            hits = (cache_after['hits'] + cache_after['disk_hits']) - (cache_before['hits'] + cache_before['disk_hits'])
+            misses = cache_after['misses'] - cache_before['misses']
+            report['server_cache'] = {
+                'hits': hits,
+                'misses': misses,
+                'hit_rate': round(hits / (hits + misses), 4) if hits + misses else 0.0,
+            }
+        return report
+
+
+def parse_mix(value):
+    """Parse "upload=0.5,predict_sample=0.3" into a weight dict"""
+    mix = {}
+    for part in value.split(','):
+        if part.strip():
+            route, _, weight = part.partition('=')
+            mix[route.strip()] = float(weight or 1)
+    return mix
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Load test the web app at a target request rate')
+    parser.add_argument('url', nargs='?', default='http://localhost:5001', help='Base URL of the server')
+    parser.add_argument('--rps', type=float, default=20, help='Target requests per second')
+    parser.add_argument('--duration', type=float, default=30, help='Seconds to send for')
+    parser.add_argument('--mix', type=parse_mix, default=DEFAULT_MIX,
+                        help='Route weights, e.g. upload=0.5,predict_sample=0.3,sample_images=0.2')
+    parser.add_argument('--data', default='cell_images', help='Images to upload (synthetic if missing)')
+    parser.add_argument('--timeout', type=float, default=30, help='Per-request timeout in seconds')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for the request mix')
+    parser.add_argument('--repeat-images', action='store_true',
+                        help='Upload the image pool unchanged, so repeats can hit the prediction cache')
+    parser.add_argument('--json', help='Also write the report to this file')
+
+    args = parser.parse_args()
+
+    test = LoadTest(args.url, args.mix, load_upload_images(args.data, seed=args.seed), args.timeout, args.seed,
+                    args.repeat_images)
+    try:
+        report = test.run(args.rps, args.duration)
+    except ValueError as e:
+        raise SystemExit(f"❌ {e}")
+
+    print(f"\n{'route':<16}{'reqs':>7}{'err %':>8}{'rps':>8}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+    for route, stats in report['routes'].items():
+        print(f"{route:<16}{stats['requests']:>7}{stats['error_rate'] * 100:>8.2f}{stats['throughput_rps']:>8}"
+              f"{stats.get('p50_ms', '-'):>9}{stats.get('p95_ms', '-'):>9}{stats.get('p99_ms', '-'):>9}")
+    total = report['total']
+    print(f"{'total':<16}{total['requests']:>7}{total['error_rate'] * 100:>8.2f}{total['throughput_rps']:>8}")
+    cache = report['server_cache']
+    if cache is None:
+        print("Server prediction cache: disabled or not reported")
+    else:
+        print(f"Server prediction cache: {cache['hits']} hits, {cache['misses']} misses "
+              f"(hit rate {cache['hit_rate']:.1%})")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
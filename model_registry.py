@@ -0,0 +1,236 @@
+"""
+Model registry for the Malaria Detection System.
+
+Finds the model artifact and works out how to load it once, then records
+that decision (and a traced serving function) under MODEL_CACHE_DIR so
+later starts go straight to the fastest loader:
+
+1. Sniff the artifact format (Keras v3 zip, HDF5 or SavedModel directory)
+   instead of trying loaders until one stops raising.
+2. Load Keras v3 files that lack the ``.keras`` suffix through a symlink
+   instead of copying the 224MB file.
+3. Export a traced ``tf.function`` as a SavedModel the first time; later
+   starts load that directly and skip rebuilding the Keras model.
+
+The cache is keyed by the artifact's path, size and mtime, so replacing the
+model file invalidates it.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+
+MODEL_CANDIDATES = ['my_model.keras copy', 'my_model.keras']
+CACHE_DIR = os.environ.get('MODEL_CACHE_DIR', '.model_cache')
+REGISTRY_FILE = 'registry.json'
+SERVING_DIR = 'serving'
+INPUT_SHAPE = (224, 224, 3)
+
+_ZIP_MAGIC = b'PK\x03\x04'
+_HDF5_MAGIC = b'\x89HDF\r\n\x1a\n'
+
+
+def parse_batch_sizes(value):
+    """Parse a comma separated list of batch sizes such as "1,8,32" """
+    return tuple(int(size) for size in str(value).split(',') if size.strip())
+
+
+def model_candidates():
+    """Return the artifact paths to look for, honouring MODEL_PATH"""
+    if os.environ.get('MODEL_PATH'):
+        return [os.environ['MODEL_PATH']]
+    return MODEL_CANDIDATES
+
+
+def model_version(record):
+    """Short identifier of the loaded artifact (MODEL_VERSION overrides it)"""
+    if os.environ.get('MODEL_VERSION'):
+        return os.environ['MODEL_VERSION']
+    fingerprint = json.dumps(record['artifact'], sort_keys=True).encode('utf-8')
+    return hashlib.sha256(fingerprint).hexdigest()[:16]
+
+
+def _fingerprint(path):
+    stat = os.stat(path)
+    return {'path': os.path.abspath(path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def detect_format(path):
+    """Work out the artifact format from its contents rather than its name"""
+    if os.path.isdir(path):
+        if os.path.exists(os.path.join(path, 'saved_model.pb')):
+            return 'saved_model'
+        raise ValueError(f"{path} is a directory without saved_model.pb")
+
+    with open(path, 'rb') as f:
+        header = f.read(8)
+    if header.startswith(_ZIP_MAGIC):
+        return 'keras_v3'
+    if header == _HDF5_MAGIC:
+        return 'h5'
+    raise ValueError(f"Unrecognised model format: {path}")
+
+
+def _read_registry(cache_dir):
+    try:
+        with open(os.path.join(cache_dir, REGISTRY_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_registry(cache_dir, record):
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, REGISTRY_FILE)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(record, f, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+def resolve_artifact(candidates=None, cache_dir=CACHE_DIR):
+    """Return the registry record for the first model artifact that exists
+
+    Reuses the cached record while the artifact is unchanged, so the format
+    is only sniffed once.
+    """
+    for path in candidates or model_candidates():
+        if not os.path.exists(path):
+            continue
+
+        fingerprint = _fingerprint(path)
+        record = _read_registry(cache_dir)
+        if record and record.get('artifact') == fingerprint:
+            return record
+
+        # New or changed artifact: forget everything derived from the old one
+        shutil.rmtree(os.path.join(cache_dir, SERVING_DIR), ignore_errors=True)
+        record = {'artifact': fingerprint, 'format': detect_format(path), 'loader': None}
+        _write_registry(cache_dir, record)
+        return record
+
+    raise FileNotFoundError(f"No model artifact found (looked for: {', '.join(candidates or model_candidates())})")
+
+
+def _keras_path(record, cache_dir):
+    """Give a Keras v3 file the .keras suffix Keras insists on, without copying it"""
+    path = record['artifact']['path']
+    if record['format'] != 'keras_v3' or path.endswith('.keras'):
+        return path
+
+    alias = os.path.join(cache_dir, 'model.keras')
+    if os.path.lexists(alias):
+        os.remove(alias)
+    try:
+        os.symlink(path, alias)
+    except OSError:
+        # No symlink support (e.g. Windows without privileges): fall back to a copy
+        shutil.copy(path, alias)
+    return alias
+
+
+class ServingFunction:
+    """Callable wrapper around the traced serving function restored from disk"""
+
+    def __init__(self, loaded):
+        self._loaded = loaded
+
+    def __call__(self, batch):
+        return self._loaded.serve(batch).numpy()
+
+
+def _load_serving(cache_dir):
+    import tensorflow as tf
+    return ServingFunction(tf.saved_model.load(os.path.join(cache_dir, SERVING_DIR)))
+
+
+def export_serving_function(model, cache_dir=CACHE_DIR):
+    """Trace the model into a tf.function and save it for the next cold start"""
+    import tensorflow as tf
+
+    record = _read_registry(cache_dir)
+    if record is None or not hasattr(model, 'predict_on_batch'):
+        return False
+
+    module = tf.Module()
+    module.model = model
+    module.serve = tf.function(
+        lambda batch: model(batch, training=False),
+        input_signature=[tf.TensorSpec((None,) + INPUT_SHAPE, tf.float32)],
+    )
+
+    export_dir = os.path.join(cache_dir, SERVING_DIR)
+    tmp_dir = export_dir + '.tmp'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    tf.saved_model.save(module, tmp_dir)
+    shutil.rmtree(export_dir, ignore_errors=True)
+    os.replace(tmp_dir, export_dir)
+
+    record['serving_cache'] = True
+    _write_registry(cache_dir, record)
+    return True
+
+
+def load_model(candidates=None, cache_dir=CACHE_DIR, use_serving_cache=None):
+    """Load the model with the loader recorded in the registry
+
+    Returns ``(model, record)``; ``record['load_seconds']`` holds the load
+    time and ``record['loader']`` which loader was used.
+    """
+    import tensorflow as tf
+
+    if use_serving_cache is None:
+        use_serving_cache = os.environ.get('MODEL_SERVING_CACHE', '1') == '1'
+
+    started = time.perf_counter()
+    record = resolve_artifact(candidates, cache_dir)
+
+    model = None
+    if use_serving_cache and record.get('serving_cache'):
+        try:
+            model = _load_serving(cache_dir)
+            loader = 'serving_cache'
+        except Exception as e:
+            print(f"Serving cache unusable, loading the artifact instead: {e}")
+            record['serving_cache'] = False
+            _write_registry(cache_dir, record)
+
+    if model is None:
+        if record['loader'] == 'tfsm_layer':
+            model = tf.keras.layers.TFSMLayer(record['artifact']['path'], call_endpoint='serving_default')
+            loader = 'tfsm_layer'
+        else:
+            try:
+                model = tf.keras.models.load_model(_keras_path(record, cache_dir), compile=False)
+                loader = 'keras'
+            except Exception:
+                if record['format'] != 'saved_model':
+                    raise
+                # Plain SavedModel without Keras metadata
+                model = tf.keras.layers.TFSMLayer(record['artifact']['path'], call_endpoint='serving_default')
+                loader = 'tfsm_layer'
+
+    if record['loader'] != loader and loader != 'serving_cache':
+        record['loader'] = loader
+        _write_registry(cache_dir, record)
+
+    record = dict(record, loader=loader, load_seconds=round(time.perf_counter() - started, 3))
+    print(f"Model loaded using {loader} in {record['load_seconds']}s")
+    return model, record
+
+
+def warmup(predict_fn, batch_sizes=(1, 8, 32), input_dtype=np.float32):
+    """Run one pass per batch size so graph tracing happens before serving
+
+    Returns the time taken per batch size in milliseconds.
+    """
+    timings = {}
+    for batch_size in batch_sizes:
+        batch = np.zeros((batch_size,) + INPUT_SHAPE, dtype=input_dtype)
+        started = time.perf_counter()
+        predict_fn(batch)
+        timings[str(batch_size)] = round((time.perf_counter() - started) * 1000, 1)
+    return timings
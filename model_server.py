@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+"""
+Model host process for the Malaria Detection System.
+
+Loads the model once and serves inference to any number of web workers
+over a local Unix socket, so memory stays at one copy of the weights no
+matter how many HTTP workers run. All workers share one MicroBatcher, so
+their requests are also batched together.
+
+Usage:
+    python model_server.py --socket /tmp/malaria-model.sock
+    MODEL_SERVER_SOCKET=/tmp/malaria-model.sock gunicorn -w 8 app:app
+
+Connections are authenticated with MODEL_SERVER_AUTHKEY when it is set.
+Otherwise the server generates a random key on every start and writes it
+next to the socket (``<socket>.key``, readable by its owner only), where
+web workers running as the same user read it.
+"""
+
+import os
+import queue
+import secrets
+import tempfile
+import threading
+from multiprocessing.connection import Client, Listener
+
+import numpy as np
+
+DEFAULT_SOCKET = '/tmp/malaria-model.sock'
+
+
+def key_path(address):
+    """Where the server writes its generated key for a socket address"""
+    return address + '.key'
+
+
+def _authkey(address):
+    """Key a client authenticates with: MODEL_SERVER_AUTHKEY, else the server's key file"""
+    if os.environ.get('MODEL_SERVER_AUTHKEY'):
+        return os.environ['MODEL_SERVER_AUTHKEY'].encode('utf-8')
+    try:
+        with open(key_path(address), 'rb') as f:
+            return f.read().strip()
+    except OSError as e:
+        raise OSError(f"No model server key at {key_path(address)} and MODEL_SERVER_AUTHKEY is not set: {e}") from e
+
+
+def _create_authkey(address):
+    """Key the server listens with: MODEL_SERVER_AUTHKEY, else a new random one saved for the clients"""
+    if os.environ.get('MODEL_SERVER_AUTHKEY'):
+        return os.environ['MODEL_SERVER_AUTHKEY'].encode('utf-8')
+    key = secrets.token_hex(32).encode('ascii')
+    # mkstemp creates the file with mode 0600, so the key is never readable by others
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(address)), prefix='.model-key-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(key)
+        os.replace(tmp, key_path(address))
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    return key
+
+
+class ModelServerClient:
+    """Talk to a model_server.py process with the same interface as MicroBatcher
+
+    Each thread keeps its own connection; images are sent as raw array bytes
+    with a small header rather than pickled.
+    """
+
+    def __init__(self, address=DEFAULT_SOCKET):
+        self.address = address
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # Read the key per connection: a restarted server writes a new one
+            conn = Client(self.address, family='AF_UNIX', authkey=_authkey(self.address))
+            self._local.conn = conn
+        return conn
+
+    def _request(self, message, payload=None):
+        # One retry on a fresh connection covers a restarted model server
+        for attempt in range(2):
+            conn = self._connection()
+            try:
+                conn.send(message)
+                if payload is not None:
+                    conn.send_bytes(payload)
+                return conn.recv()
+            except (EOFError, OSError):
+                self._local.conn = None
+                conn.close()
+                if attempt:
+                    raise
+
+    def predict(self, image, timeout=None):
+        """Send one preprocessed image to the model server and return its probability"""
+        image = np.ascontiguousarray(image)
+        status, value = self._request(('predict', image.shape, image.dtype.str), memoryview(image).cast('B'))
+        if status == 'busy':
+            raise queue.Full(value)
+        if status == 'error':
+            raise RuntimeError(value)
+        return value
+
+    def predict_batch(self, images, timeout=None):
+        """Send a stack of preprocessed images in one message and return their probabilities
+
+        On the server the images join the shared scheduler one by one.
+        """
+        return self._predict_stack('predict_batch', images)
+
+    def predict_pass(self, images):
+        """Run a stack of preprocessed images through one forward pass of their own
+
+        The server runs the stack as it is (taking turns with its scheduler)
+        rather than splitting it into queue items, for test-time augmentation
+        views that belong together.
+        """
+        return self._predict_stack('predict_pass', images)
+
+    def _predict_stack(self, kind, images):
+        images = np.ascontiguousarray(images)
+        status, value = self._request((kind, images.shape, images.dtype.str), memoryview(images).cast('B'))
+        if status == 'busy':
+            raise queue.Full(value)
+        if status == 'error':
+            raise RuntimeError(value)
+        return np.array(value, dtype=np.float32)
+
+    def info(self):
+        """Return details of the model the server is running, such as its version"""
+        status, value = self._request(('info',))
+        if status != 'ok':
+            raise RuntimeError(value)
+        return value
+
+    def stats(self):
+        """Return the batching statistics of the model server"""
+        status, value = self._request(('stats',))
+        if status != 'ok':
+            raise RuntimeError(value)
+        return value
+
+
+def handle_connection(conn, batcher, input_dtype, info, predict_pass=None):
+    """Answer requests from one web worker until it disconnects
+
+    ``predict_pass`` runs a 'predict_pass' stack in one forward pass; without
+    it such stacks go through the batcher like 'predict_batch'.
+    """
+    with conn:
+        while True:
+            try:
+                message = conn.recv()
+            except (EOFError, OSError):
+                return
+
+            if message[0] == 'stats':
+                conn.send(('ok', batcher.stats()))
+                continue
+            if message[0] == 'info':
+                conn.send(('ok', info))
+                continue
+
+            kind, shape, dtype = message
+            image = np.frombuffer(conn.recv_bytes(), dtype=np.dtype(dtype)).reshape(shape)
+            if image.dtype != input_dtype:
+                # Workers send uint8 pixels; scale them for a float model
+                image = image * np.float32(1.0 / 255.0)
+
+            try:
+                if kind == 'predict_pass' and predict_pass is not None:
+                    conn.send(('ok', np.asarray(predict_pass(image)).tolist()))
+                elif kind in ('predict_batch', 'predict_pass'):
+                    conn.send(('ok', batcher.predict_batch(image).tolist()))
+                else:
+                    conn.send(('ok', batcher.predict(image)))
+            except queue.Full:
+                conn.send(('busy', 'Server busy, please retry'))
+            except Exception as e:
+                conn.send(('error', str(e)))
+
+
+def serve(address, batcher, input_dtype, info=None, predict_pass=None):
+    """Accept web worker connections forever, one thread per connection"""
+    if os.path.exists(address):
+        os.remove(address)
+
+    with Listener(address, family='AF_UNIX', authkey=_create_authkey(address)) as listener:
+        os.chmod(address, 0o600)
+        print(f"✅ Model server listening on {address}")
+        while True:
+            try:
+                conn = listener.accept()
+            except Exception as e:
+                # A client that fails the handshake must not take the server down
+                print(f"Rejected connection: {e}")
+                continue
+            threading.Thread(target=handle_connection, args=(conn, batcher, input_dtype, info or {}, predict_pass),
+                             daemon=True).start()
+
+
+def main():
+    import argparse
+
+    from backends import BACKENDS, KerasBackend, load_backend
+    from inference import create_batcher
+    from model_registry import export_serving_function, parse_batch_sizes
+
+    parser = argparse.ArgumentParser(description='Malaria Detection System model server')
+    parser.add_argument('--socket', type=str, default=os.environ.get('MODEL_SERVER_SOCKET', DEFAULT_SOCKET),
+                        help='Unix socket path the web workers connect to')
+    parser.add_argument('--batch-size', type=int, default=int(os.environ.get('BATCH_MAX_SIZE', 32)),
+                        help='Largest batch sent through one forward pass')
+    parser.add_argument('--max-wait-ms', type=float, default=float(os.environ.get('BATCH_MAX_WAIT_MS', 5)),
+                        help='How long the first queued image waits for a batch to fill')
+    parser.add_argument('--max-queue', type=int, default=int(os.environ.get('BATCH_MAX_QUEUE', 256)),
+                        help='Queued images before requests are turned away')
+    parser.add_argument('--backend', choices=BACKENDS, default=os.environ.get('MODEL_BACKEND', 'keras'),
+                        help='Inference backend (see backends.py)')
+    parser.add_argument('--uint8-input', action='store_true', default=os.environ.get('UINT8_INPUT', '0') == '1',
+                        help='Fold input normalization into the model')
+    parser.add_argument('--cascade', default=os.environ.get('CASCADE_MODEL'),
+                        help='First-stage classifier (cascade.py) that answers confident images itself')
+    parser.add_argument('--warmup-batch-sizes', type=parse_batch_sizes,
+                        default=os.environ.get('WARMUP_BATCH_SIZES', '1,8,32'),
+                        help='Comma separated batch sizes to run before accepting connections')
+    # Images arrive decoded, so by default the model keeps every core
+    parser.add_argument('--intra-op-threads', type=int, default=int(os.environ.get('INTRA_OP_THREADS', 0)) or None,
+                        help='Threads for the ops of one forward pass (default: one per core)')
+    parser.add_argument('--inter-op-threads', type=int, default=int(os.environ.get('INTER_OP_THREADS', 0)) or None,
+                        help='Threads for running independent ops side by side')
+
+    args = parser.parse_args()
+
+    try:
+        backend, info = load_backend(args.backend, uint8_input=args.uint8_input,
+                                     num_threads=args.intra_op_threads, inter_op_threads=args.inter_op_threads)
+    except Exception as e:
+        raise SystemExit(f"❌ Model loading failed: {e}")
+
+    record = info.get('record', {})
+    if isinstance(backend, KerasBackend) and record.get('loader') == 'keras' and not record.get('serving_cache'):
+        export_serving_function(backend.raw_model)
+
+    if args.cascade:
+        from cascade import with_cascade
+        backend, info = with_cascade(backend, info, args.cascade, bucket_sizes=args.warmup_batch_sizes)
+
+    batcher = create_batcher(
+        backend,
+        warmup_batch_sizes=args.warmup_batch_sizes,
+        max_batch_size=args.batch_size,
+        max_wait_ms=args.max_wait_ms,
+        max_queue_size=args.max_queue,
+    )
+    # Test-time augmentation views run in one pass of their own, taking turns with the batcher
+    serve(args.socket, batcher, backend.input_dtype,
+          {'model_version': info['model_version'], 'loader': info['loader'], 'backend': info['backend']},
+          predict_pass=batcher.serialized(backend.predict_batch))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+"""
+Packed, memory-mapped copy of a class-labelled image tree.
+
+Opening tens of thousands of small PNGs one by one is slow on network
+storage. ``pack`` decodes every image once, resizes it to the model input
+size and writes the uint8 pixels into shards of ``.npy`` arrays:
+
+    cell_images.packed/
+        index.json          classes, image size, shard sizes
+        labels.npy          int class index per image
+        names.txt           source path of each image, one per line
+        shard-00000.npy     (N, 224, 224, 3) uint8
+        ...
+
+``PackedDataset`` memory-maps the shards, so opening is instant and
+batches of consecutive images are views into the page cache, not copies.
+
+Usage:
+    python packed_dataset.py pack cell_images cell_images.packed
+    python packed_dataset.py info cell_images.packed
+"""
+
+import json
+import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import repeat
+
+import numpy as np
+
+from pipeline import iter_image_files
+from preprocessing import TARGET_SIZE, fill_batch_slot
+
+FORMAT_VERSION = 1
+INDEX_FILE = 'index.json'
+SHARD_SIZE = 2048
+
+_SCALE = np.float32(1.0 / 255.0)
+
+
+def is_packed(path):
+    """Whether path is a directory written by pack_dataset"""
+    return os.path.isfile(os.path.join(path, INDEX_FILE))
+
+
+def _fill_slot(shard, index, source, target_size):
+    """Decode one image into its shard slot; returns the error message, or None"""
+    try:
+        fill_batch_slot(shard, index, source, target_size)
+        return None
+    except Exception as e:
+        return str(e)
+
+
+def pack_dataset(root, output, shard_size=SHARD_SIZE, target_size=TARGET_SIZE, workers=None):
+    """Pack every image under root into output; the first path component is the class
+
+    Images that fail to decode are skipped and listed in the returned
+    summary. The directory is written next to output and renamed into place
+    at the end, so a reader never sees a half-written dataset.
+    """
+    files = [(relpath, path) for relpath, path in iter_image_files(root) if os.sep in relpath]
+    classes = sorted({relpath.split(os.sep)[0] for relpath, _ in files})
+    class_index = {name: index for index, name in enumerate(classes)}
+
+    staging = output.rstrip(os.sep) + '.tmp'
+    shutil.rmtree(staging, ignore_errors=True)
+    os.makedirs(staging)
+
+    width, height = target_size
+    names, labels, shards, failed = [], [], [], []
+    workers = workers or min(32, (os.cpu_count() or 1) + 4)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for first in range(0, len(files), shard_size):
+            chunk = files[first:first + shard_size]
+            shard_name = f'shard-{len(shards):05d}.npy'
+            shard = np.lib.format.open_memmap(os.path.join(staging, shard_name), mode='w+',
+                                              dtype=np.uint8, shape=(len(chunk), height, width, 3))
+
+            # Failed slots are compacted away so the shard holds only good images
+            kept = 0
+            errors = pool.map(_fill_slot, repeat(shard), range(len(chunk)), [path for _, path in chunk],
+                              repeat(target_size))
+            for index, error in enumerate(errors):
+                relpath = chunk[index][0]
+                if error:
+                    failed.append((relpath, error))
+                    continue
+                if kept != index:
+                    shard[kept] = shard[index]
+                names.append(relpath)
+                labels.append(class_index[relpath.split(os.sep)[0]])
+                kept += 1
+            shard.flush()
+            del shard
+
+            if kept < len(chunk):
+                # Rewrite with the final length (np.save keeps the .npy header consistent)
+                path = os.path.join(staging, shard_name)
+                with open(path + '.tmp', 'wb') as f:
+                    np.save(f, np.load(path, mmap_mode='r')[:kept])
+                os.replace(path + '.tmp', path)
+            shards.append({'file': shard_name, 'count': kept})
+
+    np.save(os.path.join(staging, 'labels.npy'), np.array(labels, dtype=np.int16))
+    with open(os.path.join(staging, 'names.txt'), 'w') as f:
+        f.writelines(f'{name}\n' for name in names)
+    with open(os.path.join(staging, INDEX_FILE), 'w') as f:
+        json.dump({
+            'version': FORMAT_VERSION,
+            'source': os.path.abspath(root),
+            'created': time.time(),
+            'image_size': [height, width],
+            'classes': classes,
+            'count': len(names),
+            'shards': shards,
+        }, f, indent=2)
+
+    shutil.rmtree(output, ignore_errors=True)
+    os.replace(staging, output)
+    return {'count': len(names), 'classes': classes, 'shards': len(shards), 'failed': failed}
+
+
+class PackedDataset:
+    """Read-only, memory-mapped view of a packed dataset"""
+
+    def __init__(self, path):
+        with open(os.path.join(path, INDEX_FILE)) as f:
+            self.index = json.load(f)
+        if self.index.get('version') != FORMAT_VERSION:
+            raise ValueError(f"{path}: unsupported packed dataset version {self.index.get('version')}")
+
+        self.path = path
+        self.classes = self.index['classes']
+        self.labels = np.load(os.path.join(path, 'labels.npy'))
+        with open(os.path.join(path, 'names.txt')) as f:
+            self.names = f.read().splitlines()
+        self.shards = [np.load(os.path.join(path, shard['file']), mmap_mode='r') for shard in self.index['shards']]
+        self._offsets = np.cumsum([0] + [len(shard) for shard in self.shards])
+
+    def __len__(self):
+        return int(self._offsets[-1])
+
+    def _locate(self, index):
+        shard = int(np.searchsorted(self._offsets, index, side='right')) - 1
+        return shard, index - int(self._offsets[shard])
+
+    def __getitem__(self, index):
+        """(224, 224, 3) uint8 view of one image"""
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        shard, offset = self._locate(index)
+        return self.shards[shard][offset]
+
+    def take(self, indices, dtype=np.uint8, out=None):
+        """Gather arbitrary images into one batch (a copy, scaled to [0, 1] for float dtypes)"""
+        indices = list(indices)
+        if out is None:
+            out = np.empty((len(indices),) + self.shards[0].shape[1:], dtype=dtype)
+        for slot, index in enumerate(indices):
+            fill_batch_slot(out, slot, self[index])
+        return out[:len(indices)]
+
+    def iter_batches(self, batch_size=32, dtype=np.uint8, start=0, stop=None):
+        """Yield ``(pixels, labels, first index)`` for consecutive images
+
+        Batches never cross a shard boundary, so with ``dtype=np.uint8`` the
+        pixels are zero-copy views of the memory map. For float dtypes each
+        batch is scaled into one reused buffer; copy it to keep it.
+        """
+        stop = len(self) if stop is None else min(stop, len(self))
+        buffer = None
+        index = start
+        while index < stop:
+            shard, offset = self._locate(index)
+            count = min(batch_size, stop - index, len(self.shards[shard]) - offset)
+            pixels = self.shards[shard][offset:offset + count]
+            if dtype != np.uint8:
+                if buffer is None:
+                    buffer = np.empty((batch_size,) + pixels.shape[1:], dtype=dtype)
+                pixels = np.multiply(pixels, _SCALE, out=buffer[:count])
+            yield pixels, self.labels[index:index + count], index
+            index += count
+
+    def sample(self, per_class, seed=0, exclude=()):
+        """Pick up to per_class random indices of each class, skipping those in exclude"""
+        rng = np.random.default_rng(seed)
+        excluded = set(exclude)
+        picks = []
+        for label in range(len(self.classes)):
+            candidates = [int(i) for i in np.flatnonzero(self.labels == label) if int(i) not in excluded]
+            rng.shuffle(candidates)
+            picks += candidates[:per_class]
+        return picks
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Pack an image tree into memory-mappable shards')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    pack = commands.add_parser('pack', help='Pack a class-labelled image tree')
+    pack.add_argument('root', nargs='?', default='cell_images', help='Image tree, one folder per class')
+    pack.add_argument('output', nargs='?', help='Output directory (default: <root>.packed)')
+    pack.add_argument('--shard-size', type=int, default=SHARD_SIZE, help='Images per shard')
+    pack.add_argument('--workers', type=int, default=None, help='Decode threads (default: cores + 4)')
+
+    info = commands.add_parser('info', help='Describe a packed dataset')
+    info.add_argument('path', help='Packed dataset directory')
+
+    args = parser.parse_args()
+
+    if args.command == 'pack':
+        if not os.path.isdir(args.root):
+            raise SystemExit(f"❌ Directory not found: {args.root}")
+        output = args.output or args.root.rstrip(os.sep) + '.packed'
+        started = time.perf_counter()
+        summary = pack_dataset(args.root, output, args.shard_size, workers=args.workers)
+        print(f"✅ Packed {summary['count']} images ({', '.join(summary['classes'])}) into "
+              f"{summary['shards']} shards in {output} in {time.perf_counter() - started:.1f}s")
+        for relpath, error in summary['failed']:
+            print(f"   skipped {relpath}: {error}")
+    else:
+        dataset = PackedDataset(args.path)
+        counts = np.bincount(dataset.labels, minlength=len(dataset.classes))
+        print(f"{len(dataset)} images in {len(dataset.shards)} shards, "
+              f"{'x'.join(map(str, dataset.index['image_size']))} uint8")
+        for name, count in zip(dataset.classes, counts):
+            print(f"  {name}: {count}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,223 @@
+"""
+Overlapping decode / preprocess / inference pipeline for bulk prediction.
+
+Used by the /predict_batch endpoint and the batch_predict.py CLI. Three
+stages run at the same time so the model never waits on image decoding:
+
+1. A thread pool decodes and resizes images (Pillow releases the GIL).
+2. A producer thread collects decoded images, in order, into batches.
+3. An inference thread runs each batch through ``predict_batch`` while the
+   next batch is being decoded.
+
+Results are yielded in input order as each batch finishes.
+
+Passing a ``DecodeStage`` makes stage 1 use that shared pool instead of a
+pool of its own, so every route of the web app decodes on the same bounded
+set of threads.
+"""
+
+import functools
+import io
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+
+import numpy as np
+
+from preprocessing import preprocess_batch
+
+IMAGE_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'bmp'}
+
+_DONE = object()
+
+
+def is_image_file(filename):
+    """Whether filename has one of the supported image extensions"""
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in IMAGE_EXTENSIONS
+
+
+def iter_image_files(root):
+    """Yield (relative path, absolute path) of every image under root, in sorted order"""
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if is_image_file(filename):
+                path = os.path.join(dirpath, filename)
+                yield os.path.relpath(path, root), path
+
+
+def decode_source(source, dtype=np.float32):
+    """Preprocess one image into a (224, 224, 3) array of dtype
+
+    Sources may be paths, file objects, raw bytes or a callable returning bytes.
+    """
+    if callable(source):
+        source = source()
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        source = io.BytesIO(source)
+    return preprocess_batch([source], dtype=dtype)[0]
+
+
+def iter_batch_predictions(sources, predict_batch, batch_size=32, decode_workers=None,
+                           prefetch_batches=2, input_dtype=np.float32, decode_stage=None):
+    """Yield ``(name, probability, error)`` for each ``(name, source)`` in input order
+
+    ``predict_batch`` takes an (N, 224, 224, 3) array and returns N
+    probabilities. Images that fail to decode are reported with ``error``
+    set and never reach the model. Images are decoded on ``decode_stage``
+    when given, else on a pool of ``decode_workers`` threads.
+    """
+    decode_workers = decode_workers or min(32, (os.cpu_count() or 1) + 4)
+    batches = queue.Queue(maxsize=prefetch_batches)
+    results = queue.Queue(maxsize=prefetch_batches + 1)
+    stop = threading.Event()
+
+    def put(q, item):
+        # Give up quietly if the consumer went away
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            own_pool = ThreadPoolExecutor(max_workers=decode_workers) if decode_stage is None else nullcontext()
+            with own_pool as pool:
+                submit = pool.submit if decode_stage is None else functools.partial(decode_stage.submit, timeout=None)
+                pending = deque()
+                batch = []
+
+                def collect_one():
+                    name, future = pending.popleft()
+                    try:
+                        batch.append((name, future.result(), None))
+                    except Exception as e:
+                        batch.append((name, None, str(e)))
+
+                for name, source in sources:
+                    if stop.is_set():
+                        return
+                    pending.append((name, submit(decode_source, source, input_dtype)))
+                    # Bound the decoded-but-not-yet-batched images
+                    while len(pending) > batch_size * prefetch_batches:
+                        collect_one()
+                        if len(batch) == batch_size:
+                            if not put(batches, batch):
+                                return
+                            batch = []
+                while pending:
+                    collect_one()
+                    if len(batch) == batch_size:
+                        if not put(batches, batch):
+                            return
+                        batch = []
+                if batch:
+                    put(batches, batch)
+        except Exception as e:
+            put(batches, e)
+        finally:
+            put(batches, _DONE)
+
+    def infer():
+        while True:
+            batch = batches.get()
+            if batch is _DONE or isinstance(batch, Exception):
+                put(results, batch)
+                return
+
+            decoded = [(i, pixels) for i, (_, pixels, error) in enumerate(batch) if error is None]
+            probabilities = {}
+            batch_error = None
+            if decoded:
+                try:
+                    output = predict_batch(np.stack([pixels for _, pixels in decoded]))
+                    probabilities = {i: float(p) for (i, _), p in zip(decoded, output)}
+                except Exception as e:
+                    batch_error = f"Prediction error: {e}"
+
+            rows = [(name, probabilities.get(i), error or (batch_error if i not in probabilities else None))
+                    for i, (name, _, error) in enumerate(batch)]
+            if not put(results, rows):
+                return
+
+    threads = [threading.Thread(target=produce, name='pipeline-decode', daemon=True),
+               threading.Thread(target=infer, name='pipeline-infer', daemon=True)]
+    for thread in threads:
+        thread.start()
+
+    try:
+        while True:
+            rows = results.get()
+            if rows is _DONE:
+                return
+            if isinstance(rows, Exception):
+                raise rows
+            for row in rows:
+                yield row
+    finally:
+        stop.set()
+
+
+class DecodeStage:
+    """A fixed pool of decode threads shared by every route of the process
+
+    However many requests are open, decoding never uses more than
+    ``workers`` cores and the rest stay free for the model. At most
+    ``max_pending`` tasks are queued or running; ``submit`` waits up to
+    ``timeout`` seconds for a place and then raises ``queue.Full``, like a
+    full batcher queue. Bulk callers pass ``timeout=None`` to wait as long
+    as it takes.
+    """
+
+    def __init__(self, workers, max_pending=None, timeout=10):
+        self.workers = workers
+        self.max_pending = max_pending or 4 * workers
+        self.timeout = timeout
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='decode')
+        self._places = threading.BoundedSemaphore(self.max_pending)
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._decoded = 0
+        self._rejected = 0
+        self._decode_seconds = 0.0
+
+    def _run(self, fn, args):
+        started = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                self._pending -= 1
+                self._decoded += 1
+                self._decode_seconds += elapsed
+            self._places.release()
+
+    def submit(self, fn, *args, timeout=-1):
+        """Run ``fn(*args)`` on a decode thread and return its Future"""
+        timeout = self.timeout if timeout == -1 else timeout
+        if not self._places.acquire(timeout=timeout):
+            with self._lock:
+                self._rejected += 1
+            raise queue.Full
+        with self._lock:
+            self._pending += 1
+        return self._pool.submit(self._run, fn, args)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'max_pending': self.max_pending,
+                'pending': self._pending,
+                'decoded': self._decoded,
+                'rejected': self._rejected,
+                'mean_decode_ms': round(1000 * self._decode_seconds / self._decoded, 3) if self._decoded else None,
+            }
@@ -0,0 +1,94 @@
+"""
+Content-addressed prediction cache for the Malaria Detection System.
+
+Predictions are keyed by a SHA-256 of the preprocessed pixels plus the
+model version, so resubmitting the same image (under any file name, from
+any route) skips the forward pass, while a new model never sees stale
+results. Entries live in a bounded in-memory LRU and, optionally, in a
+SQLite file that survives restarts.
+"""
+
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+class PredictionCache:
+    """Bounded LRU of probabilities with an optional on-disk tier"""
+
+    def __init__(self, max_entries=4096, disk_path=None):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._db = None
+        if disk_path:
+            self._db = sqlite3.connect(disk_path, check_same_thread=False)
+            self._db.execute('CREATE TABLE IF NOT EXISTS predictions (key TEXT PRIMARY KEY, probability REAL)')
+            self._db.commit()
+
+    @staticmethod
+    def key(pixels, model_version):
+        """Hash the decoded pixels together with the model version"""
+        digest = hashlib.sha256(str(model_version).encode('utf-8'))
+        pixels = np.ascontiguousarray(pixels)
+        digest.update(f'{pixels.dtype.str}{pixels.shape}'.encode('utf-8'))
+        digest.update(memoryview(pixels).cast('B'))
+        return digest.hexdigest()
+
+    def get(self, key):
+        """Return the cached probability for key, or None on a miss"""
+        with self._lock:
+            probability = self._entries.get(key)
+            if probability is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return probability
+
+            if self._db is not None:
+                row = self._db.execute('SELECT probability FROM predictions WHERE key = ?', (key,)).fetchone()
+                if row is not None:
+                    self.disk_hits += 1
+                    self._remember(key, row[0])
+                    return row[0]
+
+            self.misses += 1
+            return None
+
+    def put(self, key, probability):
+        """Store a probability in memory and, if enabled, on disk"""
+        probability = float(probability)
+        with self._lock:
+            self._remember(key, probability)
+            if self._db is not None:
+                self._db.execute('INSERT OR REPLACE INTO predictions VALUES (?, ?)', (key, probability))
+                self._db.commit()
+
+    def _remember(self, key, probability):
+        self._entries[key] = probability
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self):
+        """Return hit/miss counters and current size"""
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': round((self.hits + self.disk_hits) / lookups, 4) if lookups else 0.0,
+                'disk_tier': self._db is not None,
+            }
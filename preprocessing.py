@@ -0,0 +1,99 @@
+"""
+Shared image preprocessing for the Malaria Detection System.
+
+Every entry point (both web apps and the test script) goes through this
+module so that decoding, resizing and normalisation are identical
+everywhere. Images are written straight into one contiguous
+(N, 224, 224, 3) buffer instead of building a float64 array per image.
+"""
+
+import numpy as np
+from PIL import Image
+
+TARGET_SIZE = (224, 224)
+
+# Fixed resampling filter (Pillow's default for resize) so results do not
+# drift with the Pillow version or the code path that produced the image
+RESAMPLE = Image.BICUBIC
+
+_SCALE = np.float32(1.0 / 255.0)
+
+
+def load_image(source, target_size=TARGET_SIZE):
+    """Decode an image (path or file object) into an RGB image of target_size"""
+    img = Image.open(source)
+
+    # JPEG only: let the decoder downscale by a power of two while decoding,
+    # never going below target_size. A no-op for other formats.
+    img.draft('RGB', target_size)
+
+    # Convert to RGB if necessary
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+
+    if img.size != tuple(target_size):
+        img = img.resize(target_size, RESAMPLE)
+    return img
+
+
+def allocate_batch(count, target_size=TARGET_SIZE, dtype=np.float32):
+    """Allocate an uninitialised, contiguous (count, H, W, 3) input buffer"""
+    width, height = target_size
+    return np.empty((count, height, width, 3), dtype=dtype)
+
+
+def fill_batch_slot(out, index, image, target_size=TARGET_SIZE):
+    """Decode one image into ``out[index]`` in place
+
+    ``image`` can be a path, a file object, a PIL image or an (H, W, 3) uint8
+    array. A float ``out`` buffer receives pixels scaled to [0, 1]; a uint8
+    buffer receives raw pixels for models that normalise internally.
+    """
+    if isinstance(image, Image.Image):
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        if image.size != tuple(target_size):
+            image = image.resize(target_size, RESAMPLE)
+    elif not isinstance(image, np.ndarray):
+        image = load_image(image, target_size)
+
+    pixels = np.asarray(image)
+    if out.dtype == np.uint8:
+        out[index] = pixels
+    else:
+        # One pass: uint8 * float32 scale, written straight into the slot
+        np.multiply(pixels, _SCALE, out=out[index])
+
+
+def preprocess_batch(images, out=None, target_size=TARGET_SIZE, dtype=np.float32):
+    """Preprocess N images into one (N, H, W, 3) buffer
+
+    Pass ``out`` to reuse a preallocated buffer (its first N slots are
+    filled); otherwise a new one of ``dtype`` is allocated. Use
+    ``dtype=np.uint8`` together with ``fold_normalization`` to keep the
+    buffer at a quarter of the size.
+    """
+    images = list(images)
+    if out is None:
+        out = allocate_batch(len(images), target_size, dtype)
+    for index, image in enumerate(images):
+        fill_batch_slot(out, index, image, target_size)
+    return out[:len(images)]
+
+
+def preprocess_image(image, target_size=TARGET_SIZE, dtype=np.float32):
+    """Preprocess image (a path or an in-memory file object) for model prediction"""
+    try:
+        return preprocess_batch([image], target_size=target_size, dtype=dtype)
+    except Exception as e:
+        print(f"Error preprocessing image: {e}")
+        return None
+
+
+def fold_normalization(model):
+    """Wrap a Keras model so it takes uint8 pixels and does the /255 itself"""
+    import tensorflow as tf
+
+    inputs = tf.keras.Input(shape=TARGET_SIZE[::-1] + (3,), dtype='uint8')
+    scaled = tf.keras.layers.Rescaling(1.0 / 255)(inputs)
+    return tf.keras.Model(inputs, model(scaled))
@@ -1,88 +1,248 @@
 #!/usr/bin/env python3
 """
-Script to reduce the cell images dataset to 70 images (35 parasitized + 35 uninfected)
-by randomly selecting images from the original dataset.
+Stratified sampling of the cell images dataset.
+
+Draws a reproducible, per-class sample from a class-labelled tree such as
+cell_images/ and materialises it as a new tree without touching or
+backing up the original:
+
+1. The sample is recorded in a manifest (source, seed, strategy and the
+   chosen files with their sizes) next to the output. Reruns with the same
+   settings reuse it, so the selection never changes under you.
+2. Files are hardlinked (free and instant on the same filesystem),
+   reflinked or copied by a thread pool. Each lands under a temporary name
+   and is renamed into place, and files that are already there are
+   skipped, so an interrupted run is resumed by running it again.
+
+Usage:
+    python reduce_dataset.py --per-class 35                  # the old 35 + 35 demo set
+    python reduce_dataset.py --total 5000 --output cell_images_5k
+    python reduce_dataset.py --fraction 0.1 --method copy
 """
 
+import errno
+import json
 import os
 import random
 import shutil
-from pathlib import Path
-
-def reduce_dataset():
-    """Reduce dataset to 70 randomly selected images"""
-    
-    # Source directories
-    parasitized_src = 'cell_images/Parasitized'
-    uninfected_src = 'cell_images/Uninfected'
-    
-    # Create backup of original data
-    backup_dir = 'cell_images_backup'
-    if not os.path.exists(backup_dir):
-        print("Creating backup of original dataset...")
-        shutil.copytree('cell_images', backup_dir)
-        print(f"✅ Backup created at: {backup_dir}")
-    
-    # Create new reduced dataset structure
-    reduced_dir = 'cell_images_reduced'
-    parasitized_dst = os.path.join(reduced_dir, 'Parasitized')
-    uninfected_dst = os.path.join(reduced_dir, 'Uninfected')
-    
-    # Remove existing reduced directory if it exists
-    if os.path.exists(reduced_dir):
-        shutil.rmtree(reduced_dir)
-    
-    # Create new directories
-    os.makedirs(parasitized_dst, exist_ok=True)
-    os.makedirs(uninfected_dst, exist_ok=True)
-    
-    # Randomly select 35 parasitized images
-    if os.path.exists(parasitized_src):
-        parasitized_files = [f for f in os.listdir(parasitized_src) if f.endswith('.png')]
-        selected_parasitized = random.sample(parasitized_files, min(35, len(parasitized_files)))
-        
-        print(f"Selecting {len(selected_parasitized)} parasitized images...")
-        for filename in selected_parasitized:
-            src_path = os.path.join(parasitized_src, filename)
-            dst_path = os.path.join(parasitized_dst, filename)
-            shutil.copy2(src_path, dst_path)
-        print(f"✅ Copied {len(selected_parasitized)} parasitized images")
-    
-    # Randomly select 35 uninfected images
-    if os.path.exists(uninfected_src):
-        uninfected_files = [f for f in os.listdir(uninfected_src) if f.endswith('.png')]
-        selected_uninfected = random.sample(uninfected_files, min(35, len(uninfected_files)))
-        
-        print(f"Selecting {len(selected_uninfected)} uninfected images...")
-        for filename in selected_uninfected:
-            src_path = os.path.join(uninfected_src, filename)
-            dst_path = os.path.join(uninfected_dst, filename)
-            shutil.copy2(src_path, dst_path)
-        print(f"✅ Copied {len(selected_uninfected)} uninfected images")
-    
-    # Replace original cell_images with reduced dataset
-    print("Replacing original dataset with reduced version...")
-    shutil.rmtree('cell_images')
-    shutil.move(reduced_dir, 'cell_images')
-    
-    # Print summary
-    parasitized_count = len(os.listdir('cell_images/Parasitized'))
-    uninfected_count = len(os.listdir('cell_images/Uninfected'))
-    total_count = parasitized_count + uninfected_count
-    
-    print("\n" + "="*50)
-    print("DATASET REDUCTION COMPLETE")
-    print("="*50)
-    print(f"✅ Total images: {total_count}")
-    print(f"✅ Parasitized: {parasitized_count}")
-    print(f"✅ Uninfected: {uninfected_count}")
-    print(f"✅ Original backup saved at: {backup_dir}")
-    print("="*50)
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from pipeline import iter_image_files
+
+MANIFEST_VERSION = 1
+METHODS = ('auto', 'hardlink', 'reflink', 'copy', 'symlink')
+
+# Linux ioctl that shares a file's extents with another (btrfs, XFS, ...)
+FICLONE = 0x40049409
+
+
+def list_classes(root):
+    """Map class name -> sorted relative paths of its images"""
+    classes = {}
+    for relpath, _ in iter_image_files(root):
+        if os.sep in relpath:
+            classes.setdefault(relpath.split(os.sep)[0], []).append(relpath)
+    return classes
+
+
+def allocate(class_sizes, per_class=None, total=None, fraction=None):
+    """How many images to draw from each class
+
+    ``per_class`` takes the same number from every class; ``total`` and
+    ``fraction`` keep the classes' proportions (largest remainder rounding).
+    """
+    if per_class is not None:
+        return {name: min(per_class, size) for name, size in class_sizes.items()}
+
+    available = sum(class_sizes.values())
+    wanted = min(available, total if total is not None else round(available * fraction))
+    exact = {name: wanted * size / available for name, size in class_sizes.items()} if available else {}
+    counts = {name: int(share) for name, share in exact.items()}
+    leftover = wanted - sum(counts.values())
+    for name in sorted(exact, key=lambda name: exact[name] - counts[name], reverse=True)[:leftover]:
+        counts[name] += 1
+    return counts
+
+
+def build_manifest(root, seed=42, per_class=None, total=None, fraction=None):
+    """Choose the sample and describe it"""
+    classes = list_classes(root)
+    counts = allocate({name: len(files) for name, files in classes.items()}, per_class, total, fraction)
+
+    rng = random.Random(seed)
+    items = []
+    for name in sorted(classes):
+        for relpath in sorted(rng.sample(classes[name], counts[name])):
+            items.append({'path': relpath, 'size': os.path.getsize(os.path.join(root, relpath))})
+
+    return {
+        'version': MANIFEST_VERSION,
+        'source': os.path.abspath(root),
+        'seed': seed,
+        'strategy': {'per_class': per_class, 'total': total, 'fraction': fraction},
+        'classes': dict(Counter(item['path'].split(os.sep)[0] for item in items)),
+        'items': items,
+    }
+
+
+def load_or_build_manifest(path, root, resample=False, **strategy):
+    """Reuse the manifest at path if it was made with the same settings, else build and save one"""
+    if os.path.exists(path) and not resample:
+        with open(path) as f:
+            manifest = json.load(f)
+        same = (manifest.get('version') == MANIFEST_VERSION
+                and manifest.get('source') == os.path.abspath(root)
+                and manifest.get('seed') == strategy.get('seed')
+                and manifest.get('strategy') == {key: strategy.get(key) for key in ('per_class', 'total', 'fraction')})
+        if not same:
+            raise SystemExit(f"❌ {path} was made with different settings; pass --resample to replace it")
+        return manifest, False
+
+    manifest = build_manifest(root, **strategy)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(path + '.tmp', path)
+    return manifest, True
+
+
+def _reflink(src, dst):
+    import fcntl
+
+    with open(src, 'rb') as source, open(dst, 'wb') as target:
+        fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+    shutil.copystat(src, dst)
+
+
+def place_file(src, dst, method='auto'):
+    """Put src at dst with the given method and return the method actually used
+
+    Writes to a temporary name first, so dst is either absent or complete.
+    ``auto`` tries a hardlink, then a reflink, then a plain copy.
+    """
+    tmp = f'{dst}.part-{os.getpid()}'
+    attempts = ('hardlink', 'reflink', 'copy') if method == 'auto' else (method,)
+    for attempt in attempts:
+        try:
+            if os.path.lexists(tmp):
+                os.remove(tmp)
+            if attempt == 'hardlink':
+                os.link(src, tmp)
+            elif attempt == 'reflink':
+                _reflink(src, tmp)
+            elif attempt == 'symlink':
+                os.symlink(os.path.abspath(src), tmp)
+            else:
+                shutil.copy2(src, tmp)
+            os.replace(tmp, dst)
+            return attempt
+        except OSError as e:
+            if os.path.lexists(tmp):
+                os.remove(tmp)
+            # Only fall through when the method is unsupported here, not on real errors
+            unsupported = e.errno in (errno.EXDEV, errno.EPERM, errno.EOPNOTSUPP, errno.ENOTTY,
+                                      errno.EINVAL, errno.EMLINK)
+            if attempt == attempts[-1] or not unsupported:
+                raise
+
+
+def _is_current(src, dst, size):
+    try:
+        if os.path.samefile(src, dst):
+            return True
+        return os.path.getsize(dst) == size and os.path.getsize(src) == size
+    except OSError:
+        return False
+
+
+def materialize(manifest, output, method='auto', workers=16, prune=False):
+    """Create every manifest file under output; return counts of what was done"""
+    root = manifest['source']
+    wanted = {item['path']: item['size'] for item in manifest['items']}
+    for directory in {os.path.dirname(path) for path in wanted}:
+        os.makedirs(os.path.join(output, directory), exist_ok=True)
+
+    def place(relpath):
+        src, dst = os.path.join(root, relpath), os.path.join(output, relpath)
+        if _is_current(src, dst, wanted[relpath]):
+            return 'skipped'
+        if not os.path.exists(src):
+            return 'missing'
+        return place_file(src, dst, method)
+
+    counts = Counter()
+    failed = []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {relpath: pool.submit(place, relpath) for relpath in wanted}
+        for relpath, future in futures.items():
+            try:
+                counts[future.result()] += 1
+            except OSError as e:
+                counts['failed'] += 1
+                failed.append((relpath, str(e)))
+
+    if prune:
+        # Remove images (and leftover temporary files) that are not in the manifest
+        for relpath, path in list(iter_image_files(output)):
+            if relpath not in wanted:
+                os.remove(path)
+                counts['pruned'] += 1
+        for dirpath, _, filenames in os.walk(output):
+            for filename in filenames:
+                if '.part-' in filename:
+                    os.remove(os.path.join(dirpath, filename))
+
+    return counts, failed
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Draw a stratified sample of a labelled image tree')
+    parser.add_argument('--source', default='cell_images', help='Image tree, one folder per class')
+    parser.add_argument('--output', default='cell_images_reduced', help='Where to create the sample')
+    size = parser.add_mutually_exclusive_group()
+    size.add_argument('--per-class', type=int, help='Images per class (default 35)')
+    size.add_argument('--total', type=int, help='Total images, split in the classes\' proportions')
+    size.add_argument('--fraction', type=float, help='Fraction of every class, e.g. 0.1')
+    parser.add_argument('--seed', type=int, default=42, help='Random seed for the selection')
+    parser.add_argument('--method', choices=METHODS, default='auto',
+                        help='How files are placed (auto: hardlink, else reflink, else copy)')
+    parser.add_argument('--workers', type=int, default=16, help='Parallel file operations')
+    parser.add_argument('--manifest', help='Manifest path (default: <output>.manifest.json)')
+    parser.add_argument('--resample', action='store_true', help='Draw a new sample even if a manifest exists')
+    parser.add_argument('--prune', action='store_true', help='Delete images in output that are not in the sample')
+    parser.add_argument('--manifest-only', action='store_true', help='Write the manifest but do not create files')
+
+    args = parser.parse_args()
+    if args.per_class is None and args.total is None and args.fraction is None:
+        args.per_class = 35
+
+    if not os.path.isdir(args.source):
+        raise SystemExit(f"❌ Directory not found: {args.source}")
+    if os.path.abspath(args.output) == os.path.abspath(args.source):
+        raise SystemExit("❌ --output must differ from --source; the source is never modified")
+
+    manifest_path = args.manifest or args.output.rstrip(os.sep) + '.manifest.json'
+    manifest, created = load_or_build_manifest(
+        manifest_path, args.source, resample=args.resample,
+        seed=args.seed, per_class=args.per_class, total=args.total, fraction=args.fraction)
+    summary = ', '.join(f'{name}: {count}' for name, count in sorted(manifest['classes'].items()))
+    print(f"{'Created' if created else 'Reusing'} manifest {manifest_path} ({len(manifest['items'])} images; {summary})")
+
+    if args.manifest_only:
+        return
+
+    started = time.perf_counter()
+    counts, failed = materialize(manifest, args.output, args.method, args.workers, args.prune)
+    done = ', '.join(f'{count} {what}' for what, count in sorted(counts.items()))
+    print(f"✅ {args.output}: {done} in {time.perf_counter() - started:.1f}s")
+    for relpath, error in failed[:20]:
+        print(f"   {relpath}: {error}")
+    if failed:
+        raise SystemExit(f"❌ {len(failed)} files failed; run again to retry them")
+
 
 if __name__ == "__main__":
-    # Set random seed for reproducible results
-    random.seed(42)
-    
-    print("Starting dataset reduction...")
-    reduce_dataset()
-    print("\nDataset reduction completed successfully!") 
\ No newline at end of file
+    main()
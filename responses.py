@@ -0,0 +1,108 @@
+"""
+Response formats for the prediction routes of the Malaria Detection System.
+
+The web page wants the full JSON answer, including the analysed image echoed
+back as ``image_data``. Machine clients only want the verdict, so the
+prediction routes negotiate one of three formats from the ``Accept`` header
+(or a ``?format=`` query parameter, which wins):
+
+    format    media type                           image echo  labels
+    json      application/json                     yes         "Parasitized (Malaria Positive)"
+    lean      application/vnd.malaria.lean+json    no          label code
+    msgpack   application/msgpack                  no          label code
+
+The compact formats replace the ``result`` string with a ``label`` code
+(``LABEL_CODES``: 1 = parasitized, 0 = uninfected, as in evaluate.py) and
+skip the base64 encoding of the image altogether. MessagePack needs the
+optional ``msgpack`` package and is only offered when it is installed.
+"""
+
+import json
+
+from flask import Response, jsonify
+
+from inference import PARASITIZED, UNINFECTED
+
+JSON = 'application/json'
+LEAN_JSON = 'application/vnd.malaria.lean+json'
+MSGPACK = 'application/msgpack'
+FORMATS = {'json': JSON, 'lean': LEAN_JSON, 'msgpack': MSGPACK}
+# Other names clients use for MessagePack
+_MSGPACK_ALIASES = ('application/x-msgpack', 'application/vnd.msgpack')
+
+LABEL_CODES = {PARASITIZED: 1, UNINFECTED: 0}
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class NotAcceptable(Exception):
+    """The client asked for a format this server cannot produce"""
+
+    def __init__(self, message, status=406):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+def negotiate(request):
+    """Return the media type to answer ``request`` with
+
+    Clients that accept anything (browsers send ``*/*``) get the full JSON.
+    Raises NotAcceptable for an unknown ``?format=`` or for MessagePack when
+    msgpack is not installed.
+    """
+    name = request.args.get('format')
+    if name is not None:
+        mimetype = FORMATS.get(name)
+        if mimetype is None:
+            raise NotAcceptable(f"Unknown format {name!r} (choose from: {', '.join(FORMATS)})")
+        if mimetype == MSGPACK and msgpack is None:
+            raise NotAcceptable("MessagePack responses need msgpack: pip install msgpack")
+        return mimetype
+
+    offers = [JSON, LEAN_JSON]
+    if msgpack is not None:
+        offers += [MSGPACK, *_MSGPACK_ALIASES]
+    mimetype = request.accept_mimetypes.best_match(offers, default=JSON)
+    return MSGPACK if mimetype in _MSGPACK_ALIASES else mimetype
+
+
+def wants_image(mimetype):
+    """Whether the response echoes the analysed image"""
+    return mimetype == JSON
+
+
+def compact(result):
+    """Drop the image echo and turn result strings into label codes, recursively"""
+    if isinstance(result, list):
+        return [compact(item) for item in result]
+    if not isinstance(result, dict):
+        return result
+    lean = {}
+    for key, value in result.items():
+        if key == 'image_data':
+            continue
+        if key == 'result' and value in LABEL_CODES:
+            lean['label'] = LABEL_CODES[value]
+        else:
+            lean[key] = compact(value)
+    return lean
+
+
+def render(result, mimetype, status=200, headers=None):
+    """Encode a prediction (or error) dict as ``mimetype``"""
+    if mimetype == JSON:
+        response = jsonify(result)
+    elif mimetype == LEAN_JSON:
+        response = Response(json.dumps(compact(result), separators=(',', ':')), mimetype=LEAN_JSON)
+    else:
+        # Single precision is plenty for percentages rounded to two decimals
+        response = Response(msgpack.packb(compact(result), use_single_float=True), mimetype=MSGPACK)
+    response.status_code = status
+    response.headers.update(headers or {})
+    # Caches must key on Accept, since the same URL has several representations
+    response.vary.add('Accept')
+    return response
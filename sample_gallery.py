@@ -0,0 +1,137 @@
+"""
+Precomputed sample gallery for the Malaria Detection System.
+
+The gallery index (which sample images to show, their thumbnails and their
+predictions) is built once and only rebuilt when one of the class
+directories changes, instead of listing directories and base64-encoding
+full-size images on every request. Thumbnails are written to a cache
+directory and served as static files; sample IDs change whenever the
+source file changes, so clients can cache them indefinitely.
+"""
+
+import hashlib
+import os
+import threading
+
+from PIL import Image
+
+SAMPLE_CLASSES = ('Parasitized', 'Uninfected')
+THUMBNAIL_SIZE = (128, 128)
+
+
+class SampleGallery:
+    """Index of sample images with cached thumbnails and predictions"""
+
+    def __init__(self, root='cell_images', cache_dir='.gallery_cache', per_class=5,
+                 thumbnail_size=THUMBNAIL_SIZE):
+        self.root = root
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.per_class = per_class
+        self.thumbnail_size = thumbnail_size
+
+        self._lock = threading.Lock()
+        self._dir_state = None
+        self._samples = []
+        self._by_id = {}
+
+    def _current_dir_state(self):
+        state = []
+        for sample_type in SAMPLE_CLASSES:
+            try:
+                state.append(os.stat(os.path.join(self.root, sample_type)).st_mtime_ns)
+            except OSError:
+                state.append(None)
+        return tuple(state)
+
+    def refresh(self):
+        """Rebuild the index if a class directory changed since the last build"""
+        state = self._current_dir_state()
+        if state == self._dir_state:
+            return False
+
+        with self._lock:
+            if state == self._dir_state:
+                return False
+            self._build()
+            self._dir_state = state
+            return True
+
+    def _build(self):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        samples = []
+        for sample_type in SAMPLE_CLASSES:
+            directory = os.path.join(self.root, sample_type)
+            if not os.path.exists(directory):
+                continue
+
+            filenames = sorted(f for f in os.listdir(directory) if f.endswith('.png'))[:self.per_class]
+            for filename in filenames:
+                path = os.path.join(directory, filename)
+                stat = os.stat(path)
+                sample_id = hashlib.sha1(
+                    f'{sample_type}/{filename}:{stat.st_size}:{stat.st_mtime_ns}'.encode('utf-8')
+                ).hexdigest()[:16]
+
+                # Unchanged samples keep their thumbnail and prediction
+                sample = self._by_id.get(sample_id)
+                if sample is None:
+                    try:
+                        self._write_thumbnail(path, sample_id)
+                    except Exception as e:
+                        print(f"Error creating thumbnail for {path}: {e}")
+                        continue
+                    sample = {
+                        'id': sample_id,
+                        'filename': filename,
+                        'type': sample_type,
+                        'path': path,
+                        'predictions': {},
+                    }
+                samples.append(sample)
+
+        self._samples = samples
+        self._by_id = {sample['id']: sample for sample in samples}
+
+    def _write_thumbnail(self, path, sample_id):
+        thumbnail_path = self.thumbnail_path(sample_id)
+        if os.path.exists(thumbnail_path):
+            return
+        img = Image.open(path)
+        img.draft('RGB', self.thumbnail_size)
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        img.thumbnail(self.thumbnail_size)
+        img.save(thumbnail_path + '.tmp', format='PNG', optimize=True)
+        os.replace(thumbnail_path + '.tmp', thumbnail_path)
+
+    def thumbnail_path(self, sample_id):
+        """Path of the cached thumbnail for a sample"""
+        return os.path.join(self.cache_dir, f'{sample_id}.png')
+
+    def samples(self):
+        """Return the current gallery entries"""
+        self.refresh()
+        return list(self._samples)
+
+    def get(self, sample_id):
+        """Return the gallery entry for sample_id, or None"""
+        self.refresh()
+        return self._by_id.get(sample_id)
+
+    def prediction(self, sample_id, model_version, predict):
+        """Return the stored prediction for a sample, computing it once per model version"""
+        sample = self.get(sample_id)
+        if sample is None:
+            return None
+
+        result = sample['predictions'].get(model_version)
+        if result is None:
+            result = predict(sample['path'])
+            if 'error' not in result:
+                sample['predictions'][model_version] = result
+        return dict(result)
+
+    def precompute(self, model_version, predict):
+        """Run every sample through the model so the first clicks are instant"""
+        for sample in self.samples():
+            self.prediction(sample['id'], model_version, predict)
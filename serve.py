@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""
+Production server entry point for the Malaria Detection System.
+
+Runs a web app under gunicorn (several processes of threads) or waitress
+(one process of threads, also works on Windows) instead of the Werkzeug
+development server. Everything is configurable through the environment,
+with command line flags taking precedence:
+
+    WEB_SERVER    auto, gunicorn or waitress (auto: gunicorn when installed, else waitress;
+                  without waitress the Flask development server is used, with a warning)
+    WEB_WORKERS   gunicorn worker processes (default 1; each loads its own model
+                  unless MODEL_SERVER_SOCKET points them at a shared model host)
+    WEB_THREADS   request threads per process (default 64)
+    HOST, PORT    listen address (default 0.0.0.0:5001)
+    WEB_TIMEOUT   seconds before gunicorn restarts a stuck worker (default 120)
+
+Usage:
+    python serve.py                       # app:app
+    python serve.py app_lightweight:app --server waitress --threads 16
+"""
+
+import importlib
+import os
+
+DEFAULTS = {
+    'WEB_SERVER': 'auto',
+    'WEB_WORKERS': '1',
+    'WEB_THREADS': '64',
+    'HOST': '0.0.0.0',
+    'PORT': '5001',
+    'WEB_TIMEOUT': '120',
+}
+
+
+def setting(name):
+    return os.environ.get(name, DEFAULTS[name])
+
+
+def import_app(target):
+    """Import "module:attribute" and return the WSGI app"""
+    module_name, _, attribute = target.partition(':')
+    return getattr(importlib.import_module(module_name), attribute or 'app')
+
+
+def pick_server(name):
+    if name != 'auto':
+        return name
+    try:
+        import gunicorn  # noqa: F401
+        return 'gunicorn'
+    except ImportError:
+        return 'waitress'
+
+
+def run_gunicorn(target, host, port, workers, threads, timeout):
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        raise SystemExit("❌ gunicorn is not installed: pip install gunicorn (or use --server waitress)")
+
+    class Application(BaseApplication):
+        def load_config(self):
+            self.cfg.set('bind', f'{host}:{port}')
+            self.cfg.set('workers', workers)
+            self.cfg.set('threads', threads)
+            self.cfg.set('worker_class', 'gthread')
+            self.cfg.set('timeout', timeout)
+            # Load the app in each worker, after the fork: TensorFlow and the
+            # startup thread must not be shared across processes
+            self.cfg.set('preload_app', False)
+
+        def load(self):
+            return import_app(target)
+
+    Application().run()
+
+
+def run_waitress(app, host, port, threads):
+    try:
+        from waitress import serve
+    except ImportError:
+        # Still serve, but say loudly that this is not the production server
+        print("⚠️ waitress is not installed (pip install -r requirements.txt); "
+              "falling back to the Flask development server")
+        app.run(host=host, port=int(port), threaded=True)
+        return
+
+    # Requests that find every thread busy wait in waitress's own queue; keep
+    # WEB_THREADS above MAX_IN_FLIGHT + ADMISSION_QUEUE so overload is answered
+    # by the admission gate rather than left waiting there
+    serve(app, host=host, port=int(port), threads=threads)
+
+
+def run(app):
+    """Serve an already imported app in this process (used by ``python app.py``)"""
+    if os.environ.get('FLASK_DEBUG') == '1':
+        app.run(debug=True, host=setting('HOST'), port=int(setting('PORT')))
+        return
+    if setting('WEB_SERVER') == 'gunicorn' or int(setting('WEB_WORKERS')) > 1:
+        print("Several worker processes need the serve.py entry point: python serve.py")
+    run_waitress(app, setting('HOST'), setting('PORT'), int(setting('WEB_THREADS')))
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Run the web app under a production server')
+    parser.add_argument('target', nargs='?', default='app:app', help='WSGI app as module:attribute')
+    parser.add_argument('--server', choices=('auto', 'gunicorn', 'waitress'), default=setting('WEB_SERVER'))
+    parser.add_argument('--workers', type=int, default=int(setting('WEB_WORKERS')), help='Processes (gunicorn)')
+    parser.add_argument('--threads', type=int, default=int(setting('WEB_THREADS')), help='Threads per process')
+    parser.add_argument('--host', default=setting('HOST'))
+    parser.add_argument('--port', type=int, default=int(setting('PORT')))
+    parser.add_argument('--timeout', type=int, default=int(setting('WEB_TIMEOUT')), help='Worker timeout (gunicorn)')
+
+    args = parser.parse_args()
+    server = pick_server(args.server)
+    print(f"Serving {args.target} with {server} on {args.host}:{args.port}")
+
+    if server == 'gunicorn':
+        run_gunicorn(args.target, args.host, args.port, args.workers, args.threads, args.timeout)
+    else:
+        if args.workers > 1:
+            print("waitress runs a single process; ignoring --workers")
+        run_waitress(import_app(args.target), args.host, args.port, args.threads)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,453 @@
+#!/usr/bin/env python3
+"""
+Whole-field (thin smear) analysis for the Malaria Detection System.
+
+The model classifies single cropped cells. This module finds the cells in
+a full microscope field, streams the crops through the classifier in
+batches and reports a parasitemia estimate with the position of every
+cell.
+
+The field is processed in horizontal strips, so only one strip (plus an
+overlap margin) is in memory at a time when the field is read in windows:
+``.npy`` arrays are always memory-mapped, uncompressed TIFFs are when
+``tifffile`` is installed, and otherwise only the TIFF strips or tiles a
+window covers are read, at the offsets the TIFF tags give. Other formats (PNG, JPEG, compressed
+TIFF without ``tifffile``) are decoded once by Pillow into a uint8 array,
+so callers should cap the field size with ``max_pixels``.
+
+Two ways to find cells:
+
+    segment  cells are darker than the bright background: threshold the
+             field (Otsu) and take each connected blob of cell size.
+             Pixels outside the blob are blacked out, like the training crops.
+    grid     cover the field with fixed, overlapping square tiles
+
+Usage:
+    python slide.py field.png --json summary.json --output cells.csv
+"""
+
+import csv
+import os
+
+import numpy as np
+from PIL import Image
+
+from inference import interpret_probability
+from pipeline import iter_batch_predictions
+
+# Typical cell diameter in the training images, in pixels
+CELL_SIZE = 130
+
+CELL_FIELDS = ['x', 'y', 'width', 'height', 'area', 'result', 'probability', 'confidence', 'error']
+
+
+class FieldTooLarge(ValueError):
+    """The field has more pixels than the caller allows"""
+
+
+class FieldReader:
+    """Row-strip access to an (H, W, C) field image, memory-mapped where possible"""
+
+    def __init__(self, pixels):
+        self.pixels = pixels
+        self.height, self.width = pixels.shape[:2]
+
+    def read_rows(self, top, bottom):
+        """Return rows [top, bottom) as an (h, W, 3) uint8 array"""
+        rows = np.asarray(self.pixels[top:bottom])
+        if rows.ndim == 2:
+            rows = np.repeat(rows[..., None], 3, axis=2)
+        rows = rows[..., :3]
+        if rows.dtype != np.uint8:
+            # 16-bit microscopy images: keep the top 8 bits
+            rows = (rows >> 8).astype(np.uint8) if rows.dtype == np.uint16 else rows.astype(np.uint8)
+        return rows
+
+
+# TIFF tags read by TiffStripReader
+_TAG_BITS_PER_SAMPLE = 258
+_TAG_COMPRESSION = 259
+_TAG_PHOTOMETRIC = 262
+_TAG_STRIP_OFFSETS = 273
+_TAG_SAMPLES_PER_PIXEL = 277
+_TAG_ROWS_PER_STRIP = 278
+_TAG_STRIP_BYTE_COUNTS = 279
+_TAG_PLANAR_CONFIGURATION = 284
+_TAG_TILE_WIDTH = 322
+_TAG_TILE_LENGTH = 323
+_TAG_TILE_OFFSETS = 324
+_TAG_TILE_BYTE_COUNTS = 325
+_TAG_SAMPLE_FORMAT = 339
+
+
+def _tag_values(tags, tag):
+    value = tags.get(tag)
+    return () if value is None else tuple(np.atleast_1d(value).tolist())
+
+
+class TiffStripReader(FieldReader):
+    """Row-strip access to an uncompressed TIFF, read straight from its strips or tiles
+
+    The position of every strip (or tile) comes from the TIFF tags, and a
+    window reads only its own rows from the strips or tiles that overlap it
+    (even when the whole image is one strip), so it costs its own rows
+    rather than the whole field.
+    """
+
+    def __init__(self, path, width, height, dtype, samples, chunks):
+        self.path = path
+        self.width, self.height = width, height
+        self.dtype = dtype
+        self.samples = samples
+        # (top, left, rows, columns, offset) of each strip or tile as stored
+        self.chunks = chunks
+
+    @classmethod
+    def from_image(cls, path, image):
+        """Reader for a TIFF opened by Pillow, or None when its pixels are not stored as plain rows"""
+        if image.format != 'TIFF':
+            return None
+        tags = image.tag_v2
+        samples = tags.get(_TAG_SAMPLES_PER_PIXEL, 1)
+        bits = set(_tag_values(tags, _TAG_BITS_PER_SAMPLE) or (1,))
+        photometric = tags.get(_TAG_PHOTOMETRIC)
+        # Uncompressed, interleaved, unsigned 8- or 16-bit grayscale or RGB(A)
+        if (tags.get(_TAG_COMPRESSION, 1) != 1 or tags.get(_TAG_PLANAR_CONFIGURATION, 1) != 1
+                or set(_tag_values(tags, _TAG_SAMPLE_FORMAT) or (1,)) != {1}
+                or bits not in ({8}, {16})
+                or not (photometric == 1 and samples == 1 or photometric == 2 and samples in (3, 4))):
+            return None
+        bits = bits.pop()
+
+        with open(path, 'rb') as f:
+            byte_order = '<' if f.read(2) == b'II' else '>'
+        dtype = np.dtype(f'{byte_order}u{bits // 8}')
+        width, height = image.size
+
+        if _TAG_TILE_OFFSETS in tags:
+            tile_width, tile_height = tags.get(_TAG_TILE_WIDTH), tags.get(_TAG_TILE_LENGTH)
+            offsets = _tag_values(tags, _TAG_TILE_OFFSETS)
+            byte_counts = _tag_values(tags, _TAG_TILE_BYTE_COUNTS)
+            across = -(-width // tile_width)
+            # Tiles are stored whole, padded past the right and bottom edges
+            chunks = [((index // across) * tile_height, (index % across) * tile_width, tile_height, tile_width, offset)
+                      for index, offset in enumerate(offsets)]
+        else:
+            rows_per_strip = min(tags.get(_TAG_ROWS_PER_STRIP, height), height)
+            offsets = _tag_values(tags, _TAG_STRIP_OFFSETS)
+            byte_counts = _tag_values(tags, _TAG_STRIP_BYTE_COUNTS)
+            # The last strip stops at the bottom of the image
+            chunks = [(index * rows_per_strip, 0, min(rows_per_strip, height - index * rows_per_strip), width, offset)
+                      for index, offset in enumerate(offsets)]
+
+        # Mismatched counts mean a layout this reader does not understand
+        if not chunks or len(byte_counts) != len(chunks) or any(
+                count < rows * columns * samples * dtype.itemsize
+                for (_, _, rows, columns, _), count in zip(chunks, byte_counts)):
+            return None
+        return cls(path, width, height, dtype, samples, chunks)
+
+    def read_rows(self, top, bottom):
+        rows = np.zeros((bottom - top, self.width, self.samples), dtype=self.dtype.newbyteorder('='))
+        with open(self.path, 'rb') as f:
+            for chunk_top, left, chunk_rows, chunk_columns, offset in self.chunks:
+                first, last = max(top, chunk_top), min(bottom, chunk_top + chunk_rows, self.height)
+                if first >= last:
+                    continue
+                row_bytes = chunk_columns * self.samples * self.dtype.itemsize
+                # Only the rows of the chunk inside the window are read
+                f.seek(offset + (first - chunk_top) * row_bytes)
+                block = np.frombuffer(f.read((last - first) * row_bytes), dtype=self.dtype)
+                block = block.reshape(last - first, chunk_columns, self.samples)
+                columns = min(chunk_columns, self.width - left)
+                rows[first - top:last - top, left:left + columns] = block[:, :columns]
+        return FieldReader(rows if self.samples > 1 else rows[..., 0]).read_rows(0, bottom - top)
+
+
+def _check_size(width, height, max_pixels):
+    if max_pixels is not None and width * height > max_pixels:
+        raise FieldTooLarge(f"Field of {width}x{height} pixels is larger than the limit of {max_pixels} pixels")
+
+
+def open_field(source, max_pixels=None):
+    """Open a field image from a path or file object
+
+    Raises FieldTooLarge, before any pixels are decoded, when the field has
+    more than ``max_pixels`` pixels.
+    """
+    if isinstance(source, (str, os.PathLike)):
+        path = os.fspath(source)
+        if path.lower().endswith('.npy'):
+            pixels = np.load(path, mmap_mode='r')
+            _check_size(pixels.shape[1], pixels.shape[0], max_pixels)
+            return FieldReader(pixels)
+        if path.lower().endswith(('.tif', '.tiff')):
+            try:
+                import tifffile
+                pixels = tifffile.memmap(path, mode='r')
+            except (ImportError, ValueError):
+                # Not installed, or compressed: fall back to Pillow
+                pass
+            else:
+                _check_size(pixels.shape[1], pixels.shape[0], max_pixels)
+                return FieldReader(pixels)
+
+    # Opening only reads the header, so the size is known before decoding
+    image = Image.open(source)
+    _check_size(image.width, image.height, max_pixels)
+    if isinstance(source, (str, os.PathLike)):
+        reader = TiffStripReader.from_image(os.fspath(source), image)
+        if reader is not None:
+            image.close()
+            return reader
+    if image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    return FieldReader(np.asarray(image))
+
+
+def grayscale(rows):
+    """Integer luminance of an (h, W, 3) uint8 array"""
+    return ((rows[..., 0].astype(np.uint16) * 77 + rows[..., 1].astype(np.uint16) * 150
+             + rows[..., 2].astype(np.uint16) * 29) >> 8).astype(np.uint8)
+
+
+def otsu_threshold(reader, strip_rows=512, max_strips=16):
+    """Otsu threshold of the field's luminance, from up to max_strips evenly spaced strips
+
+    Returns None for a field of a single luminance (blank or uniform), which
+    has nothing to separate.
+    """
+    histogram = np.zeros(256, dtype=np.int64)
+    tops = np.linspace(0, max(0, reader.height - strip_rows), num=max_strips).astype(int)
+    for top in sorted(set(tops.tolist())):
+        gray = grayscale(reader.read_rows(top, min(reader.height, top + strip_rows)))
+        histogram += np.bincount(gray.ravel(), minlength=256)
+
+    if np.count_nonzero(histogram) < 2:
+        return None
+
+    levels = np.arange(256)
+    weight_below = np.cumsum(histogram)
+    weight_above = weight_below[-1] - weight_below
+    sum_below = np.cumsum(histogram * levels)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_below = sum_below / weight_below
+        mean_above = (sum_below[-1] - sum_below) / weight_above
+        between = weight_below * weight_above * (mean_below - mean_above) ** 2
+    return int(np.nanargmax(between))
+
+
+def label_components(mask):
+    """8-connected components of a boolean mask, found from runs of set pixels
+
+    Returns a list of components, each a list of ``(row, start, end)`` runs.
+    Working on runs instead of pixels keeps this fast enough in numpy +
+    Python for cell-sized blobs.
+    """
+    padded = np.zeros((mask.shape[0], mask.shape[1] + 2), dtype=np.int8)
+    padded[:, 1:-1] = mask
+    edges = np.diff(padded, axis=1)
+    start_rows, starts = np.nonzero(edges == 1)
+    _, ends = np.nonzero(edges == -1)
+
+    parent = list(range(len(starts)))
+
+    def find(index):
+        while parent[index] != index:
+            parent[index] = parent[parent[index]]
+            index = parent[index]
+        return index
+
+    previous = []  # (start, end, index) runs of the row above
+    current = []
+    row = -1
+    for index, (y, start, end) in enumerate(zip(start_rows.tolist(), starts.tolist(), ends.tolist())):
+        if y != row:
+            previous = current if y == row + 1 else []
+            current = []
+            row = y
+        for p_start, p_end, p_index in previous:
+            # Runs touch, diagonals included
+            if p_start <= end and p_end >= start:
+                a, b = find(index), find(p_index)
+                if a != b:
+                    parent[max(a, b)] = min(a, b)
+        current.append((start, end, index))
+
+    components = {}
+    for index, run in enumerate(zip(start_rows.tolist(), starts.tolist(), ends.tolist())):
+        components.setdefault(find(index), []).append(run)
+    return list(components.values())
+
+
+def iter_segmented_cells(reader, threshold=None, min_area=None, max_area=None, strip_rows=1024, stats=None):
+    """Yield ``(box, crop)`` for every cell-sized dark blob in the field
+
+    Each strip is read with a margin above and below so a cell on a strip
+    boundary is seen whole; a cell belongs to the strip that holds the top
+    row of its bounding box, so it is reported exactly once.
+    """
+    threshold = otsu_threshold(reader) if threshold is None else threshold
+    min_area = min_area or int(0.15 * CELL_SIZE ** 2)
+    max_area = max_area or int(1.5 * CELL_SIZE ** 2)
+    margin = int(np.sqrt(max_area) * 2)
+    if stats is not None:
+        stats.update(threshold=threshold, clumps=0, specks=0)
+    if threshold is None:
+        # A uniform field has no blobs to find
+        return
+
+    for top in range(0, reader.height, strip_rows):
+        bottom = min(reader.height, top + strip_rows)
+        read_top, read_bottom = max(0, top - margin), min(reader.height, bottom + margin)
+        rows = reader.read_rows(read_top, read_bottom)
+        mask = grayscale(rows) <= threshold
+
+        for runs in label_components(mask):
+            y0 = min(y for y, _, _ in runs)
+            if not top <= read_top + y0 < bottom:
+                continue
+            area = sum(end - start for _, start, end in runs)
+            y1 = max(y for y, _, _ in runs) + 1
+            x0 = min(start for _, start, _ in runs)
+            x1 = max(end for _, _, end in runs)
+            touches_edge = ((y0 == 0 and read_top > 0) or (y1 == len(rows) and read_bottom < reader.height))
+            if area < min_area:
+                if stats is not None:
+                    stats['specks'] += 1
+                continue
+            if area > max_area or touches_edge:
+                # Overlapping cells or debris; a lone cell never gets this big
+                if stats is not None:
+                    stats['clumps'] += 1
+                continue
+
+            # Keep the cell and its pale centre: fill each row between its outermost set pixels
+            crop = np.zeros((y1 - y0, x1 - x0, 3), dtype=np.uint8)
+            extents = {}
+            for y, start, end in runs:
+                low, high = extents.get(y, (start, end))
+                extents[y] = (min(low, start), max(high, end))
+            for y, (start, end) in extents.items():
+                crop[y - y0, start - x0:end - x0] = rows[y, start:end]
+
+            box = {'x': x0, 'y': read_top + y0, 'width': x1 - x0, 'height': y1 - y0, 'area': area}
+            yield box, crop
+
+
+def iter_grid_cells(reader, tile_size=CELL_SIZE, stride=None):
+    """Yield ``(box, crop)`` for overlapping square tiles covering the field"""
+    stride = stride or tile_size // 2
+    for top in range(0, max(1, reader.height - tile_size + 1), stride):
+        rows = reader.read_rows(top, min(reader.height, top + tile_size))
+        for left in range(0, max(1, reader.width - tile_size + 1), stride):
+            crop = np.array(rows[:, left:left + tile_size])
+            box = {'x': left, 'y': top, 'width': crop.shape[1], 'height': crop.shape[0], 'area': None}
+            yield box, crop
+
+
+def analyze_field(reader, predict_batch, mode='segment', batch_size=32, input_dtype=np.float32,
+                  decode_workers=None, decode_stage=None, **options):
+    """Classify every cell in a field and estimate parasitemia
+
+    Returns a summary with the parasitized / uninfected counts, the
+    parasitemia (percent of classified cells that are parasitized) and one
+    entry per cell with its bounding box in field pixels.
+    """
+    stats = {}
+    if mode == 'segment':
+        candidates = iter_segmented_cells(reader, stats=stats, **options)
+    elif mode == 'grid':
+        candidates = iter_grid_cells(reader, **options)
+    else:
+        raise ValueError(f"Unknown mode {mode!r} (choose from: segment, grid)")
+
+    boxes = []
+
+    def sources():
+        for box, crop in candidates:
+            boxes.append(box)
+            yield len(boxes) - 1, Image.fromarray(crop)
+
+    cells = []
+    counts = {'parasitized': 0, 'uninfected': 0, 'failed': 0}
+    for index, probability, error in iter_batch_predictions(sources(), predict_batch, batch_size=batch_size,
+                                                             decode_workers=decode_workers, input_dtype=input_dtype,
+                                                             decode_stage=decode_stage):
+        cell = dict(boxes[index])
+        boxes[index] = None
+        if error:
+            cell['error'] = error
+            counts['failed'] += 1
+        else:
+            cell.update(interpret_probability(probability))
+            counts['parasitized' if cell['result'].startswith('Parasitized') else 'uninfected'] += 1
+        cells.append(cell)
+
+    classified = counts['parasitized'] + counts['uninfected']
+    summary = {
+        'width': reader.width,
+        'height': reader.height,
+        'mode': mode,
+        'cell_count': len(cells),
+        **counts,
+        'parasitemia_percent': round(100 * counts['parasitized'] / classified, 2) if classified else None,
+        **stats,
+        'cells': cells,
+    }
+    return summary
+
+
+def main():
+    import argparse
+    import json
+    import time
+
+    from backends import BACKENDS, load_backend
+
+    parser = argparse.ArgumentParser(description='Find and classify the cells in a full smear field')
+    parser.add_argument('field', help='Field image (.npy and uncompressed .tif are read in windows)')
+    parser.add_argument('--mode', choices=('segment', 'grid'), default='segment', help='How to find cells')
+    parser.add_argument('--threshold', type=int, help='Luminance at or below which a pixel is cell (default: Otsu)')
+    parser.add_argument('--min-area', type=int, help='Smallest blob taken as a cell, in pixels')
+    parser.add_argument('--max-area', type=int, help='Largest blob taken as a cell, in pixels')
+    parser.add_argument('--strip-rows', type=int, default=1024, help='Rows read at a time')
+    parser.add_argument('--batch-size', type=int, default=32, help='Crops per forward pass')
+    parser.add_argument('--workers', type=int, default=None, help='Crop preprocessing threads (default: cores + 4)')
+    parser.add_argument('--backend', choices=BACKENDS, default=os.environ.get('MODEL_BACKEND', 'keras'))
+    parser.add_argument('--output', '-o', help='Write one row per cell to this CSV file')
+    parser.add_argument('--json', help='Write the full summary to this file')
+
+    args = parser.parse_args()
+
+    if not os.path.exists(args.field):
+        raise SystemExit(f"❌ File not found: {args.field}")
+
+    options = {}
+    if args.mode == 'segment':
+        options = {'threshold': args.threshold, 'min_area': args.min_area, 'max_area': args.max_area,
+                   'strip_rows': args.strip_rows}
+
+    backend, _ = load_backend(args.backend)
+    reader = open_field(args.field)
+
+    started = time.perf_counter()
+    summary = analyze_field(reader, backend.predict_batch, mode=args.mode, batch_size=args.batch_size,
+                            input_dtype=backend.input_dtype, decode_workers=args.workers, **options)
+    elapsed = time.perf_counter() - started
+
+    if args.output:
+        with open(args.output, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=CELL_FIELDS, extrasaction='ignore')
+            writer.writeheader()
+            writer.writerows(summary['cells'])
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(summary, f, indent=2)
+
+    print(f"✅ {summary['cell_count']} cells in {elapsed:.1f}s: {summary['parasitized']} parasitized, "
+          f"{summary['uninfected']} uninfected, parasitemia {summary['parasitemia_percent']}%")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+"""
+WebSocket streaming endpoint for continuous microscope feeds.
+
+``GET /stream`` upgrades to a WebSocket. The client sends each frame as one
+binary message holding an encoded image (PNG, JPEG, ...) and gets back one
+compact JSON text message per frame as soon as its prediction is ready:
+
+    {"seq":0,"result":"Uninfected (Malaria Negative)","confidence":97.1,"probability":97.1}
+    {"seq":1,"error":"Not a supported image"}
+
+``seq`` numbers the binary messages of a connection from 0; results may
+arrive out of order. The image is never echoed back.
+
+Flow control: at most ``window`` frames per connection are in flight. The
+first message on every connection announces the window:
+``{"type":"ready","window":8}``, and a client is expected to wait for a
+result before sending past it. simple_websocket reads the socket on its own
+thread and buffers every message it receives, so the server cannot slow a
+client down by not reading. Instead, a connection with more than
+``max_buffered`` frames waiting behind a full window is sent
+``{"error":"Too many frames in flight","window":8}`` and closed (code
+1008). Memory per connection is therefore bounded by ``window +
+max_buffered`` messages of at most ``max_message_size`` bytes.
+
+Needs the optional flask-sock package (``pip install flask-sock``) and a
+server that hands the socket to the app: gunicorn or the development
+server, not waitress.
+"""
+
+import io
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+
+from admission import Overloaded
+from ingest import HEADER_BYTES, sniff_image
+from telemetry import REGISTRY
+
+# How often a handler waiting for a free slot in the window checks the receive buffer
+BUFFER_CHECK_INTERVAL = 0.02
+
+
+def _dumps(message):
+    return json.dumps(message, separators=(',', ':'))
+
+
+class StreamStats:
+    """Connection and frame counters across all streams of this process"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {'connections': 0, 'open_connections': 0, 'frames': 0, 'errors': 0, 'in_flight': 0,
+                         'overflows': 0}
+
+    def add(self, **deltas):
+        with self._lock:
+            for key, delta in deltas.items():
+                self.counters[key] += delta
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters)
+
+
+def init_app(app, predict, admission=None, window=8, workers=32, max_message_size=None, max_buffered=None,
+             path='/stream'):
+    """Register the WebSocket endpoint at path; return False when flask-sock is not installed
+
+    ``predict`` takes a file object with the encoded image and returns the
+    same dict as ``predict_malaria``. Frames of all connections share a pool
+    of ``workers`` threads; each frame holds an ``admission`` slot while it
+    is predicted. A connection with more than ``max_buffered`` (default
+    ``window``) received frames waiting for the window is closed.
+    """
+    try:
+        from flask_sock import Sock
+        from simple_websocket import ConnectionClosed
+    except ImportError:
+        print(f"WebSocket streaming disabled (pip install flask-sock to enable {path})")
+        return False
+
+    max_buffered = window if max_buffered is None else max_buffered
+    app.config.setdefault('SOCK_SERVER_OPTIONS', {})
+    app.config['SOCK_SERVER_OPTIONS'].setdefault('max_message_size', max_message_size)
+    sock = Sock(app)
+    pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='stream')
+    counters = StreamStats()
+    REGISTRY.collector('malaria_stream', 'WebSocket stream connections and frames', 'gauge', counters.stats)
+
+    def predict_frame(seq, frame):
+        if sniff_image(bytes(frame[:HEADER_BYTES])) is None:
+            return {'seq': seq, 'error': 'Not a supported image'}
+        try:
+            with admission.slot() if admission is not None else nullcontext():
+                result = predict(io.BytesIO(frame))
+        except Overloaded as e:
+            return {'seq': seq, 'error': e.message, 'retry_after': e.retry_after}
+        return {'seq': seq, **result}
+
+    @sock.route(path)
+    def stream(ws):
+        credits = threading.BoundedSemaphore(window)
+        send_lock = threading.Lock()
+        closed = threading.Event()
+
+        def send(message):
+            with send_lock:
+                if closed.is_set():
+                    return
+                try:
+                    ws.send(_dumps(message))
+                except ConnectionClosed:
+                    closed.set()
+
+        def run(seq, frame):
+            try:
+                message = predict_frame(seq, frame)
+            except Exception as e:
+                message = {'seq': seq, 'error': f"Prediction error: {e}"}
+            if 'error' in message:
+                counters.add(errors=1)
+            send(message)
+            counters.add(in_flight=-1)
+            credits.release()
+
+        counters.add(connections=1, open_connections=1)
+        try:
+            send({'type': 'ready', 'window': window})
+            seq = 0
+            while not closed.is_set():
+                # Wait for a free slot in the window before taking the next frame. The
+                # socket is still read meanwhile, so cut off a client that keeps sending.
+                overflow = False
+                while not credits.acquire(timeout=BUFFER_CHECK_INTERVAL):
+                    if len(ws.input_buffer) > max_buffered:
+                        overflow = True
+                        break
+                if overflow:
+                    counters.add(overflows=1)
+                    send({'error': 'Too many frames in flight', 'window': window})
+                    with send_lock:
+                        closed.set()
+                        try:
+                            ws.close(reason=1008, message='Too many frames in flight')
+                        except ConnectionClosed:
+                            pass
+                    break
+                try:
+                    frame = ws.receive()
+                except ConnectionClosed:
+                    credits.release()
+                    break
+                if isinstance(frame, str):
+                    credits.release()
+                    send({'error': 'Send each image as one binary message'})
+                    continue
+                counters.add(frames=1, in_flight=1)
+                pool.submit(run, seq, frame)
+                seq += 1
+
+            # Let the frames already received finish before the handler returns
+            for _ in range(window):
+                credits.acquire()
+        finally:
+            counters.add(open_connections=-1)
+
+    return True
@@ -0,0 +1,222 @@
+"""
+Request tracing and metrics for the Malaria Detection System.
+
+- ``span(stage)`` times one stage of the hot path (decode, inference, ...)
+  into the ``malaria_stage_seconds`` histogram and into the current
+  request's trace.
+- ``init_app(app)`` gives every request a trace ID (taken from an incoming
+  ``X-Request-ID`` header when present), returns it with a
+  ``Server-Timing`` header listing the stage timings, records
+  ``malaria_request_seconds`` per route and serves everything at
+  ``/metrics`` in the Prometheus text format.
+- With ``PROFILER_ENABLED=1``, ``/debug/profile?seconds=10`` samples the
+  stacks of all threads and returns them in the collapsed format read by
+  flamegraph.pl and speedscope.
+
+Metrics are kept per process; with several web workers, scrape each one.
+"""
+
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_trace = threading.local()
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+class Histogram:
+    """Thread-safe Prometheus histogram with a fixed set of label names"""
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * len(self.buckets), 0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][index] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            series = sorted((labels, (list(counts), total, count))
+                            for labels, (counts, total, count) in self._series.items())
+        for labels, (counts, total, count) in series:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, [('le', f'{bound:g}')])} "
+                             f"{cumulative}")
+            lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, [('le', '+Inf')])} {count}")
+            lines.append(f'{self.name}_sum{_format_labels(self.labelnames, labels)} {total:.6f}')
+            lines.append(f'{self.name}_count{_format_labels(self.labelnames, labels)} {count}')
+        return lines
+
+
+class Registry:
+    """Histograms plus callbacks that report current values when scraped"""
+
+    def __init__(self):
+        self._histograms = []
+        self._collectors = []
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        histogram = Histogram(name, documentation, labelnames, buckets)
+        self._histograms.append(histogram)
+        return histogram
+
+    def collector(self, name, documentation, kind, collect):
+        """Register ``collect() -> number or {label value: number}`` as a gauge or counter
+
+        A dict result is reported with one ``key`` label per entry. Errors
+        and None results skip the metric for that scrape.
+        """
+        self._collectors.append((name, documentation, kind, collect))
+
+    def render(self):
+        lines = []
+        for histogram in self._histograms:
+            lines += histogram.render()
+        for name, documentation, kind, collect in self._collectors:
+            try:
+                value = collect()
+            except Exception:
+                continue
+            if value is None:
+                continue
+            lines += [f'# HELP {name} {documentation}', f'# TYPE {name} {kind}']
+            if isinstance(value, dict):
+                lines += [f"{name}{_format_labels(('key',), (key,))} {float(v):g}" for key, v in sorted(value.items())]
+            else:
+                lines.append(f'{name} {float(value):g}')
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+STAGE_SECONDS = REGISTRY.histogram('malaria_stage_seconds', 'Time spent in each stage of a request', ('stage',))
+REQUEST_SECONDS = REGISTRY.histogram('malaria_request_seconds', 'Time to handle a request until the response '
+                                     'headers are sent', ('route', 'method', 'status'))
+
+
+def record_span(stage, elapsed):
+    """Record ``elapsed`` seconds of ``stage`` in the stage histogram and the current trace
+
+    For stages timed on another thread (e.g. the decode stage), whose own
+    thread has no trace: time them there and record them from the request.
+    """
+    STAGE_SECONDS.observe(elapsed, stage)
+    spans = getattr(_trace, 'spans', None)
+    if spans is not None:
+        spans.append((stage, elapsed))
+
+
+@contextmanager
+def span(stage):
+    """Time a block as ``stage`` in the stage histogram and the current trace"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_span(stage, time.perf_counter() - started)
+
+
+def current_trace_id():
+    """Trace ID of the request being handled on this thread, or None"""
+    return getattr(_trace, 'trace_id', None)
+
+
+def sample_stacks(seconds, interval=0.005):
+    """Sample every other thread's stack for ``seconds`` and count collapsed stacks"""
+    me = threading.get_ident()
+    names = {}
+    counts = Counter()
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        frames = sys._current_frames()
+        if len(names) != len(frames):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in frames.items():
+            if ident == me:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                frame = frame.f_back
+            stack.append(names.get(ident, str(ident)))
+            counts[';'.join(reversed(stack))] += 1
+        time.sleep(interval)
+    return counts
+
+
+def init_app(app, profiler_enabled=False):
+    """Add trace IDs, Server-Timing headers, request metrics, /metrics and /debug/profile"""
+    from flask import Response, abort, request
+
+    profile_lock = threading.Lock()
+
+    @app.before_request
+    def start_trace():
+        _trace.trace_id = request.headers.get('X-Request-ID') or uuid.uuid4().hex
+        _trace.started = time.perf_counter()
+        _trace.spans = []
+
+    @app.after_request
+    def finish_trace(response):
+        started = getattr(_trace, 'started', None)
+        if started is None:
+            return response
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        REQUEST_SECONDS.observe(time.perf_counter() - started, route, request.method, str(response.status_code))
+
+        response.headers['X-Request-ID'] = _trace.trace_id
+        if _trace.spans:
+            response.headers['Server-Timing'] = ', '.join(f'{stage};dur={elapsed * 1000:.2f}'
+                                                          for stage, elapsed in _trace.spans)
+        _trace.started = _trace.spans = None
+        return response
+
+    @app.route('/metrics')
+    def metrics():
+        """Prometheus metrics for this process"""
+        return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
+    @app.route('/debug/profile')
+    def profile():
+        """Sample all thread stacks and return them as collapsed stacks for a flame graph"""
+        if not profiler_enabled:
+            abort(404)
+        seconds = min(float(request.args.get('seconds', 10)), 60.0)
+        interval = max(float(request.args.get('interval_ms', 5)), 1.0) / 1000
+        if not profile_lock.acquire(blocking=False):
+            return Response('A profile is already running\n', status=409, mimetype='text/plain')
+        try:
+            counts = sample_stacks(seconds, interval)
+        finally:
+            profile_lock.release()
+        body = ''.join(f'{stack} {count}\n' for stack, count in counts.most_common())
+        return Response(body, mimetype='text/plain')
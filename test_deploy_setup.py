@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+Tests for the model download in deploy_setup.py, against a local HTTP server
+stand-in that serves byte ranges.
+"""
+
+import hashlib
+import os
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import deploy_setup
+from deploy_setup import DownloadError, fetch_model
+
+PAYLOAD = os.urandom(3 * 1024 * 1024 + 17)
+PAYLOAD_SHA256 = hashlib.sha256(PAYLOAD).hexdigest()
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    """Serves server.payload, honouring single byte ranges like a CDN would"""
+
+    def do_GET(self):
+        payload = self.server.payload
+        header = self.headers.get('Range')
+        with self.server.lock:
+            self.server.ranges.append(header)
+        match = re.fullmatch(r'bytes=(\d+)-(\d*)', header or '')
+        if match:
+            start = int(match.group(1))
+            end = int(match.group(2)) + 1 if match.group(2) else len(payload)
+            body = payload[start:end]
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end - 1}/{len(payload)}')
+        else:
+            body = payload
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', '"model-v1"')
+        self.end_headers()
+        # Simulate a dropped connection partway through every ranged body
+        if self.server.cut_after is not None and match and len(body) > 1:
+            body = body[:self.server.cut_after]
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), RangeHandler)
+    httpd.payload = PAYLOAD
+    httpd.ranges = []
+    httpd.lock = threading.Lock()
+    httpd.cut_after = None
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    httpd.url = f'http://127.0.0.1:{httpd.server_address[1]}/my_model.keras'
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture(autouse=True)
+def small_segments(monkeypatch):
+    # Split the test payload over several connections and retry without waiting
+    monkeypatch.setattr(deploy_setup, 'MIN_SEGMENT', 512 * 1024)
+    monkeypatch.setattr(deploy_setup, 'BUFFER_SIZE', 64 * 1024)
+    monkeypatch.setattr(deploy_setup.time, 'sleep', lambda seconds: None)
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def test_parallel_ranges(server, tmp_path):
+    target = str(tmp_path / 'my_model.keras')
+
+    assert fetch_model(server.url, target, sha256=PAYLOAD_SHA256, connections=4, verbose=False) == 'downloaded'
+
+    assert read(target) == PAYLOAD
+    # One probe plus one request per segment
+    assert len(server.ranges) == 5
+    starts = sorted(int(r.split('=')[1].split('-')[0]) for r in server.ranges[1:])
+    assert starts == [len(PAYLOAD) * i // 4 for i in range(4)]
+    assert not os.path.exists(target + '.part')
+    assert not os.path.exists(target + '.part.json')
+
+
+def test_resume_after_truncation(server, tmp_path, monkeypatch):
+    target = str(tmp_path / 'my_model.keras')
+    monkeypatch.setattr(deploy_setup, 'RETRIES', 1)
+    server.cut_after = 100 * 1024
+
+    with pytest.raises(DownloadError):
+        fetch_model(server.url, target, sha256=PAYLOAD_SHA256, connections=4, verbose=False)
+    assert not os.path.exists(target)
+    assert os.path.exists(target + '.part.json')
+
+    server.cut_after = None
+    server.ranges.clear()
+    assert fetch_model(server.url, target, sha256=PAYLOAD_SHA256, connections=4, verbose=False) == 'downloaded'
+
+    assert read(target) == PAYLOAD
+    # Every segment carried on from where the first attempt stopped
+    starts = sorted(int(r.split('=')[1].split('-')[0]) for r in server.ranges[1:])
+    assert starts == [len(PAYLOAD) * i // 4 + 100 * 1024 for i in range(4)]
+
+
+def test_sha256_mismatch(server, tmp_path):
+    target = str(tmp_path / 'my_model.keras')
+
+    with pytest.raises(DownloadError, match='SHA-256 mismatch'):
+        fetch_model(server.url, target, sha256='0' * 64, verbose=False)
+
+    assert not os.path.exists(target)
+    assert not os.path.exists(target + '.part')
+    assert not os.path.exists(target + '.part.json')
+
+
+def test_cached_copy_is_not_downloaded(server, tmp_path):
+    target = str(tmp_path / 'my_model.keras')
+    fetch_model(server.url, target, sha256=PAYLOAD_SHA256, verbose=False)
+    server.ranges.clear()
+
+    assert fetch_model(server.url, target, sha256=PAYLOAD_SHA256, verbose=False) == 'cached'
+    assert server.ranges == []
+
+
+def test_progress_with_zero_size(tmp_path):
+    state = {'size': 0, 'segments': [{'start': 0, 'end': 0, 'done': 0}]}
+    with open(tmp_path / 'part', 'wb') as f:
+        progress = deploy_setup._Progress(state, str(tmp_path / 'part.json'), f.fileno())
+        progress.advance(state['segments'][0], 0)
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+"""
+Tests for the MicroBatcher scheduler in inference.py, driven by the stub
+backend behind a gate so the tests decide when each forward pass finishes.
+"""
+
+import queue
+import threading
+from concurrent.futures import TimeoutError
+
+import numpy as np
+import pytest
+
+from backends import StubBackend
+from inference import MicroBatcher
+
+IMAGES = np.random.default_rng(0).random((16, 4, 4, 3), dtype=np.float32)
+EXPECTED = StubBackend(cost_ms=0, per_image_ms=0).predict_batch(IMAGES)
+
+
+class GatedModel:
+    """Stub backend whose passes wait until the test opens the gate"""
+
+    def __init__(self):
+        self.backend = StubBackend(cost_ms=0, per_image_ms=0)
+        self.gate = threading.Event()
+        self.entered = threading.Event()
+        self.batch_sizes = []
+        # Numbers (from 1) of the passes that raise
+        self.failing_passes = set()
+
+    def predict_batch(self, batch):
+        self.batch_sizes.append(len(batch))
+        self.entered.set()
+        assert self.gate.wait(5)
+        if len(self.batch_sizes) in self.failing_passes:
+            raise RuntimeError('model failed')
+        return self.backend.predict_batch(batch)
+
+
+@pytest.fixture
+def model():
+    return GatedModel()
+
+
+@pytest.fixture
+def make_batcher(model):
+    batchers = []
+
+    def make(**options):
+        batcher = MicroBatcher(model.predict_batch, **options)
+        batchers.append(batcher)
+        return batcher
+
+    yield make
+    model.gate.set()
+    for batcher in batchers:
+        batcher.close()
+
+
+def hold_first_pass(model, batcher):
+    """Put one image through so the scheduler is busy in a pass until the gate opens"""
+    future = batcher.submit(IMAGES[0])
+    assert model.entered.wait(5)
+    return future
+
+
+def test_full_batch_does_not_wait(model, make_batcher):
+    batcher = make_batcher(max_batch_size=4, max_wait_ms=60_000)
+    model.gate.set()
+
+    futures = [batcher.submit(image) for image in IMAGES[:4]]
+
+    assert [future.result(5) for future in futures] == pytest.approx(EXPECTED[:4].tolist())
+    assert model.batch_sizes == [4]
+
+
+def test_queued_images_are_coalesced(model, make_batcher):
+    batcher = make_batcher(max_batch_size=3, max_wait_ms=0)
+    first = hold_first_pass(model, batcher)
+
+    # Seven images queue up behind the pass in progress
+    futures = [batcher.submit(image) for image in IMAGES[1:8]]
+    model.gate.set()
+
+    assert first.result(5) == pytest.approx(float(EXPECTED[0]))
+    assert [future.result(5) for future in futures] == pytest.approx(EXPECTED[1:8].tolist())
+    assert model.batch_sizes == [1, 3, 3, 1]
+    stats = batcher.stats()
+    assert stats['batch_size_counts'] == {'1': 2, '3': 2}
+    assert stats['images'] == 8
+
+
+def test_partial_batch_runs_after_max_wait(model, make_batcher):
+    batcher = make_batcher(max_batch_size=32, max_wait_ms=20)
+    model.gate.set()
+
+    futures = [batcher.submit(image) for image in IMAGES[:3]]
+
+    assert [future.result(5) for future in futures] == pytest.approx(EXPECTED[:3].tolist())
+    assert sum(model.batch_sizes) == 3
+    assert max(model.batch_sizes) <= 3
+
+
+def test_result_timeout(model, make_batcher):
+    batcher = make_batcher(max_batch_size=4, max_wait_ms=0)
+
+    with pytest.raises(TimeoutError):
+        batcher.predict(IMAGES[0], timeout=0.05)
+
+    model.gate.set()
+    assert batcher.predict(IMAGES[1], timeout=5) == pytest.approx(float(EXPECTED[1]))
+
+
+def test_error_reaches_every_future_of_the_batch(model, make_batcher):
+    batcher = make_batcher(max_batch_size=4, max_wait_ms=0)
+    model.failing_passes = {2}
+    first = hold_first_pass(model, batcher)
+    # The held pass succeeds; the next one, of these four images, fails
+    failing = [batcher.submit(image) for image in IMAGES[1:5]]
+    model.gate.set()
+
+    assert first.result(5) == pytest.approx(float(EXPECTED[0]))
+    for future in failing:
+        with pytest.raises(RuntimeError, match='model failed'):
+            future.result(5)
+    assert batcher.stats()['errors'] == 1
+
+    # The scheduler keeps going after a failed pass
+    assert batcher.predict(IMAGES[5], timeout=5) == pytest.approx(float(EXPECTED[5]))
+
+
+def test_full_queue_sheds_load(model, make_batcher):
+    batcher = make_batcher(max_batch_size=4, max_wait_ms=0, max_queue_size=2)
+    hold_first_pass(model, batcher)
+    batcher.submit(IMAGES[1])
+    batcher.submit(IMAGES[2])
+
+    with pytest.raises(queue.Full):
+        batcher.submit(IMAGES[3])
+
+
+def test_predict_batch_of_mixed_sizes(model, make_batcher):
+    batcher = make_batcher(max_batch_size=4, max_wait_ms=1)
+    model.gate.set()
+
+    for size in (1, 3, 4, 9):
+        probabilities = batcher.predict_batch(IMAGES[:size], timeout=5)
+        assert probabilities.dtype == np.float32
+        assert probabilities.tolist() == pytest.approx(EXPECTED[:size].tolist())
+    assert max(model.batch_sizes) <= 4
+
+
+def test_serialized_waits_for_the_scheduler_pass(model, make_batcher):
+    batcher = make_batcher(max_batch_size=4, max_wait_ms=0)
+    hold_first_pass(model, batcher)
+    single_pass = batcher.serialized(model.backend.predict_batch)
+    result = []
+    thread = threading.Thread(target=lambda: result.append(single_pass(IMAGES[:8])))
+    thread.start()
+
+    thread.join(0.1)
+    assert thread.is_alive() and not result
+
+    model.gate.set()
+    thread.join(5)
+    assert result[0].tolist() == pytest.approx(EXPECTED[:8].tolist())
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""
+Tests for the streaming request parsers in ingest.py, fed through small
+chunk sizes so boundaries, keys and escapes land across chunk edges.
+"""
+
+import base64
+import io
+import random
+
+import pytest
+
+from ingest import IngestError, iter_multipart_files, read_data_url_image, sniff_image
+
+# Looks like a PNG to sniff_image; the parsers never decode the pixels
+PNG = b'\x89PNG\r\n\x1a\n' + random.Random(0).randbytes(3000)
+BOUNDARY = 'test-boundary-1234'
+
+
+def multipart(*parts):
+    """Body holding (field, filename, data) file parts"""
+    body = b''
+    for field, filename, data in parts:
+        body += (f'--{BOUNDARY}\r\nContent-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'
+                 f'Content-Type: application/octet-stream\r\n\r\n').encode() + data + b'\r\n'
+    return body + f'--{BOUNDARY}--\r\n'.encode()
+
+
+def validate_image(filename, head):
+    return None if sniff_image(head) else 'Not a supported image file'
+
+
+def read_parts(body, **kwargs):
+    return [(name, None if data is None else bytes(data), error)
+            for name, data, error in iter_multipart_files(io.BytesIO(body), BOUNDARY, ('file',), **kwargs)]
+
+
+def json_body(encoded, key='image_data'):
+    return b'{"other": 1, "' + key.encode() + b'": "data:image\\/png;base64,' + encoded + b'", "x": 2}'
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 64, 65536])
+def test_multipart_boundaries_across_chunks(chunk_size):
+    body = multipart(('file', 'a.png', PNG), ('ignored', 'b.png', PNG), ('file', 'c.png', PNG[:500]))
+
+    parts = read_parts(body, validate=validate_image, chunk_size=chunk_size)
+
+    assert parts == [('a.png', PNG, None), ('c.png', PNG[:500], None)]
+
+
+def test_multipart_rejects_non_image_without_storing_it():
+    body = multipart(('file', 'notes.txt', b'plain text, not an image' * 100), ('file', 'a.png', PNG))
+
+    parts = read_parts(body, validate=validate_image, chunk_size=7)
+
+    assert parts == [('notes.txt', None, 'Not a supported image file'), ('a.png', PNG, None)]
+
+
+def test_multipart_rejects_empty_part():
+    parts = read_parts(multipart(('file', 'empty.png', b'')), validate=validate_image)
+
+    assert parts == [('empty.png', None, 'Not a supported image file')]
+
+
+def test_multipart_size_limit():
+    body = multipart(('file', 'a.png', PNG))
+
+    with pytest.raises(IngestError) as error:
+        read_parts(body, max_bytes=len(PNG) - 1, chunk_size=64)
+    assert error.value.status == 413
+    assert read_parts(body, max_bytes=len(PNG)) == [('a.png', PNG, None)]
+
+
+def test_multipart_incomplete_body():
+    body = multipart(('file', 'a.png', PNG))[:-40]
+
+    with pytest.raises(IngestError, match='Incomplete multipart body'):
+        read_parts(body, chunk_size=64)
+
+
+def test_multipart_malformed_part_headers():
+    body = f'--{BOUNDARY}\r\nContent-Type: image/png\r\n\r\n'.encode() + PNG + f'\r\n--{BOUNDARY}--\r\n'.encode()
+
+    with pytest.raises(IngestError, match='Invalid multipart body'):
+        read_parts(body)
+
+
+def test_multipart_spool():
+    body = multipart(('file', 'a.png', PNG), ('file', 'notes.txt', b'not an image at all'))
+
+    parts = list(iter_multipart_files(io.BytesIO(body), BOUNDARY, ('file',), validate=validate_image,
+                                      chunk_size=7, spool=True))
+
+    (name, spooled, error), (rejected_name, rejected, rejected_error) = parts
+    assert (name, error) == ('a.png', None)
+    assert spooled.name.endswith('.png')
+    assert spooled.read() == PNG
+    spooled.close()
+    assert (rejected_name, rejected, rejected_error) == ('notes.txt', None, 'Not a supported image file')
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 3, 5, 7, 64, 65536])
+def test_data_url_key_and_escapes_across_chunks(chunk_size):
+    encoded = base64.b64encode(PNG)
+    assert b'/' in encoded
+    # Base64 wrapped at 76 columns, then JSON-encoded with "/" escaped
+    wrapped = b'\n'.join(encoded[i:i + 76] for i in range(0, len(encoded), 76))
+    escaped = wrapped.replace(b'/', b'\\/').replace(b'\n', b'\\n')
+
+    prefix, image = read_data_url_image(io.BytesIO(json_body(escaped)), chunk_size=chunk_size)
+
+    assert prefix == 'data:image/png;base64'
+    assert bytes(image) == PNG
+
+
+def test_data_url_missing_key():
+    assert read_data_url_image(io.BytesIO(b'{"sample_id": "x"}'), chunk_size=3) == (None, None)
+
+
+@pytest.mark.parametrize('encoded', [b'iVBOR\\u0041', b'iVBOR\\"abc', b'iVBOR\\tabc'])
+def test_data_url_rejects_other_escapes(encoded):
+    with pytest.raises(IngestError, match='Invalid image data'):
+        read_data_url_image(io.BytesIO(json_body(encoded)), chunk_size=4)
+
+
+def test_data_url_rejects_bad_prefix():
+    body = b'{"image_data": "http://example.com/cell.png,abcd"}'
+
+    with pytest.raises(IngestError, match='Invalid image data'):
+        read_data_url_image(io.BytesIO(body))
+
+
+def test_data_url_incomplete():
+    body = json_body(base64.b64encode(PNG))[:-20]
+
+    with pytest.raises(IngestError, match='Incomplete image data'):
+        read_data_url_image(io.BytesIO(body), chunk_size=64)
+
+
+def test_data_url_size_limit():
+    body = json_body(base64.b64encode(PNG))
+
+    with pytest.raises(IngestError) as error:
+        read_data_url_image(io.BytesIO(body), max_bytes=1024, chunk_size=64)
+    assert error.value.status == 413
+
+
+def test_data_url_rejects_non_image():
+    body = json_body(base64.b64encode(b'plain text, not an image' * 10))
+
+    with pytest.raises(IngestError, match='Not a supported image file'):
+        read_data_url_image(io.BytesIO(body), chunk_size=5)
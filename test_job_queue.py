@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+"""
+Tests for the SQLite job queue in job_queue.py, with the stub backend as
+the model and a temporary database per test.
+"""
+
+import io
+import sqlite3
+import time
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from backends import StubBackend
+from job_queue import JobQueue
+
+STUB = StubBackend(cost_ms=0, per_image_ms=0)
+
+
+def png(value):
+    buffer = io.BytesIO()
+    Image.fromarray(np.full((40, 40, 3), value, dtype=np.uint8)).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def wait_until_done(jobs, job_id, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        job = jobs.get(job_id)
+        if job['status'] == 'done':
+            return job
+        time.sleep(0.01)
+    raise AssertionError(f'job still {jobs.get(job_id)} after {timeout}s')
+
+
+def jobs_status(db_path):
+    with sqlite3.connect(db_path) as db:
+        return [row[0] for row in db.execute('SELECT status FROM items ORDER BY seq')]
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / 'jobs.sqlite3')
+
+
+def test_job_results_in_submission_order(db_path):
+    jobs = JobQueue(db_path, batch_size=2, workers=2, poll_interval=0.01)
+    images = [('dark.png', png(40)), ('broken.png', b'not an image'), ('light.png', png(220))]
+    job_id = jobs.submit(images)
+    assert jobs.get(job_id)['status'] == 'queued'
+
+    jobs.start(STUB.predict_batch)
+    job = wait_until_done(jobs, job_id)
+
+    assert (job['total'], job['done'], job['failed'], job['progress']) == (3, 2, 1, 1.0)
+    results = jobs.results(job_id)
+    assert [result['filename'] for result in results] == ['dark.png', 'broken.png', 'light.png']
+    assert [result['status'] for result in results] == ['done', 'failed', 'done']
+    assert results[1]['error'].startswith('Failed to process image')
+    assert results[0]['result'].startswith('Parasitized')
+    assert results[2]['result'].startswith('Uninfected')
+
+
+def test_empty_job_is_done(db_path):
+    jobs = JobQueue(db_path)
+
+    job_id = jobs.submit([])
+
+    assert jobs.get(job_id)['status'] == 'done'
+    assert jobs.get(job_id)['progress'] == 1.0
+    assert jobs.get('unknown') is None
+
+
+def test_prediction_error_fails_the_batch(db_path):
+    jobs = JobQueue(db_path, batch_size=8, workers=1, poll_interval=0.01)
+    job_id = jobs.submit([('a.png', png(40)), ('b.png', png(220))])
+
+    def broken_model(batch):
+        raise RuntimeError('out of memory')
+    jobs.start(broken_model)
+    job = wait_until_done(jobs, job_id)
+
+    assert (job['done'], job['failed']) == (0, 2)
+    assert [result['error'] for result in jobs.results(job_id)] == ['Prediction error: out of memory'] * 2
+
+
+def test_jobs_survive_a_restart(db_path):
+    job_id = JobQueue(db_path).submit([('a.png', png(40))])
+
+    restarted = JobQueue(db_path, workers=1, poll_interval=0.01)
+    assert restarted.get(job_id)['status'] == 'queued'
+    restarted.start(STUB.predict_batch)
+
+    assert wait_until_done(restarted, job_id)['done'] == 1
+
+
+def test_expired_lease_is_requeued_and_live_lease_is_not(db_path):
+    job_id = JobQueue(db_path).submit([('a.png', png(40)), ('b.png', png(220))])
+
+    # A worker that claims the items and then dies without renewing its lease
+    dead = JobQueue(db_path, lease_seconds=0.2)
+    assert len(dead._claim()) == 2
+    assert jobs_status(db_path) == ['running', 'running']
+
+    # While the lease runs, other workers leave the items alone
+    other = JobQueue(db_path, workers=1, poll_interval=0.01)
+    assert other._claim() == []
+
+    time.sleep(0.3)
+    other.start(STUB.predict_batch)
+    job = wait_until_done(other, job_id)
+    assert (job['done'], job['failed']) == (2, 0)
+
+
+def test_live_lease_is_renewed(db_path):
+    jobs = JobQueue(db_path, workers=1, poll_interval=0.01, lease_seconds=0.3)
+    job_id = jobs.submit([('a.png', png(40))])
+    started = []
+
+    def slow_model(batch):
+        started.append(time.time())
+        time.sleep(0.8)
+        return STUB.predict_batch(batch)
+    jobs.start(slow_model)
+
+    # Past the first lease, the heartbeat has kept the item from being claimed again
+    time.sleep(0.5)
+    assert JobQueue(db_path)._claim() == []
+    wait_until_done(jobs, job_id)
+    assert len(started) == 1
+
+
+def test_worker_recovers_from_database_errors(db_path, monkeypatch):
+    jobs = JobQueue(db_path, workers=1, poll_interval=0.01)
+    job_id = jobs.submit([('a.png', png(40))])
+    claim = jobs._claim
+    calls = []
+
+    def flaky_claim():
+        calls.append(1)
+        if len(calls) == 1:
+            raise sqlite3.OperationalError('database is locked')
+        return claim()
+    monkeypatch.setattr(jobs, '_claim', flaky_claim)
+    jobs.start(STUB.predict_batch)
+
+    assert wait_until_done(jobs, job_id)['done'] == 1
+    assert len(calls) >= 2
+
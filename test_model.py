@@ -3,78 +3,44 @@
 Test script to verify model loading and basic functionality
 """
 
-import tensorflow as tf
 import numpy as np
-from PIL import Image
 import os
 
+from inference import model_probabilities
+from model_registry import load_model, warmup
+from preprocessing import preprocess_image
+
 def test_model_loading():
     """Test if the model can be loaded successfully"""
     print("Testing model loading...")
     
-    model = None
-    
-    # Try different loading approaches
     try:
-        # First try: direct load
-        model = tf.keras.models.load_model('my_model.keras copy')
-        print("✅ Model loaded successfully using direct load!")
+        model, record = load_model()
+        print(f"✅ Model loaded successfully using {record['loader']} "
+              f"({record['format']}) in {record['load_seconds']}s!")
         
         # Print model summary
-        print("\nModel Summary:")
-        model.summary()
+        if hasattr(model, 'summary'):
+            print("\nModel Summary:")
+            model.summary()
         
         # Test with a dummy image
         print("\nTesting with dummy image...")
-        dummy_image = np.random.rand(1, 224, 224, 3)
-        prediction = model.predict(dummy_image)
+        dummy_image = np.random.rand(1, 224, 224, 3).astype(np.float32)
+        prediction = model_probabilities(model, dummy_image)
         print(f"✅ Prediction shape: {prediction.shape}")
         print(f"✅ Prediction value: {prediction[0]}")
         
+        # Warm up at the batch sizes the app uses
+        print("\nWarming up...")
+        timings = warmup(lambda batch: model_probabilities(model, batch))
+        print(f"✅ Warmup time per batch size (ms): {timings}")
+        
         return True
         
     except Exception as e:
-        print(f"Direct load failed: {e}")
-        
-        try:
-            # Second try: using TFSMLayer
-            from tensorflow import keras
-            model = keras.layers.TFSMLayer('my_model.keras copy', call_endpoint='serving_default')
-            print("✅ Model loaded successfully using TFSMLayer!")
-            
-            # Test with a dummy image
-            print("\nTesting with dummy image...")
-            dummy_image = np.random.rand(1, 224, 224, 3)
-            prediction = model(dummy_image)
-            if isinstance(prediction, dict):
-                prediction = list(prediction.values())[0]
-            print(f"✅ Prediction shape: {prediction.shape}")
-            print(f"✅ Prediction value: {prediction[0]}")
-            
-            return True
-            
-        except Exception as e2:
-            print(f"TFSMLayer load failed: {e2}")
-            
-            try:
-                # Third try: rename and load
-                import shutil
-                shutil.copy('my_model.keras copy', 'my_model.keras')
-                model = tf.keras.models.load_model('my_model.keras')
-                print("✅ Model loaded successfully after renaming!")
-                
-                # Test with a dummy image
-                print("\nTesting with dummy image...")
-                dummy_image = np.random.rand(1, 224, 224, 3)
-                prediction = model.predict(dummy_image)
-                print(f"✅ Prediction shape: {prediction.shape}")
-                print(f"✅ Prediction value: {prediction[0]}")
-                
-                return True
-                
-            except Exception as e3:
-                print(f"Renamed file load failed: {e3}")
-                return False
+        print(f"Model load failed: {e}")
+        return False
 
 def test_image_processing():
     """Test image processing functionality"""
@@ -100,13 +66,8 @@ def test_image_processing():
     if os.path.exists(parasitized_dir) and parasitized_files:
         sample_file = os.path.join(parasitized_dir, parasitized_files[0])
         try:
-            img = Image.open(sample_file)
-            img = img.resize((224, 224))
-            if img.mode != 'RGB':
-                img = img.convert('RGB')
-            img_array = np.array(img) / 255.0
-            img_array = np.expand_dims(img_array, axis=0)
-            print(f"✅ Sample image processed successfully. Shape: {img_array.shape}")
+            img_array = preprocess_image(sample_file)
+            print(f"✅ Sample image processed successfully. Shape: {img_array.shape}, dtype: {img_array.dtype}")
         except Exception as e:
             print(f"❌ Error processing sample image: {e}")
 
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+Tests for the content-addressed PredictionCache in prediction_cache.py.
+"""
+
+import numpy as np
+
+from prediction_cache import PredictionCache
+
+PIXELS = np.random.default_rng(0).integers(0, 256, (224, 224, 3), dtype=np.uint8)
+
+
+def test_key_follows_pixels_and_model_version():
+    key = PredictionCache.key(PIXELS, 'v1')
+
+    assert PredictionCache.key(PIXELS.copy(), 'v1') == key
+    # Non-contiguous views of the same pixels hash the same
+    assert PredictionCache.key(np.asfortranarray(PIXELS), 'v1') == key
+    assert PredictionCache.key(PIXELS, 'v2') != key
+    changed = PIXELS.copy()
+    changed[0, 0, 0] ^= 1
+    assert PredictionCache.key(changed, 'v1') != key
+    # Same bytes in another dtype or shape are another image
+    assert PredictionCache.key(PIXELS.astype(np.float32) / 255, 'v1') != key
+    assert PredictionCache.key(PIXELS.reshape(224, 672), 'v1') != key
+
+
+def test_hits_and_misses():
+    cache = PredictionCache(max_entries=4)
+    key = cache.key(PIXELS, 'v1')
+
+    assert cache.get(key) is None
+    cache.put(key, np.float32(0.25))
+    assert cache.get(key) == 0.25
+    assert isinstance(cache.get(key), float)
+
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['entries']) == (2, 1, 1)
+    assert stats['hit_rate'] == round(2 / 3, 4)
+    assert stats['disk_tier'] is False
+
+
+def test_least_recently_used_is_evicted():
+    cache = PredictionCache(max_entries=2)
+    cache.put('a', 0.1)
+    cache.put('b', 0.2)
+    cache.get('a')
+    cache.put('c', 0.3)
+
+    assert cache.get('b') is None
+    assert cache.get('a') == 0.1
+    assert cache.get('c') == 0.3
+    assert cache.stats()['evictions'] == 1
+    assert cache.stats()['entries'] == 2
+
+
+def test_disk_tier_survives_restart(tmp_path):
+    path = str(tmp_path / 'predictions.sqlite3')
+    cache = PredictionCache(max_entries=1, disk_path=path)
+    cache.put('a', 0.1)
+    cache.put('b', 0.2)
+
+    # Evicted from memory, still on disk
+    assert cache.get('a') == 0.1
+    assert cache.stats()['disk_hits'] == 1
+
+    restarted = PredictionCache(max_entries=8, disk_path=path)
+    assert restarted.get('b') == 0.2
+    assert restarted.get('missing') is None
+    stats = restarted.stats()
+    assert (stats['hits'], stats['disk_hits'], stats['misses']) == (0, 1, 1)
+    # The disk hit is now in memory
+    assert restarted.get('b') == 0.2
+    assert restarted.stats()['hits'] == 1